@@ -25,6 +25,13 @@
 #define RFM69_RST   4
 #define LED        13
 
+// Set to 1 to send 6 byte binary frames to the PC instead of text lines,
+//  run TrickOrTreaters.py with -b to read them
+//  [0xA5][type 'B' or 'H'][from][id][seq][crc8 of type, from, id and seq]
+//  Text lines end with " [From :<address>]" so the PC can tell the remotes apart
+#define BINARY_FRAMES 0
+#define FRAME_SYNC    0xA5
+
 // Singleton instance of the radio driver
 RH_RF69 rf69(RFM69_CS, RFM69_INT);
 
@@ -85,18 +92,35 @@ void loop() {
     if (rf69_manager.recvfromAck(buf, &len, &from)) {
       buf[len] = 0; // zero out remaining string
 
+#if BINARY_FRAMES
+      // Buttons send their number, hearts send the address of the remote.
+      //  The sequence is the radio header id, each remote counts its own so it is sent with the address.
+      //  The PC uses them to find lost and repeated packets
+      if(buf[0] == 'B')
+      {
+        SendFrame('B', from, atoi((char*)buf + 7), rf69_manager.headerId());
+      }
+      else if(buf[0] == 'H')
+      {
+        SendFrame('H', from, from, rf69_manager.headerId());
+      }
+#else
       if(buf[0] == 'H')
       {
       // Serial.print("Got packet from #"); Serial.print(from);
         Serial.print((char*)buf);
         Serial.print(" [RSSI :");
         Serial.print(rf69.lastRssi());
-        Serial.println("]");
+        Serial.print("]");
       }
       else
       {
-        Serial.println((char*)buf);
+        Serial.print((char*)buf);
       }
+      Serial.print(" [From :");
+      Serial.print(from);
+      Serial.println("]");
+#endif
       Blink(LED, 40, 3); // blink LED 3 times, 40ms between blinks
 
       // Send a reply back to the originator client
@@ -114,3 +138,21 @@ void Blink(byte pin, byte delay_ms, byte loops) {
     delay(delay_ms);
   }
 }
+
+// CRC-8, polynomial 0x07, matches crc8 in serial_interface.py
+uint8_t Crc8(const uint8_t *data, uint8_t len) {
+  uint8_t crc = 0;
+  while (len--) {
+    crc ^= *data++;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+void SendFrame(uint8_t type, uint8_t from, uint8_t id, uint8_t seq) {
+  uint8_t frame[6] = {FRAME_SYNC, type, from, id, seq, 0};
+  frame[5] = Crc8(frame + 1, 4);
+  Serial.write(frame, sizeof(frame));
+}
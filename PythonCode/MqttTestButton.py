@@ -13,15 +13,17 @@ import json
 import os
 import time
 import cmd
-from mqtt_interface import mqtt
+from mqtt_interface import mqtt, CoalescingPublisher
+from load_generator import poisson_arrivals, bursty_arrivals
 
 class ButtonTest(cmd.Cmd):
     def __init__(self, mqtt_config):
         super().__init__()
         """Init Class and create MQTT interface"""
-        self.send_topic = "Halloween\ButtonPress"
-        self.count_topic = "Halloween\TotalCount"
+        self.send_topic = r"Halloween\ButtonPress"
+        self.count_topic = r"Halloween\TotalCount"
         self.mqtt_interface = mqtt(mqtt_config, None, [])
+        self.count_publisher = CoalescingPublisher(self.mqtt_interface.publish_state, self.mqtt_interface.flush_window)
         self.intro = '\n'
         self.prompt = '> '
         self.test_count = 0
@@ -32,7 +34,7 @@ class ButtonTest(cmd.Cmd):
         print("Button Press")
         self.test_count = self.test_count + 1
         self.mqtt_interface.publish(self.send_topic, 1)
-        self.mqtt_interface.publish(self.count_topic, self.test_count)
+        self.count_publisher.publish(self.count_topic, self.test_count)
 
     def emptyline(self):
         """Sending an empty line will simulate a button press"""
@@ -47,7 +49,33 @@ class ButtonTest(cmd.Cmd):
         for x in range(int(count)):
             self.send_button_press()
 
+    def do_load(self, line):
+        """Send presses at a rate without printing each one (example: load 1000 200 bursty, sends 1000 at 200/s)"""
+        arguments = line.split()
+        count = int(arguments[0]) if len(arguments) > 0 else 100
+        rate = float(arguments[1]) if len(arguments) > 1 else 10
+        pattern = arguments[2] if len(arguments) > 2 else 'poisson'
+        if pattern == 'bursty':
+            offsets = bursty_arrivals(rate, count)
+        else:
+            offsets = poisson_arrivals(rate, count)
+        start = time.perf_counter()
+        for offset in offsets.tolist():
+            wait = start + offset - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            self.mqtt_interface.client.publish(self.send_topic, 1)
+        elapsed = time.perf_counter() - start
+        self.test_count = self.test_count + count
+        self.count_publisher.publish(self.count_topic, self.test_count)
+        print(f"Sent {count} presses in {elapsed:.2f}s ({count / elapsed:.0f}/s)")
+
+    def do_stats(self, line):
+        """Show how many count publishes were sent straight away, batched or replaced by a newer count"""
+        print(self.count_publisher.get_stats())
+
     def do_exit(self, line):
+        self.count_publisher.flush()
         return 1
         
 
@@ -8,20 +8,129 @@
 # -----------------------------------------------------------
 
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-import matplotlib.dates as mdates
-import pandas as pd
 
-import time
+import os
+import logging
+from threading import Thread, Lock, Event
 import random
-from random import randrange
 
-import numpy as np #used for testing only
+import numpy as np
+
+from event_store import EventBuffer, events_to_frame, merge_events, downsample_events, local_time_ns, ns_to_datetime, datetime_to_ns, NS_PER_SEC
+from rollup import RollupRing, CountIndex, MINUTE_NS, FIFTEEN_MIN_NS, HOUR_NS
+from event_log import EventLog, replay_log, FLUSH_INTERVAL_SEC
+from trick_report import CountRollups, write_csv_files, plot_rollups
+from live_state import LiveStateWriter
+
+MINUTE_BUCKETS = 24 * 60
+FIFTEEN_MIN_BUCKETS = 24 * 4
+# the events are compacted each time the oldest raw events are this share of the horizon past it
+COMPACT_SHARE = 10
 
 class trick_count:
-    def __init__(self):
-        self.raw_timestamp_df = pd.DataFrame({'count': 0}, index = [datetime.now()])
+    """Every public method is safe to call from any thread. Changes and reads of the events hold the
+       counter's lock only for the O(1) update or an array copy, the pandas work is done after the lock is released.
+       The total is a single int that is read without the lock.
+       With a retention policy the old events are compacted in tiers: raw events older than the raw horizon
+       become one event at the start of each minute and those older than the minute horizon one at the start
+       of each 15 minutes. The total stays exact, and old times are counted to the minute or 15 minutes.
+       A background thread compacts them, the new events and counts are built without the lock and swapped in"""
+    def __init__(self, log_path = None, flush_interval = FLUSH_INTERVAL_SEC, live_name = None,
+                 raw_horizon_sec = None, minute_horizon_sec = None):
+        """Create the counter
+           log_path - file for the event log, None to keep the events in memory only.
+                      if the file exists the events in it are replayed, so a restart resumes the count
+           flush_interval - seconds between writes of the event log to disk
+           live_name - shared memory name to publish the total and recent minutes in for other local
+                       processes (see live_state.LiveStateReader), None to not publish them
+           raw_horizon_sec - keep every event for this long, older ones are summed by the minute. None keeps them all
+           minute_horizon_sec - keep the minute sums for this long, older ones are summed by the 15 minutes.
+                                None keeps the minutes. The event log is compacted the same way"""
+        self.lock = Lock()
+        self.events = EventBuffer()
+        self.total = 0
+        self.minute_rollup = RollupRing(MINUTE_NS, MINUTE_BUCKETS)
+        self.fifteen_min_rollup = RollupRing(FIFTEEN_MIN_NS, FIFTEEN_MIN_BUCKETS)
+        self.index = CountIndex(MINUTE_NS, FIFTEEN_MIN_NS)
+        self.event_log = None
+        self.live_state = None if live_name is None else LiveStateWriter(live_name)
+        if None not in (raw_horizon_sec, minute_horizon_sec) and minute_horizon_sec < raw_horizon_sec:
+            raise ValueError("The minute horizon has to be at least as long as the raw horizon")
+        # (horizon ns, bucket ns) of each tier, longest horizon first
+        self.tiers = [(int(horizon * NS_PER_SEC), bucket_ns) for horizon, bucket_ns in
+                      [(minute_horizon_sec, FIFTEEN_MIN_NS), (raw_horizon_sec, MINUTE_NS)] if horizon is not None]
+        self.compact_interval = min((horizon // COMPACT_SHARE for horizon, _ in self.tiers), default=None)
+        # events at the front of the buffer that are compacted buckets, decrease() does not remove them,
+        # the time they end at, and the time the 15 minute buckets end at
+        self.compacted_size = 0
+        self.compacted_before_ns = None
+        self.folded_before_ns = None
+        # held for a whole compaction, so only one runs at a time
+        self.compact_lock = Lock()
+        # events at the front of the buffer not removed since the last compaction copied them
+        self.unchanged_size = 0
+        if log_path is not None and os.path.isfile(log_path):
+            replay_log(log_path, self.events)
+            self.__rebuild_rollups()
+        if log_path is not None:
+            self.event_log = EventLog(log_path, flush_interval)
+            self.compact()
+        if len(self.events) == 0:
+            self.__add_event(local_time_ns(), 0)
+        self.stop_event = Event()
+        self.compact_thread = None
+        if self.compact_interval is not None:
+            self.compact_thread = Thread(target=self.__compact_thread, args=(), daemon=True, name='EventCompaction')
+            self.compact_thread.start()
+
+    @property
+    def raw_timestamp_df(self):
+        """DataFrame view of the time stamped events, this is built from the event buffer on each access"""
+        return events_to_frame(*self.snapshot())
+
+    @raw_timestamp_df.setter
+    def raw_timestamp_df(self, df):
+        """Replace the events with the data in a DataFrame indexed by time with a 'count' column"""
+        self.load_events(EventBuffer.from_frame(df))
+
+    def load_events(self, events):
+        """Replace the stored events with the given EventBuffer and recompute the running counts"""
+        with self.compact_lock:
+            with self.lock:
+                self.events = events
+                self.compacted_size = 0
+                self.compacted_before_ns = None
+                self.folded_before_ns = None
+                self.__rebuild_rollups()
+            self.__compact(local_time_ns())
+
+    def merge_events(self, timestamps_ns, deltas, window_ns=0):
+        """Merge a block of events, like a backfill of lost presses, into the stored events in time order.
+           Events already stored are skipped, the running counts and the event log are rebuilt.
+           window_ns - an event this close to a stored event with the same delta is the stored event
+           Old events that have been compacted can not be matched, so they are not skipped.
+           Returns the number of events added"""
+        with self.compact_lock:
+            with self.lock:
+                timestamps, merged_deltas, added = merge_events(self.events.get_timestamps(), self.events.get_deltas(),
+                                                                timestamps_ns, deltas, window_ns)
+                if added == 0:
+                    return 0
+                self.events = EventBuffer(len(timestamps))
+                self.events.extend(timestamps, merged_deltas)
+                self.compacted_size = 0
+                self.compacted_before_ns = None
+                self.folded_before_ns = None
+                self.__rebuild_rollups()
+                if self.event_log is not None:
+                    self.event_log.rewrite(timestamps, merged_deltas)
+            self.__compact(local_time_ns())
+        return added
+
+    def snapshot(self):
+        """Return a consistent copy of the event (timestamps, deltas) arrays"""
+        with self.lock:
+            return self.events.copy_arrays()
 
     # def increase_fake(self, min, max):
     #     time_now = datetime.now()
@@ -30,100 +139,216 @@ class trick_count:
     #     print(f"{current} New Trick-or-Treater")
 
     def increase(self):
-        """increase the trick-or-treater count and time stamp a new entry into the data frame"""
-        time_now = datetime.now()
-        self.raw_timestamp_df = pd.concat([self.raw_timestamp_df, pd.DataFrame({'count': 1}, index = [time_now])])
-        print(f"{time_now} New Trick-or-Treater")
+        """increase the trick-or-treater count and time stamp a new entry into the event buffer"""
+        time_now = local_time_ns()
+        self.__add_event(time_now, 1)
+        logging.debug("New Trick-or-Treater")
 
     def decrease(self):
         """Remove the last entry incase the button is accidentally pressed"""
-        time_now = datetime.now()
-        self.raw_timestamp_df.drop(self.raw_timestamp_df.tail(1).index,inplace=True)
-        print(f"{time_now} Remove -- Trick-or-Treater")
+        with self.lock:
+            # a compacted bucket is many presses, it is not taken back
+            removed = self.events.pop() if len(self.events) > self.compacted_size else None
+            if removed is not None:
+                self.unchanged_size = min(self.unchanged_size, len(self.events))
+                self.__update_rollups(removed[0], -removed[1])
+                if self.event_log is not None:
+                    self.event_log.pop(removed[0])
+        logging.debug("Remove -- Trick-or-Treater")
 
     def mark(self):
         """set the new min to zero, which is a lazy way of inserting some zero into the graph"""
-        time_now = datetime.now()
-        self.raw_timestamp_df = pd.concat([self.raw_timestamp_df, pd.DataFrame({'count': 0}, index = [time_now])])
+        self.__add_event(local_time_ns(), 0)
         
+    def close(self):
+        """Stop the compaction, flush and close the event log, and remove the live state"""
+        self.stop_event.set()
+        if self.compact_thread is not None:
+            self.compact_thread.join()
+        with self.compact_lock, self.lock:
+            event_log, self.event_log = self.event_log, None
+            live_state, self.live_state = self.live_state, None
+        if event_log is not None:
+            event_log.close()
+        if live_state is not None:
+            live_state.close()
+
     def get_last_minute_count(self):
-        """returns the count of th previous minute's worth of data, by analyzing the """
-        output_df = self.raw_timestamp_df
-        # print(output_df)
-
-        min_data = self.raw_timestamp_df['count'].resample('min').sum()
-
-        last_min = (datetime.now() - timedelta(hours=0, minutes=1)).strftime('%H:%M')
-        last_min_data = min_data.between_time(last_min, last_min)
-        count = 0
-        if len(last_min_data):
-                count = last_min_data.values[0]
-        return count
+        """returns the count of the previous minute's worth of data, read from the minute rollup"""
+        last_min = self.minute_rollup.bucket_of(local_time_ns()) - 1
+        with self.lock:
+            return self.minute_rollup.get(last_min)
+
+    def get_last_fifteen_minute_count(self):
+        """returns the count of the previous full 15 minute block, read from the 15 minute rollup"""
+        last_block = self.fifteen_min_rollup.bucket_of(local_time_ns()) - 1
+        with self.lock:
+            return self.fifteen_min_rollup.get(last_block)
             
     def get_total_count(self):
         """Return the Total Count of all Trick-or-Treaters"""
-        sum = self.raw_timestamp_df['count'].sum()
-        return sum
-    
-    def plot_output(self): 
-        """Create some graphs and save the data"""  
-        min_data = self.raw_timestamp_df['count'].resample('min').sum()
-        min_df = pd.DataFrame(min_data)
-        min_df.index = pd.to_datetime(min_df.index, format = '%I:%M:%S').strftime('%I:%M')
-        min_plot = min_df.plot.bar(color = 'purple')
-        min_plot.set_xlabel("Time Stamp")
-        # min_plot.xaxis.set_major_locator(mdates.MinuteLocator(interval=1)) 
-        min_plot.set_ylabel("Count (Min)")
-        min_plot.set_title("Count by Min")
-    
-        fifteen_min_data = self.raw_timestamp_df['count'].resample('15min').sum()
-        fifteen_min_df = pd.DataFrame(fifteen_min_data)
-        fifteen_min_df.index = pd.to_datetime(fifteen_min_df.index, format = '%I:%M:%S').strftime('%I:%M')
-        fifteen_min_bar_plot = fifteen_min_df.plot.bar( color='red' )
-        fifteen_min_bar_plot.set_xlabel("Time Stamp")
-        fifteen_min_bar_plot.set_ylabel("Count (Min)")
-        fifteen_min_bar_plot.set_title("Count by 15 Mins")
-        
-        # raw_bar_plot = self.raw_timestamp_df.plot.bar( color='green' )
-        # raw_bar_plot.set_title("Raw Timestamped data")
-        self.raw_timestamp_df['total_count'] = self.raw_timestamp_df['count'].cumsum()
-        
-        # Create a timeline plot of the total count
-        plt.figure(figsize=(10, 3))
-        plt.plot(self.raw_timestamp_df.index, range(len(self.raw_timestamp_df)), marker='x', linestyle='-')
-        plt.yticks(range(len(self.raw_timestamp_df)), self.raw_timestamp_df['total_count'])
-        plt.gca().xaxis.set_major_formatter(DateFormatter('%I:%M'))
-        plt.gca().xaxis.set_major_locator(mdates.MinuteLocator(interval=15))
-        plt.xlabel('Time')
-        plt.xticks(minor=True)
-        plt.title('Total Trick-or-Treaters')
-        plt.grid(axis='x')
-        plt.tight_layout()
-        
-        raw_file_name = f"{datetime.today().year}_RawTrickOrTreatData.csv"
-        self.raw_timestamp_df.to_csv(raw_file_name, encoding='utf-8')
+        return self.total
+
+    def get_count_between(self, start, end):
+        """Count with start <= time < end to the minute, start and end are datetimes or nanosecond time stamps"""
+        start_ns = datetime_to_ns(start) if isinstance(start, datetime) else int(start)
+        end_ns = datetime_to_ns(end) if isinstance(end, datetime) else int(end)
+        with self.lock:
+            return self.index.count_between(start_ns, end_ns)
+
+    def get_rolling_count(self, minutes):
+        """Count of the last number of minutes, including the current minute"""
+        now = local_time_ns()
+        with self.lock:
+            return self.index.rolling_count(minutes * MINUTE_NS, now)
+
+    def get_rolling_rate(self, minutes):
+        """Trick-or-Treaters per minute over the last number of minutes"""
+        return self.get_rolling_count(minutes) / minutes
+
+    def get_hourly_counts(self):
+        """List of (hour start datetime, count) for every hour from the first event to now"""
+        with self.lock:
+            first_minute = self.index.first_bucket()
+            if first_minute is None:
+                return list()
+            first_hour = first_minute * MINUTE_NS // HOUR_NS
+            last_hour = local_time_ns() // HOUR_NS
+            return [(ns_to_datetime(hour * HOUR_NS), self.index.count_between(hour * HOUR_NS, (hour + 1) * HOUR_NS))
+                    for hour in range(first_hour, last_hour + 1)]
+
+    def get_busiest_windows(self, count=1):
+        """The busiest 15 minute blocks so far as a list of (block start datetime, count), busiest first"""
+        with self.lock:
+            windows = self.index.top_windows(count)
+        return [(ns_to_datetime(start), window_count) for start, window_count in windows]
+
+    def get_window_counts(self):
+        """Copy of the count of every 15 minute block as {block number: count}, a block starts at number * 15 minutes"""
+        with self.lock:
+            return self.index.all_window_counts()
 
-        min_file_name = f"{datetime.today().year}_MinTrickOrTreatData.csv"
-        min_df.to_csv(min_file_name, encoding='utf-8')
+    def __add_event(self, timestamp_ns, delta):
+        """Store a new event and update the running counts"""
+        with self.lock:
+            self.events.append(timestamp_ns, delta)
+            self.__update_rollups(timestamp_ns, delta)
+            if self.event_log is not None:
+                self.event_log.append(timestamp_ns, delta)
 
-        fifteen_file_name = f"{datetime.today().year}_15minTrickOrTreatData.csv"
-        fifteen_min_df.to_csv(fifteen_file_name, encoding='utf-8')
+    def compact(self):
+        """Compact the old events now instead of waiting for the compaction thread, does nothing without a
+           retention policy. Returns True if any events were compacted"""
+        if self.compact_interval is None:
+            return False
+        with self.compact_lock:
+            return self.__compact(local_time_ns())
 
-        plt.show()
+    def __compact_thread(self):
+        """Compact the old events every compact interval"""
+        while not self.stop_event.wait(self.compact_interval / NS_PER_SEC):
+            try:
+                self.compact()
+            except OSError as err:
+                logging.error("Event compaction failed: %s", err)
 
-def generate_test_data():
-    """Generate a data set to test graphing with"""
-    number_of_hours = 3
-    number_of_trick_or_treaters = random.randint(30, 100)
+    def __compact(self, now_ns):
+        """Sum the events past each tier's horizon into its buckets, the compact lock is held by the caller.
+           The events are copied under the lock, compacted and counted without it, then swapped in under the lock
+           with the events added meanwhile, even if none were compacted so a replayed log gets the compacted point.
+           The event log is rewritten when events were compacted, keeping the records written after the copy.
+           Returns True if any events were compacted"""
+        if self.compact_interval is None:
+            return False
+        with self.lock:
+            size = len(self.events)
+            old_timestamps, old_deltas = self.events.copy_arrays()
+            self.unchanged_size = size
+            log_end = None if self.event_log is None else self.event_log.end_offset()
+        timestamps, deltas = old_timestamps, old_deltas
+        compacted_size = 0
+        folded_before_ns = None
+        for horizon, bucket_ns in self.tiers:
+            compacted_before_ns = (now_ns - horizon) // bucket_ns * bucket_ns
+            timestamps, deltas, compacted_size = downsample_events(timestamps, deltas, compacted_before_ns, bucket_ns)
+            if bucket_ns == FIFTEEN_MIN_NS:
+                folded_before_ns = compacted_before_ns
+        changed = not (np.array_equal(timestamps, old_timestamps) and np.array_equal(deltas, old_deltas))
+        total, minute_rollup, fifteen_min_rollup, index = self.__build_rollups(timestamps, deltas, compacted_before_ns,
+                                                                               folded_before_ns)
+        with self.lock:
+            if self.unchanged_size < size:
+                logging.debug("Events were removed during the compaction, it is tried again next time")
+                return False
+            new_timestamps = self.events.get_timestamps()[size:].copy()
+            new_deltas = self.events.get_deltas()[size:].copy()
+            for timestamp_ns, delta in zip(new_timestamps.tolist(), new_deltas.tolist()):
+                total += delta
+                minute_rollup.add(timestamp_ns, delta)
+                fifteen_min_rollup.add(timestamp_ns, delta)
+                index.add(timestamp_ns, delta)
+            if changed:
+                logging.debug("Compacted %s events into %s", size, len(timestamps))
+            self.events = EventBuffer(len(timestamps) + len(new_timestamps))
+            self.events.extend(timestamps, deltas)
+            self.events.extend(new_timestamps, new_deltas)
+            self.compacted_size = compacted_size
+            self.compacted_before_ns = compacted_before_ns
+            self.folded_before_ns = folded_before_ns
+            # the total stays the same, so do the live state's recent minutes unless the minute horizon is under an hour
+            self.total, self.minute_rollup, self.fifteen_min_rollup, self.index = total, minute_rollup, fifteen_min_rollup, index
+            event_log = self.event_log
+        if changed and event_log is not None:
+            event_log.rewrite(timestamps, deltas, log_end)
+        return changed
+
+    def __update_rollups(self, timestamp_ns, delta):
+        """Apply a delta to the running total and the minute and 15 minute buckets, O(1)"""
+        self.total += delta
+        self.minute_rollup.add(timestamp_ns, delta)
+        self.fifteen_min_rollup.add(timestamp_ns, delta)
+        self.index.add(timestamp_ns, delta)
+        if self.live_state is not None:
+            self.live_state.update(self.total, timestamp_ns, delta)
+
+    def __rebuild_rollups(self):
+        """Recompute the running counts from every stored event"""
+        timestamps = self.events.get_timestamps()
+        deltas = self.events.get_deltas()
+        self.total, self.minute_rollup, self.fifteen_min_rollup, self.index = \
+            self.__build_rollups(timestamps, deltas, self.compacted_before_ns, self.folded_before_ns)
+        if self.live_state is not None:
+            self.live_state.load(self.total, timestamps, deltas)
+
+    @staticmethod
+    def __build_rollups(timestamps, deltas, compacted_before_ns, folded_before_ns):
+        """New (total, minute rollup, 15 minute rollup, index) of the events"""
+        minute_rollup = RollupRing(MINUTE_NS, MINUTE_BUCKETS)
+        minute_rollup.add_many(timestamps, deltas)
+        fifteen_min_rollup = RollupRing(FIFTEEN_MIN_NS, FIFTEEN_MIN_BUCKETS)
+        fifteen_min_rollup.add_many(timestamps, deltas)
+        index = CountIndex(MINUTE_NS, FIFTEEN_MIN_NS)
+        index.add_many(timestamps, deltas, compacted_before_ns, folded_before_ns)
+        return int(np.asarray(deltas).sum()), minute_rollup, fifteen_min_rollup, index
+    
+    def plot_output(self, show = True, image_format = None, output_dir = '.'):
+        """Create some graphs and save the data
+           show - open the graphs in a window, False renders without a display
+           image_format - 'png' or 'svg' to save the graphs as images, None to not save them"""
+        rollups = CountRollups(*self.snapshot())
+        write_csv_files(rollups, output_dir = output_dir)
+        plot_rollups(rollups, show = show, image_format = image_format, output_dir = output_dir)
+
+def generate_test_data(number_of_trick_or_treaters = None, number_of_hours = 3, show = True):
+    """Generate a data set to test graphing with, the count defaults to a random 30 to 100"""
+    import pandas as pd
+    if number_of_trick_or_treaters is None:
+        number_of_trick_or_treaters = random.randint(30, 100)
     end_time = datetime.now()
     start_time = end_time - timedelta(hours=number_of_hours)
         
-    random_times_list = []
-    
-    for _ in range(number_of_trick_or_treaters):
-        random_min = random.randint(0, (number_of_hours * 60))
-        random_time = (start_time + timedelta(minutes=random_min))
-        random_times_list.append(random_time)
+    random_mins = np.random.randint(0, (number_of_hours * 60) + 1, number_of_trick_or_treaters)
+    random_times_list = start_time + pd.to_timedelta(random_mins, unit='min')
     df = pd.DataFrame({'Time': random_times_list, 'count': 1}).sort_values('Time')
     # df['total_count'] = df['count'].cumsum()
     df = df.set_index('Time')
@@ -132,7 +357,8 @@ def generate_test_data():
     tc = trick_count()
     tc.raw_timestamp_df = df
     
-    tc.plot_output()
+    tc.plot_output(show = show)
+    return tc
     
 
 if __name__ == '__main__':
@@ -9,104 +9,315 @@
 
 import argparse
 import os
+import sys
 import json
+import logging
 import time
-import schedule
 from datetime import datetime
-from threading import Thread
-from TrickCount import trick_count
-from serial_interface import RadioInterface
-from mqtt_interface import mqtt
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from counter_group import CounterGroup, DEFAULT_SITE
+from radio_manager import RadioManager
+from mqtt_interface import mqtt, match_topic, CoalescingPublisher
+from ingest_filter import IngestFilter, SOURCE_RADIO, SOURCE_MQTT, DEBOUNCE_SEC, MATCH_WINDOW_SEC, payload_message_id, radio_message_id
 from adafruit_io import adafruit_io_interface
+from history import export_year
+from forecast import ArrivalForecast, load_prior_years
+from event_store import local_time_ns
+from metrics import REGISTRY, PROFILER, MetricsServer
+from scheduler import Scheduler
 
 REPORT_TIME_SEC = 60
-MQTT_SUBSCRIBE = "Halloween\ButtonPress"
-MQTT_PUBLISH_COUNT = "Halloween\TotalCount"
+MQTT_SUBSCRIBE = r"Halloween\ButtonPress"
+MQTT_PUBLISH_COUNT = r"Halloween\TotalCount"
+MQTT_SITE_SUBSCRIBE = "Halloween/+/ButtonPress"
+MQTT_SITE_DOWN_SUBSCRIBE = "Halloween/+/DownPress"
+MQTT_SITE_PUBLISH_COUNT = "Halloween/{site}/TotalCount"
+MQTT_PUBLISH_STATS = "Halloween/Stats"
+ROLLING_MINUTES = [5, 15, 60]
+BUSIEST_WINDOW_COUNT = 3
+
+EVENT_COUNT = "count"
+EVENT_DOWN = "down"
+EVENT_MARK = "mark"
+
+SOURCE_LOCAL = "local"
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'off']
+
+EVENTS_RECEIVED = REGISTRY.counter('trick_events_total', "Events received by source and event", ['source', 'event'])
+DISPATCH_SECONDS = REGISTRY.histogram('trick_dispatch_seconds', "Time to count an event and publish the count", ['source'])
+SITES_REFUSED = REGISTRY.counter('trick_site_refused_total', "Events for a site that is not allowed or past the site limit", ['source'])
+# the refused site names that are logged, the rest are only counted
+REFUSED_LOG_LIMIT = 100
+STARTUP_SECONDS = REGISTRY.gauge('trick_startup_seconds', "Time from creating the tracker until the radio was taking presses")
+
+# MQTT subscriptions and the event they raise, a '+' in the topic is the site name
+MQTT_ROUTES = [(MQTT_SUBSCRIBE, EVENT_COUNT),
+               (MQTT_SITE_SUBSCRIBE, EVENT_COUNT),
+               (MQTT_SITE_DOWN_SUBSCRIBE, EVENT_DOWN)]
+
+# Radio button index and the event it raises, the index matches the button ID - 1
+RADIO_BUTTON_EVENTS = [EVENT_COUNT, None, EVENT_DOWN]
 
 class TrickOrTreaterTracker:
-    def __init__(self, mqtt_config, aio_config, serial_port):
-        """Init Class and create MQTT interface and Monitoring Thread"""
-        self.tc = trick_count()
-        subscribe_list = [MQTT_SUBSCRIBE]
-        self.mqtt_interface = mqtt(mqtt_config, self.__msg_callback, subscribe_list)
-
-        self.monitor = True
-        self.report_schedule = schedule.every().minute.at(":00").do(self.__report_status)
-        self.daemon = Thread(target=self.__schedule_thread, args=(), daemon=True, name='TrickStatus')
-
-        self.feedlist = ['totalcount', 'count']
-        self.aio = adafruit_io_interface(aio_config, self.feedlist)
-
-        self.serial_port = serial_port
-        self.serial_radio = RadioInterface()
-        button_callback = [self.__count_btn_callback, None, self.__down_btn_callback]
-        self.serial_radio.start(self.serial_port, button_callbacks = button_callback)
+    def __init__(self, mqtt_config, aio_config, serial_ports, radio_site = DEFAULT_SITE, log_dir = None, use_asyncio = False,
+                 show_graphs = True, image_format = None, binary_frames = False, debounce_sec = DEBOUNCE_SEC,
+                 metrics_port = None, report_interval = REPORT_TIME_SEC, history_dir = '.',
+                 live_prefix = None, retention = (None, None), site_list = None, match_sec = MATCH_WINDOW_SEC):
+        """Init Class and create MQTT interface and the report scheduler
+           serial_ports - serial port of the radio receiver, or a list of them. "COM11=back" counts that radio into the back site
+           radio_site - name of the counter the serial radio buttons count into, unless the port names a site
+           log_dir - directory for the event logs, the counts in it are resumed. None disables the logs
+           use_asyncio - drive the serial port, MQTT, reports and console from one asyncio event loop instead of threads
+           show_graphs - open the graphs in a window at the end
+           image_format - 'png' or 'svg' to save the graphs as images at the end, None to not save them
+           binary_frames - the radio receiver was built with BINARY_FRAMES and sends binary frames, not text
+           debounce_sec - a radio press within this time of the last one is dropped, 0 to count every press
+           metrics_port - serve the metrics on this local port, None to not serve them
+           report_interval - seconds between status reports, they line up with the wall clock and can be under a second
+           history_dir - directory of the prior years' history and raw CSV files, the forecast is based on them
+           live_prefix - publish each site's count in shared memory named <live_prefix>_<site> for local readers, None to not
+           retention - (raw horizon, minute horizon) in seconds, presses older than the raw horizon are kept as minute counts
+                       and those older than the minute horizon as 15 minute counts, None keeps them. For long sessions
+           site_list - the only sites MQTT can count into besides the radio sites, None allows any site name
+           match_sec - a press on the radio and one on MQTT for the same site within this time are one press, 0 counts both
+           The MQTT and Adafruit IO interfaces come up on their own threads while the radio is started, presses are
+           counted as soon as the radio is open and published once the connections are up"""
+        start = time.perf_counter()
+        self.use_asyncio = use_asyncio
+        self.history_dir = history_dir
+        self.show_graphs = show_graphs
+        self.image_format = image_format
+        self.radio_ports = parse_radio_ports(serial_ports, radio_site)
+        sites = [radio_site] + [site for _, site in self.radio_ports if site != radio_site]
+        self.counters = CounterGroup(list(dict.fromkeys(sites)), log_dir, live_prefix, retention, site_list)
+        self.refused_sites = set()
+        self.ingest_filter = IngestFilter({SOURCE_RADIO: debounce_sec}, match_window_sec=match_sec)
+        self.event_table = {EVENT_COUNT: self.__count_event,
+                            EVENT_DOWN: self.__down_event,
+                            EVENT_MARK: self.__mark_event}
+        subscribe_list = [topic for topic, _ in MQTT_ROUTES]
+        self.feedlist = ['totalcount', 'count', 'forecasttotal', 'forecastremaining', 'forecastnext15']
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix='TrickInit') as init_pool:
+            mqtt_start = init_pool.submit(mqtt, mqtt_config, self.__msg_callback, subscribe_list, start_loop = not use_asyncio)
+            aio_start = init_pool.submit(adafruit_io_interface, aio_config, self.feedlist)
+            prior_start = init_pool.submit(load_prior_years, history_dir, datetime.today().year)
+
+            self.report_interval = report_interval
+            self.scheduler = None
+            if not use_asyncio:
+                self.scheduler = Scheduler()
+                self.scheduler.every(report_interval, self.report_status, name='report')
+
+            # the press handlers publish the count, so the MQTT interface has to exist before the radio starts.
+            # With the threaded runtime it connects in the background and queues the publishes until it is up
+            self.mqtt_interface = mqtt_start.result()
+            # a burst of presses sends the first count straight away and then only the latest one each window
+            self.count_publisher = CoalescingPublisher(self.mqtt_interface.publish_state, self.mqtt_interface.flush_window)
+            # every radio is read by one thread, or polled from the event loop with asyncio
+            self.radios = RadioManager()
+            for port, site in self.radio_ports:
+                name = self.radios.add(port, binary = binary_frames)
+                self.radios.get_protocol(name).set_button_callback(
+                    [None if event is None else partial(self.__radio_event, name, site, event) for event in RADIO_BUTTON_EVENTS])
+            if not use_asyncio:
+                self.radios.start()
+            STARTUP_SECONDS.set(time.perf_counter() - start)
+            self.aio = aio_start.result()
+            self.forecast = ArrivalForecast(*prior_start.result())
+            self.forecast.catch_up(*self.counters.snapshot(), local_time_ns())
+        logging.info("Started in %.2f seconds", time.perf_counter() - start)
+
+        REGISTRY.gauge('trick_count', "Total count by site", ['site']).set_function(
+            lambda: {(site,): int(self.counters.get_counter(site).get_total_count()) for site in self.counters.site_names()})
+        REGISTRY.counter('mqtt_count_publish_total', "Count publishes by how they were sent", ['result']).set_function(
+            lambda: {(name,): value for name, value in self.count_publisher.get_stats().items() if name != 'pending'})
+        REGISTRY.counter('trick_events_suppressed_total', "Events dropped by the ingest filter", ['source', 'reason']).set_function(
+            lambda: {(source, reason): stats[reason] for source, stats in self.ingest_filter.get_stats().items()
+                     for reason in ('debounced', 'duplicates')})
+        self.metrics_server = None if metrics_port is None else MetricsServer(metrics_port).start()
         
     def start(self):
         """Start taking numbers, wait here till the user types "end" """
-        self.daemon.start()
-        self.__report_status()
-        self.__report_count_locally()
+        if self.use_asyncio:
+            import asyncio
+            from async_runtime import AsyncRuntime
+            if sys.platform == 'win32':
+                # paho's socket is watched with add_reader, which needs the selector event loop
+                asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+            asyncio.run(AsyncRuntime(self, self.report_interval).run())
+            return
 
-        print("Start Counting")
+        self.scheduler.start()
+        self.begin_counting()
         
         continue_thread = True
         while continue_thread:
-            input_str = input()
-            if input_str == "end":
-                continue_thread = False
-                self.__process_finish()
-                print("End Program")
+            continue_thread = self.handle_command(input())
             time.sleep(1)
+
+    def begin_counting(self):
+        """Send the first reports before any new presses come in"""
+        self.report_status()
+        self.__report_count_locally(DEFAULT_SITE)
+        print("Start Counting")
+
+    def handle_command(self, input_str):
+        """Process a line typed on the console, returns False once counting is finished"""
+        if input_str.strip() == "end":
+            self.__process_finish()
+            print("End Program")
+            return False
+        return True
+
+    def dispatch(self, site, event, source = None, message_id = None):
+        """Single entry point for every input, looks the event up in the dispatch table and applies it to the site's counter
+           source - input the event came from, events from a source go through the ingest filter. None skips the filter
+           message_id - ID of the message, the same press seen on two sources is only counted once.
+                        Without one, a press on another source just after this one is taken to be the same press"""
+        start = time.perf_counter()
+        handler = self.event_table.get(event)
+        if handler is None:
+            logging.warning("Unknown Event: %s", event)
+            return
+        EVENTS_RECEIVED.inc(source or SOURCE_LOCAL, event)
+        if not self.counters.accepts(site):
+            self.__refuse_site(site, source)
+            return
+        if source is not None and not self.ingest_filter.accept(source, site, event, message_id):
+            return
+        PROFILER.run(self.__apply_event, site, handler)
+        DISPATCH_SECONDS.observe(time.perf_counter() - start, source or SOURCE_LOCAL)
+
+    def __apply_event(self, site, handler):
+        """Apply the event to the site's counter and publish the new count"""
+        try:
+            counter = self.counters.get_counter(site)
+        except ValueError:
+            # another new site took the last place first
+            self.__refuse_site(site, None)
+            return
+        handler(counter)
+        self.__report_count_locally(site)
+
+    def __refuse_site(self, site, source):
+        """Drop an event for a site the group will not make, each name is logged once"""
+        SITES_REFUSED.inc(source or SOURCE_LOCAL)
+        if site not in self.refused_sites and len(self.refused_sites) < REFUSED_LOG_LIMIT:
+            self.refused_sites.add(site)
+            logging.warning("Events for site %r are dropped, it is not an allowed site or there are already %s sites",
+                            site, len(self.counters.site_names()))
     
-    def __msg_callback(self, msg_topic):
-        """Callback from the MQTT class when a new message is received"""
-        self.tc.increase()
-        self.__report_count_locally()
+    def __msg_callback(self, msg_topic, msg_payload = b""):
+        """Callback from the MQTT class when a new message is received, the topic is routed to a site and event.
+           A message ID can follow the value in the payload ("1 42"), a bridge that republishes a radio press
+           sends the radio ID ("1 radio:2:17") so the press is not counted twice"""
+        for topic_filter, event in MQTT_ROUTES:
+            captured = match_topic(topic_filter, msg_topic)
+            if captured is not None:
+                site = captured[0] if captured else DEFAULT_SITE
+                self.dispatch(site, event, SOURCE_MQTT, payload_message_id(msg_payload))
+                return
+
+    def __radio_event(self, radio_name, site, event):
+        """Callback from the radio buttons, with binary frames the remote's address and sequence number are the message ID.
+           Two receivers that hear the same packet pass the same ID, so the press is only counted once"""
+        sender, seq = self.radios.get_protocol(radio_name).packet
+        self.dispatch(site, event, SOURCE_RADIO, None if seq is None else radio_message_id(sender, seq))
     
-    def __count_btn_callback(self):
-        """Callback from the button interface when the count should be increased"""
-        self.tc.increase()
-        self.__report_count_locally()
+    def __count_event(self, counter):
+        """Event handler when the count should be increased"""
+        counter.increase()
         
-    def __down_btn_callback(self):
+    def __down_event(self, counter):
         """Incase of too many button presses, remove the last entry"""
-        self.tc.decrease()
-        self.__report_count_locally()
+        counter.decrease()
+
+    def __mark_event(self, counter):
+        """Insert a zero entry into the counter"""
+        counter.mark()
 
     def __process_finish(self):
         """Complete the counting process and show the graph"""
-        self.monitor = False
-        total_count = self.tc.get_total_count()
+        if self.scheduler is not None:
+            # a report that is running finishes first, then the final report below is the last one
+            self.scheduler.stop()
+        total_count = self.counters.get_total_count()
+        for site in self.counters.site_names():
+            print(f"{site} Count: {self.counters.get_counter(site).get_total_count()}")
         print(f"Total Count: {total_count}")
+        print(f"Radio: {self.radios.get_stats()}")
+        for name, health in self.radios.get_health().items():
+            print(f"Radio {name}: {health}")
+        self.radios.exit()
+        print(f"Suppressed: {self.ingest_filter.get_suppressed_count()} {self.ingest_filter.get_stats()}")
+        self.count_publisher.flush()
+        print(f"Count Publishes: {self.count_publisher.get_stats()}")
+        self.report_status()
+        self.aio.exit()
+        self.counters.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         if total_count > 0:
-            self.tc.plot_output()
-
-    def __schedule_thread(self):
-        """Thread to report the latest count every minuit, thread runs the scheduler to do the event on the min"""
-        while self.monitor:
-            sleep_time = schedule.idle_seconds()
-            if sleep_time is None:
-                # no more jobs
-                break
-            elif sleep_time > 0:
-                # sleep exactly the right amount of time
-                time.sleep(sleep_time) # close enough?
-            schedule.run_pending()
-        schedule.cancel_job(self.report_schedule)
-
-    def __report_status(self):
+            combined = self.counters.combined_count()
+            try:
+                print(f"History saved to {export_year(*combined.snapshot(), output_dir = self.history_dir)}")
+            except ImportError as err:
+                print(err)
+            combined.plot_output(show = self.show_graphs, image_format = self.image_format)
+
+    def report_status(self):
         """Report the latest count every minuit"""
-        min_count = self.tc.get_last_minute_count()
-        total_count = self.tc.get_total_count() 
-        self.aio.send_status(self.feedlist[0], int(total_count))
-        self.aio.send_status(self.feedlist[1], int(min_count))
-        print(f"Report Time Now: {datetime.now()} Last Min Count: {min_count}, Total: {total_count}")
+        PROFILER.run(self.__send_report)
+
+    def __send_report(self):
+        """Send the last minute and total counts, and the forecast, to Adafruit IO"""
+        min_count = self.counters.get_last_minute_count()
+        total_count = self.counters.get_total_count() 
+        forecast = self.__update_forecast(total_count)
+        self.aio.send_status_group({self.feedlist[0]: int(total_count),
+                                    self.feedlist[1]: int(min_count),
+                                    self.feedlist[2]: forecast['expected_total'],
+                                    self.feedlist[3]: forecast['remaining'],
+                                    self.feedlist[4]: forecast['next']})
+        logging.info("Report Last Min Count: %s, Total: %s, Expected Total: %s", min_count, total_count, forecast['expected_total'])
+        self.mqtt_interface.publish_state(MQTT_PUBLISH_STATS, json.dumps(self.get_live_stats(forecast)))
+
+    def __update_forecast(self, total_count):
+        """Add the minutes closed since the last report to the forecast and forecast the rest of the night"""
+        now = local_time_ns()
+        self.forecast.advance(now, self.counters.get_count_between)
+        return self.forecast.forecast(int(total_count), now)
+
+    def get_live_stats(self, forecast = None):
+        """Rolling rates, the last hour's count and the busiest 15 minute blocks so far, all read from the count index,
+           and the forecast if one is given"""
+        stats = {f"rate{minutes}": round(self.counters.get_rolling_rate(minutes), 2) for minutes in ROLLING_MINUTES}
+        stats['last_hour'] = int(self.counters.get_rolling_count(60))
+        stats['busiest'] = [{'start': start.strftime('%I:%M %p'), 'count': int(count)}
+                            for start, count in self.counters.get_busiest_windows(BUSIEST_WINDOW_COUNT)]
+        if forecast is not None:
+            stats['forecast'] = forecast
+        return stats
         
-    def __report_count_locally(self):
-        """Publish the count to the MQTT topic, This is only used in the internal MQTT server"""
-        total_count = self.tc.get_total_count() 
-        self.mqtt_interface.publish( MQTT_PUBLISH_COUNT, int(total_count) )
+    def __report_count_locally(self, site):
+        """Publish the count to the MQTT topic, This is only used in the internal MQTT server
+           the combined total goes to the original topic, and each named site also gets its own topic"""
+        total_count = self.counters.get_total_count() 
+        self.count_publisher.publish( MQTT_PUBLISH_COUNT, int(total_count) )
+        if site != DEFAULT_SITE:
+            site_count = self.counters.get_counter(site).get_total_count()
+            self.count_publisher.publish( MQTT_SITE_PUBLISH_COUNT.format(site=site), int(site_count) )
+
+def parse_radio_ports(serial_ports, default_site = DEFAULT_SITE):
+    """List of (port, site) from a port or list of ports, a port written as "COM11=back" counts into the back site"""
+    if isinstance(serial_ports, str):
+        serial_ports = [serial_ports]
+    radio_ports = list()
+    for port in serial_ports:
+        port, _, site = port.partition('=')
+        radio_ports.append((port, site or default_site))
+    return radio_ports
 
 def is_file(value):
     """Called from argparse to ensure the file exists"""
@@ -124,9 +335,29 @@ if __name__ == '__main__':
                                      description='Timestamp Button Presses, counting Trick-Or-Treaters and publish results')
     parser.add_argument('-fm', required=False, type = is_file, default="mqtt_keys.json", help="Json Config File for local MQTT broker")
     parser.add_argument('-fa', required=False, type = is_file, default="adafruit_info.json", help="Json Config File for Adafrut Io Interface")
-    parser.add_argument('-p', required=False, default="COM10", help="Serial port, the radio interface is connected to")
+    parser.add_argument('-p', required=False, nargs='+', default=["COM10"], help="Serial ports the radio receivers are connected to, PORT=site counts a receiver into its own site")
+    parser.add_argument('-s', required=False, default=DEFAULT_SITE, help="Site name the radio buttons count into")
+    parser.add_argument('-a', required=False, action='store_true', help="Run on a single asyncio event loop instead of a thread per interface")
+    parser.add_argument('-i', required=False, choices=['png', 'svg'], default=None, help="Save the graphs as images in this format")
+    parser.add_argument('-n', required=False, action='store_true', help="Do not open a window for the graphs")
+    parser.add_argument('-l', required=False, default=f"{datetime.today().year}_TrickOrTreatLog", help="Directory for the event logs, a restart resumes the count saved there")
+    parser.add_argument('-b', required=False, action='store_true', help="The radio receiver sends binary frames (BINARY_FRAMES in RadioReceiver.ino)")
+    parser.add_argument('-d', required=False, type=float, default=DEBOUNCE_SEC, help="Drop a radio press within this many seconds of the last one, 0 to count every press")
+    parser.add_argument('-w', required=False, type=float, default=MATCH_WINDOW_SEC, help="A radio and an MQTT press for the same site within this many seconds are one press, 0 counts both")
+    parser.add_argument('-m', required=False, type=int, default=None, help="Serve the metrics on http://127.0.0.1:<port>/metrics")
+    parser.add_argument('-v', required=False, choices=LOG_LEVELS, default='info', help="Log level, debug shows every press, off turns logging off")
+    parser.add_argument('-r', required=False, type=float, default=REPORT_TIME_SEC, help="Seconds between status reports, can be under a second")
+    parser.add_argument('-k', required=False, nargs=2, type=float, default=None, metavar=('RAW_HOURS', 'MINUTE_DAYS'),
+                        help="Keep every press for RAW_HOURS and the minute counts for MINUTE_DAYS, older ones are kept as 15 minute counts")
+    parser.add_argument('-ss', required=False, nargs='+', default=None, help="Only these sites are counted from MQTT, otherwise any site name is")
+    parser.add_argument('-sh', required=False, default=None, help="Share each site's live count with local processes in shared memory named <prefix>_<site>")
     args = parser.parse_args()
 
+    if args.v == 'off':
+        logging.disable(logging.CRITICAL)
+    else:
+        logging.basicConfig(level=args.v.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
     aio_config = None
     mqtt_config = None
 
@@ -136,6 +367,9 @@ if __name__ == '__main__':
     with open(args.fa) as config_file:
         aio_config = json.load(config_file)
 
+    retention = (None, None) if args.k is None else (args.k[0] * 3600, args.k[1] * 86400)
+
     if mqtt_config is not None:    
-        TrickOrTreaterTracker(mqtt_config, aio_config, args.p).start()
+        TrickOrTreaterTracker(mqtt_config, aio_config, args.p, args.s, args.l, args.a, not args.n, args.i, args.b, args.d, args.m, args.r,
+                              live_prefix = args.sh, retention = retention, site_list = args.ss, match_sec = args.w).start()
         
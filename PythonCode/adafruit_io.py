@@ -1,34 +1,226 @@
 # -----------------------------------------------------------
-# Wrapper class for the Adafruit IO interface, based on the 
+# Wrapper class for the Adafruit IO interface, based on the
 #  Adafruit digital_in example. Class only sends digital data
 #   and does not receive data.
+#  Data is sent by a background publisher, so sending never
+#   blocks the caller and many feeds share one request
+#  The feed keys are looked up in the background and kept in a
+#   cache file, so a restart does not wait on the REST service
 #
-# (C) 2023 Daniel VanVolkinburg 
+# (C) 2023 Daniel VanVolkinburg
 # Released under GNU Public License (GPL)
 # email dvanvolk@ieee.org
 # -----------------------------------------------------------
 
 # import Adafruit IO REST client.
-from Adafruit_IO import Client, Feed, RequestError
+from Adafruit_IO import Client, Feed, RequestError, ThrottlingError
+from aio_publisher import BatchPublisher, RATE_LIMIT_PER_MIN, FIRST_RETRY_DELAY, RETRY_RATE, MAX_RETRY_DELAY
+from metrics import REGISTRY
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+import json
+import logging
+import os
+import time
+import requests
+
+DEFAULT_BASE_URL = 'https://io.adafruit.com'
+DEFAULT_GROUP = 'default'
+FEED_CACHE_FILE = 'aio_feed_cache.json'
+FEED_WAIT_SEC = 10
+API_URL = "{base_url}/api/v2/{username}/{path}"
+NOT_FOUND_STATUS = 404
+THROTTLED_STATUS = 429
+REQUEST_TIMEOUT_SEC = 30
+
+AIO_REQUEST_SECONDS = REGISTRY.histogram('aio_request_seconds', "Adafruit IO request time by result", ['result'])
+
+class ResponseError(RequestError):
+    """RequestError that keeps the HTTP status code of the failed request"""
+    def __init__(self, response):
+        super().__init__(response)
+        self.status_code = response.status_code
+
+def post_data(client, path, data):
+    """POST data to a REST path under the user, with the client's server, user name and key.
+       Raises ThrottlingError like the Client does and ResponseError for the other failed requests"""
+    response = requests.post(API_URL.format(base_url=client.base_url, username=client.username, path=path),
+                             headers={'X-AIO-Key': client.key, 'Content-Type': 'application/json'},
+                             proxies=client.proxies, data=json.dumps(data), timeout=REQUEST_TIMEOUT_SEC)
+    if response.status_code == THROTTLED_STATUS:
+        raise ThrottlingError()
+    if response.status_code >= 400:
+        raise ResponseError(response)
+    return response.json()
+
+def post_group_data(client, group, feeds):
+    """Send several feed values in one request to the REST group data endpoint, the Client has no public
+       method for it. feeds - list of {'key': feed key, 'value': data}"""
+    return post_data(client, f"groups/{group}/data", {'feeds': feeds})
 
 class adafruit_io_interface:
-    def __init__(self, config, feed_list):
-        """Connect the Adafruit IO interface
-        config - dictionary containing username and api_key 
-        feed_list - list of feeds to connect to"""
-        self.aio = Client(config.get('username'), config.get('api_key'))
-        self.feed_list = []
-
-        for feed_name in feed_list:
-            try: # if we have a 'digital' feed
-                aio_feed = self.aio.feeds(feed_name)
-            except RequestError: # create a digital feed
-                feed = Feed(name=feed_name)
-                aio_feed = self.aio.create_feed(feed)
-            self.feed_list.append(aio_feed)
-            
+    def __init__(self, config, feed_list, cache_file = FEED_CACHE_FILE):
+        """Connect the Adafruit IO interface, the feeds are looked up in the background so this does not wait
+        config - dictionary containing username and api_key, and optionally
+                 base_url (service address), group (group the feeds are in) and rate_limit (data points per minute)
+        feed_list - list of feeds to connect to
+        cache_file - JSON file the feed keys are saved in so the next start skips looking them up, None to not cache them"""
+        base_url = config.get('base_url', DEFAULT_BASE_URL)
+        self.aio = Client(config.get('username'), config.get('api_key'), base_url=base_url)
+        self.group = config.get('group', DEFAULT_GROUP)
+        self.feed_names = list(feed_list)
+        self.cache_file = cache_file
+        # the same file can hold the keys of more than one account or server
+        self.cache_name = f"{config.get('username')}@{base_url}"
+        self.lock = Lock()
+        self.feeds = self.__load_cache()
+        self.feeds_ready = Event()
+        self.stopping = Event()
+        self.resolver = None
+
+        self.publisher = BatchPublisher(self.__send_group,
+                                        rate_per_min=config.get('rate_limit', RATE_LIMIT_PER_MIN),
+                                        throttle_error=ThrottlingError,
+                                        send_timeout=FEED_WAIT_SEC + REQUEST_TIMEOUT_SEC)
+        self.publisher.start()
+        self.__start_resolver()
+        REGISTRY.counter('aio_publisher_total', "Adafruit IO publisher counts", ['stat']).set_function(
+            lambda: {(name,): value for name, value in self.get_stats().items() if name not in ('queue_depth', 'pending')})
+        REGISTRY.gauge('aio_queue_depth', "Adafruit IO values waiting to be sent", ['queue']).set_function(
+            lambda: {(name,): value for name, value in self.get_stats().items() if name in ('queue_depth', 'pending')})
+
+    @property
+    def feed_list(self):
+        """List of the keys of the feeds found so far"""
+        with self.lock:
+            return list(self.feeds.values())
+
+    def wait_for_feeds(self, timeout = None):
+        """Wait for every feed key to be known, returns False on a timeout"""
+        return self.feeds_ready.wait(timeout)
+
     def send_status(self, feed_name, data):
-        """Send feed data"""
-        for items in self.feed_list:
-            if items.key == feed_name:
-                self.aio.send_data(items.key, data)
+        """Queue feed data to be sent by the background publisher"""
+        self.send_status_group({feed_name: data})
+
+    def send_status_group(self, feed_data):
+        """Queue a dictionary of {feed name: data}, the values are sent together in one request.
+           The names are turned into feed keys on the publisher thread, so this works before the keys are known"""
+        values = {feed_name: data for feed_name, data in feed_data.items() if feed_name in self.feed_names}
+        if values:
+            self.publisher.publish_group(values)
+
+    def get_stats(self):
+        """Return the publisher statistics"""
+        return self.publisher.get_stats()
+
+    def exit(self):
+        """Send anything still waiting and stop the publisher"""
+        self.publisher.stop()
+        self.stopping.set()
+
+    def __start_resolver(self):
+        """Look up the feeds that are not in the cache on a background thread"""
+        with self.lock:
+            missing = [feed_name for feed_name in self.feed_names if feed_name not in self.feeds]
+        if not missing:
+            self.feeds_ready.set()
+            return
+        self.feeds_ready.clear()
+        self.resolver = Thread(target=self.__resolve_feeds, args=(missing,), daemon=True, name='AioFeeds')
+        self.resolver.start()
+
+    def __resolve_feeds(self, missing):
+        """Look the feeds up at the same time, retrying with a back off until they are all found"""
+        retry_delay = FIRST_RETRY_DELAY
+        while missing and not self.stopping.is_set():
+            with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='AioFeed') as pool:
+                lookups = [(feed_name, pool.submit(self.__lookup_feed, feed_name)) for feed_name in missing]
+            found = dict()
+            for feed_name, lookup in lookups:
+                try:
+                    found[feed_name] = lookup.result()
+                except Exception as err:
+                    logging.warning("Adafruit IO feed %s lookup failed: %s", feed_name, err)
+            with self.lock:
+                self.feeds.update(found)
+            missing = [feed_name for feed_name in missing if feed_name not in found]
+            if missing:
+                self.stopping.wait(retry_delay)
+                retry_delay = min(retry_delay * RETRY_RATE, MAX_RETRY_DELAY)
+        if not missing:
+            self.__save_cache()
+            self.feeds_ready.set()
+            logging.info("Adafruit IO feeds found: %s", self.feed_list)
+
+    def __lookup_feed(self, feed_name):
+        """Return the key of the feed, it is created if it does not exist"""
+        try: # if we have a 'digital' feed
+            aio_feed = self.aio.feeds(feed_name)
+        except RequestError: # create a digital feed
+            aio_feed = self.aio.create_feed(Feed(name=feed_name))
+        return aio_feed.key
+
+    def __load_cache(self):
+        """Feed keys saved by the last run, {feed name: key}"""
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return dict()
+        try:
+            with open(self.cache_file) as cache:
+                return dict(json.load(cache).get(self.cache_name, dict()))
+        except (OSError, ValueError, AttributeError) as err:
+            logging.warning("Adafruit IO feed cache %s not read: %s", self.cache_file, err)
+            return dict()
+
+    def __save_cache(self):
+        """Save the feed keys, the file is replaced in one step so a crash never leaves half of it"""
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file) as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            cached = dict()
+        with self.lock:
+            cached[self.cache_name] = dict(self.feeds)
+        try:
+            with open(self.cache_file + '.tmp', 'w') as cache:
+                json.dump(cached, cache, indent=2)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as err:
+            logging.warning("Adafruit IO feed cache %s not saved: %s", self.cache_file, err)
+
+    def __forget_feeds(self, feed_names):
+        """A cached key was not found by the service, look the feeds up again"""
+        with self.lock:
+            for feed_name in feed_names:
+                self.feeds.pop(feed_name, None)
+        if self.resolver is None or not self.resolver.is_alive():
+            self.__start_resolver()
+
+    def __send_group(self, values):
+        """Send the values with the group data endpoint, one request for every feed.
+           Runs on the publisher thread, which waits here for the feed keys on the first send"""
+        if not self.feeds_ready.wait(FEED_WAIT_SEC):
+            raise ConnectionError("Adafruit IO feeds have not been found yet")
+        with self.lock:
+            values = {self.feeds[feed_name]: data for feed_name, data in values.items()}
+        start = time.perf_counter()
+        result = 'failed'
+        try:
+            if len(values) == 1:
+                (feed_key, data), = values.items()
+                post_data(self.aio, f"feeds/{feed_key}/data", {'value': data})
+            else:
+                feeds = [{'key': feed_key, 'value': data} for feed_key, data in values.items()]
+                post_group_data(self.aio, self.group, feeds)
+            result = 'ok'
+        except ResponseError as err:
+            if err.status_code != NOT_FOUND_STATUS:
+                raise
+            with self.lock:
+                feed_names = [feed_name for feed_name, feed_key in self.feeds.items() if feed_key in values]
+            self.__forget_feeds(feed_names)
+            raise
+        finally:
+            AIO_REQUEST_SECONDS.observe(time.perf_counter() - start, result)
@@ -0,0 +1,130 @@
+# -----------------------------------------------------------
+# Small local stand-in for the Adafruit IO REST service, so the
+#  publisher can be tested offline. It understands the feed lookup,
+#  feed create, feed data and group data requests, records every
+#  value it is sent and can be told to throttle or fail requests.
+#  Point the interface at it with "base_url" in adafruit_info.json
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+import json
+import re
+
+HOST = "127.0.0.1"
+
+class LocalAdafruitIO:
+    def __init__(self, port=0):
+        """Create the server, port 0 picks a free port, the chosen one is in self.port"""
+        self.lock = Lock()
+        self.feeds = dict()
+        self.received = list()
+        self.request_count = 0
+        self.throttle_count = 0
+        self.fail_count = 0
+        self.server = ThreadingHTTPServer((HOST, port), self.__make_handler())
+        self.port = self.server.server_address[1]
+        self.base_url = f"http://{HOST}:{self.port}"
+        self.thread = None
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self.thread = Thread(target=self.server.serve_forever, args=(), daemon=True, name='LocalAdafruitIO')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def throttle_next(self, count=1):
+        """Answer the next requests with 429 Too Many Requests"""
+        with self.lock:
+            self.throttle_count += count
+
+    def fail_next(self, count=1):
+        """Answer the next requests with 500 Server Error"""
+        with self.lock:
+            self.fail_count += count
+
+    def latest(self, feed_key):
+        """Return the last value received for a feed, None if nothing has been received"""
+        with self.lock:
+            for key, value in reversed(self.received):
+                if key == feed_key:
+                    return value
+        return None
+
+    def __add_feed(self, name):
+        key = re.sub(r'[^a-z0-9-]', '-', name.lower())
+        feed = {'name': name, 'key': key, 'id': len(self.feeds) + 1}
+        self.feeds[key] = feed
+        return feed
+
+    def handle(self, method, path, body):
+        """Process one request, returns (status, response object)"""
+        with self.lock:
+            self.request_count += 1
+            if self.throttle_count:
+                self.throttle_count -= 1
+                return 429, {'error': 'throttled'}
+            if self.fail_count:
+                self.fail_count -= 1
+                return 500, {'error': 'server error'}
+
+            parts = [part for part in path.split('?')[0].split('/') if part]
+            # every path looks like /api/v2/{username}/...
+            parts = parts[3:]
+            if method == 'GET' and len(parts) == 2 and parts[0] == 'feeds':
+                feed = self.feeds.get(parts[1])
+                if feed is None:
+                    return 404, {'error': 'not found'}
+                return 200, feed
+            if method == 'POST' and parts == ['feeds']:
+                return 200, self.__add_feed(body['feed']['name'])
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'feeds' and parts[2] == 'data':
+                self.received.append((parts[1], body['value']))
+                return 200, {'feed_key': parts[1], 'value': body['value']}
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'data':
+                created = list()
+                for item in body['feeds']:
+                    self.received.append((item['key'], item['value']))
+                    created.append({'feed_key': item['key'], 'value': item['value']})
+                return 200, created
+            return 404, {'error': 'not found'}
+
+    def __make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.__respond(*server.handle('GET', self.path, None))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                self.__respond(*server.handle('POST', self.path, body))
+
+            def __respond(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+if __name__ == '__main__':
+    """Run the stand-in server until Enter is pressed"""
+    local_server = LocalAdafruitIO(8080).start()
+    print(f"Local Adafruit IO running at {local_server.base_url}")
+    input("Press Enter to end...")
+    local_server.stop()
@@ -0,0 +1,188 @@
+# -----------------------------------------------------------
+# Background publisher for the Adafruit IO feeds. Values are
+#  put on a bounded queue, coalesced so only the latest value of
+#  each feed is kept, and sent together in one request by a
+#  worker thread that respects the Adafruit IO rate limit
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Thread, Lock
+import logging
+import queue
+import time
+
+QUEUE_SIZE = 256
+BATCH_WINDOW_SEC = 0.25
+RATE_LIMIT_PER_MIN = 30
+FIRST_RETRY_DELAY = 1
+RETRY_RATE = 2
+MAX_RETRY_COUNT = 5
+MAX_RETRY_DELAY = 60
+THROTTLE_DELAY = 60
+SEND_TIMEOUT_SEC = 30
+
+class TokenBucket:
+    """Token bucket rate limiter, tokens refill at rate_per_sec up to capacity"""
+    def __init__(self, rate_per_sec, capacity):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, tokens=1):
+        """Return how many seconds until the tokens are available, zero if they are available now"""
+        self.__refill()
+        tokens = min(tokens, self.capacity)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        """Remove tokens from the bucket, returns False if there are not enough"""
+        self.__refill()
+        tokens = min(tokens, self.capacity)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+class BatchPublisher:
+    def __init__(self, send_function, queue_size=QUEUE_SIZE, rate_per_min=RATE_LIMIT_PER_MIN,
+                 batch_window=BATCH_WINDOW_SEC, throttle_error=None, send_timeout=SEND_TIMEOUT_SEC):
+        """Create the publisher, the worker thread is started with start()
+           send_function - called with a dictionary of {feed key: value}, sends them all in one request
+           queue_size - max number of updates waiting for the worker, updates are dropped when full
+           rate_per_min - Adafruit IO data points allowed per minute, each feed in a batch is one data point
+           batch_window - time to wait after the first update for more to arrive before sending
+           throttle_error - exception type raised by send_function when the service is throttling
+           send_timeout - longest a send_function call takes, stop() waits this long for the last batch"""
+        self.send_function = send_function
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.bucket = TokenBucket(rate_per_min / 60, rate_per_min)
+        self.batch_window = batch_window
+        self.throttle_error = throttle_error
+        self.pending = dict()
+        self.send_timeout = send_timeout
+        self.worker = None
+        self.stats_lock = Lock()
+        self.stats = {'queued': 0, 'dropped': 0, 'coalesced': 0, 'requests': 0,
+                      'sent_values': 0, 'retries': 0, 'failed': 0}
+
+    def start(self):
+        """Start the worker thread"""
+        self.worker = Thread(target=self.__worker_thread, args=(), daemon=True, name='AioPublisher')
+        self.worker.start()
+
+    def stop(self):
+        """Stop the worker, anything already queued is sent first. Waits for the batch being sent and the last one"""
+        self.queue.put(None)
+        if self.worker is not None:
+            self.worker.join(2 * self.send_timeout + self.batch_window)
+            if self.worker.is_alive():
+                logging.warning("Adafruit IO publisher did not finish sending, %s values lost", len(self.pending))
+
+    def publish(self, feed_key, value):
+        """Queue a value for a feed, never blocks"""
+        return self.publish_group({feed_key: value})
+
+    def publish_group(self, values):
+        """Queue a dictionary of {feed key: value} to be sent together, never blocks
+           Returns False if the queue is full and the values were dropped"""
+        try:
+            self.queue.put_nowait(dict(values))
+        except queue.Full:
+            self.__count('dropped', len(values))
+            logging.warning("Adafruit IO publish queue full, dropped %s", list(values))
+            return False
+        self.__count('queued', len(values))
+        return True
+
+    def get_stats(self):
+        """Return a copy of the publisher statistics"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue.qsize()
+        stats['pending'] = len(self.pending)
+        return stats
+
+    def __count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def __merge(self, values):
+        """Coalesce values into the pending batch, a newer value replaces the older one"""
+        for key, value in values.items():
+            if key in self.pending:
+                self.__count('coalesced')
+            self.pending[key] = value
+
+    def __collect(self, wait_sec):
+        """Move queued values into the pending batch for up to wait_sec, returns False when stop was requested"""
+        deadline = time.monotonic() + wait_sec
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self.queue.get(timeout=remaining)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                return True
+            if item is None:
+                return False
+            self.__merge(item)
+
+    def __worker_thread(self):
+        """Wait for values, then send the pending batch when the rate limit allows it"""
+        keep_running = True
+        while keep_running or self.pending:
+            if not self.pending:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.__merge(item)
+                keep_running = self.__collect(self.batch_window)
+
+            wait = self.bucket.wait_time(len(self.pending))
+            if wait > 0 and keep_running:
+                keep_running = self.__collect(wait)
+                continue
+            self.bucket.take(len(self.pending))
+            keep_running = self.__send_pending(keep_running)
+
+    def __send_pending(self, keep_running):
+        """Send the pending batch, retrying with backoff. Values that arrive while waiting are merged in.
+           Returns False once stop has been requested"""
+        retry_count, retry_delay = 0, FIRST_RETRY_DELAY
+        while True:
+            batch = self.pending
+            self.pending = dict()
+            try:
+                self.__count('requests')
+                self.send_function(batch)
+                self.__count('sent_values', len(batch))
+                return keep_running
+            except Exception as err:
+                # Keep the failed values, newer values that arrive during the backoff replace them
+                self.pending = batch
+                retry_count += 1
+                if retry_count > MAX_RETRY_COUNT or not keep_running:
+                    logging.error("Adafruit IO send failed after %s attempts: %s", retry_count, err)
+                    self.__count('failed', len(self.pending))
+                    self.pending = dict()
+                    return keep_running
+                delay = retry_delay
+                if self.throttle_error is not None and isinstance(err, self.throttle_error):
+                    delay = max(delay, THROTTLE_DELAY)
+                logging.warning("%s. Adafruit IO send failed, retrying in %s seconds...", err, delay)
+                self.__count('retries')
+                if not self.__collect(delay):
+                    keep_running = False
+                retry_delay = min(retry_delay * RETRY_RATE, MAX_RETRY_DELAY)
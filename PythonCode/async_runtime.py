@@ -0,0 +1,160 @@
+# -----------------------------------------------------------
+# Optional asyncio runtime for the TrickOrTreaterTracker. The
+#  serial port, the MQTT network traffic, the minute report and
+#  the console are all driven from one event loop, so every change
+#  to the counters happens on the loop's thread, one at a time
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Thread, get_ident
+from paho.mqtt import client as mqtt_client
+import asyncio
+import logging
+import sys
+import time
+
+from mqtt_interface import FIRST_RECONNECT_DELAY, RECONNECT_RATE, MAX_RECONNECT_DELAY, MQTT_RECONNECTS
+from scheduler import WallClockTicks, SCHEDULER_DRIFT, SCHEDULER_TICKS
+from event_store import NS_PER_SEC
+
+SERIAL_POLL_SEC = 0.01
+MQTT_MISC_SEC = 1
+
+class AsyncMqttDriver:
+    """Runs a paho client's network traffic from the event loop in place of loop_start()'s thread,
+       the socket is watched with add_reader/add_writer and loop_misc() keeps the connection alive.
+       Connecting is a blocking TCP connect, so it runs on the loop's executor"""
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.loop_thread = get_ident()
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_register_write
+        client.on_socket_unregister_write = self.__on_socket_unregister_write
+
+        # the client connected before the callbacks were set, so hook up the open socket now
+        sock = client.socket()
+        if sock is not None:
+            self.__on_socket_open(client, None, sock)
+            if client.want_write():
+                self.__on_socket_register_write(client, None, sock)
+
+    def __on_socket_open(self, client, userdata, sock):
+        self.__call_in_loop(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.__call_in_loop(self.loop.remove_reader, sock.fileno())
+        self.__call_in_loop(self.loop.remove_writer, sock.fileno())
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self.__call_in_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self.__call_in_loop(self.loop.remove_writer, sock.fileno())
+
+    def __call_in_loop(self, function, *args):
+        """paho calls the socket callbacks on the thread that is connecting, the watchers are only changed on the
+           loop's thread. The file number is passed, the socket may be closed by the time the loop gets to it"""
+        if get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    async def run(self):
+        """Keep alive and connect task, the connects run on the executor and back off between tries,
+           so a broker that can not be reached never holds up the other tasks"""
+        reconnect_delay = FIRST_RECONNECT_DELAY
+        while True:
+            if self.client.loop_misc() == mqtt_client.MQTT_ERR_NO_CONN:
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    MQTT_RECONNECTS.inc('ok')
+                    logging.info("Reconnected successfully!")
+                    reconnect_delay = FIRST_RECONNECT_DELAY
+                except Exception as err:
+                    MQTT_RECONNECTS.inc('failed')
+                    logging.error("%s. Reconnect failed. Retrying in %d seconds...", err, reconnect_delay)
+                    await asyncio.sleep(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * RECONNECT_RATE, MAX_RECONNECT_DELAY)
+                    continue
+            await asyncio.sleep(MQTT_MISC_SEC)
+
+class AsyncRuntime:
+    def __init__(self, tracker, report_interval):
+        """tracker - TrickOrTreaterTracker created with use_asyncio=True
+           report_interval - seconds between status reports, reports line up with the wall clock"""
+        self.tracker = tracker
+        self.report_interval = report_interval
+        self.stop_event = None
+
+    async def run(self):
+        """Run every interface until "end" is typed on the console"""
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        mqtt_driver = AsyncMqttDriver(loop, self.tracker.mqtt_interface.client)
+        # held counts are sent from the loop too, paho is only used from this thread
+        self.tracker.count_publisher.set_timer_function(loop.call_later)
+
+        self.tracker.begin_counting()
+        tasks = [asyncio.create_task(mqtt_driver.run()),
+                 asyncio.create_task(self.__serial_task()),
+                 asyncio.create_task(self.__report_task()),
+                 asyncio.create_task(self.__console_task(loop))]
+        await self.stop_event.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tracker.mqtt_interface.client.disconnect()
+
+    async def __serial_task(self):
+        """Poll the radio ports, the protocol handlers call the button callbacks on this thread.
+           A port that fails is reopened by the radio manager while the others keep being read"""
+        radios = self.tracker.radios
+        while True:
+            if not radios.poll():
+                await asyncio.sleep(SERIAL_POLL_SEC)
+            else:
+                await asyncio.sleep(0)
+
+    async def __report_task(self):
+        """Report the status at each report interval boundary of the wall clock"""
+        ticks = WallClockTicks(self.report_interval)
+        while True:
+            await asyncio.sleep(ticks.seconds_until_next())
+            ticks.resync()
+            due, skipped = ticks.take_due(time.monotonic_ns())
+            if due:
+                # a report that ran long covers the ticks that passed meanwhile
+                SCHEDULER_TICKS.inc('report', 'coalesced', amount=len(due) - 1 + skipped)
+                SCHEDULER_DRIFT.observe((time.monotonic_ns() - due[-1]) / NS_PER_SEC, 'report')
+                SCHEDULER_TICKS.inc('report', 'ran')
+                self.tracker.report_status()
+
+    async def __console_task(self, loop):
+        """Read console lines and pass them to the tracker, stops the runtime on "end" """
+        lines = asyncio.Queue()
+        try:
+            loop.add_reader(sys.stdin.fileno(), lambda: lines.put_nowait(sys.stdin.readline()))
+        except (NotImplementedError, ValueError, OSError):
+            # Windows event loops can not watch the console, read it on a daemon thread that only hands lines over
+            def read_console():
+                for line in sys.stdin:
+                    loop.call_soon_threadsafe(lines.put_nowait, line)
+                loop.call_soon_threadsafe(lines.put_nowait, '')
+            Thread(target=read_console, args=(), daemon=True, name='Console').start()
+
+        while True:
+            line = await lines.get()
+            if line == '':
+                # end of input, keep counting until the process is stopped
+                try:
+                    loop.remove_reader(sys.stdin.fileno())
+                except (NotImplementedError, ValueError, OSError):
+                    pass
+                return
+            if not self.tracker.handle_command(line):
+                self.stop_event.set()
+                return
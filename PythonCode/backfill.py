@@ -0,0 +1,287 @@
+# -----------------------------------------------------------
+# Backfill of the presses missed while the tracker was down, from
+#  captures of the RadioReceiver serial output or of the broker's
+#  messages. A capture is read in large blocks and each block is
+#  parsed with one regular expression scan, the presses become
+#  count events the same way the tracker would have counted them
+#  and are merged into the sites' event logs in time order
+#      python backfill.py -r radio_capture.txt -t 2023-10-31
+#      python backfill.py -q mosquitto_dump.txt
+#  Every capture line needs a time stamp at the start, like
+#      2023-10-31 18:02:03.123 Button: 1        (serial logger)
+#      18:02:03.123 -> Button: 1                (Arduino serial monitor, needs -t)
+#      1698789723.123 Halloween/front/ButtonPress 1   (mosquitto_sub -v -F "%U %t %p")
+#  Stop the tracker first, it holds the event logs open
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from datetime import datetime
+import argparse
+import logging
+import os
+import re
+import time
+import numpy as np
+
+from counter_group import CounterGroup, DEFAULT_SITE, LOG_SUFFIX, SITE_NAME
+from event_log import replay_log
+from event_store import EventBuffer, NS_PER_SEC, ns_to_datetime
+from history import DAY_NS
+from ingest_filter import DEBOUNCE_SEC, DEDUPE_WINDOW_SEC, payload_message_id
+from mqtt_interface import match_topic
+from rollup import FIFTEEN_MIN_NS
+from TrickOrTreaters import RADIO_BUTTON_EVENTS, MQTT_ROUTES, EVENT_COUNT, EVENT_DOWN
+
+CHUNK_BYTES = 8 * 1024 * 1024
+# a time only capture that goes back more than this has gone past midnight
+ROLLOVER_NS = DAY_NS // 2
+# a press counts one, a down press takes one away at its time instead of removing the last event
+EVENT_DELTAS = {EVENT_COUNT: 1, EVENT_DOWN: -1}
+
+# date and time, time only, or seconds since 1970. A time zone after it is ignored, the counts are local time
+TIMESTAMP = (rb'(\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d+)?|\d\d:\d\d:\d\d(?:\.\d+)?|\d{9,10}(?:\.\d+)?)'
+             rb'(?:Z|[+-]\d\d:?\d\d)?')
+SEPARATOR = rb'[^\w\r\n]*'
+SERIAL_LINE = re.compile(rb'^' + SEPARATOR + TIMESTAMP + SEPARATOR + rb'(Button|Heart)[: \t]*(\d+)', re.M)
+MQTT_LINE = re.compile(rb'^' + SEPARATOR + TIMESTAMP + SEPARATOR + rb'(Halloween\S*)[ \t]*([^\r\n]*)', re.M)
+
+def read_blocks(path, block_size=CHUNK_BYTES):
+    """Read the file in blocks that end on a line ending, so a line is never split between two blocks"""
+    rest = b""
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield data[:end]
+    if rest:
+        yield rest
+
+def parse_timestamps(stamps, date=None):
+    """Local nanosecond time stamps of the captured time stamp text, converted a whole block at a time
+       date - 'YYYY-MM-DD' of the first time only stamp, a time that goes back past midnight is the next day"""
+    stamps = np.asarray(stamps, dtype=bytes)
+    timestamps = np.zeros(len(stamps), dtype=np.int64)
+    if len(stamps) == 0:
+        return timestamps
+    has_date = np.char.find(stamps, b'-') == 4
+    has_time = np.char.find(stamps, b':') >= 0
+    if has_date.any():
+        timestamps[has_date] = np.char.replace(stamps[has_date], b' ', b'T').astype('datetime64[ns]').view(np.int64)
+    time_only = has_time & ~has_date
+    if time_only.any():
+        if date is None:
+            raise ValueError("The capture only has the time of day, give the date it was captured on")
+        times = np.char.add(f"{date}T".encode(), stamps[time_only]).astype('datetime64[ns]').view(np.int64)
+        rolled = np.zeros(len(times), dtype=np.int64)
+        rolled[1:] = np.cumsum(np.diff(times) < -ROLLOVER_NS)
+        timestamps[time_only] = times + rolled * DAY_NS
+    epoch = ~has_time
+    if epoch.any():
+        seconds = stamps[epoch].astype(np.float64)
+        # the UTC offset can change in the night (daylight saving), it is looked up once per hour
+        hours, hour_index = np.unique((seconds // 3600).astype(np.int64), return_inverse=True)
+        offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in hours.tolist()], dtype=np.int64)
+        timestamps[epoch] = np.round(seconds * NS_PER_SEC).astype(np.int64) + offsets[hour_index] * NS_PER_SEC
+    return timestamps
+
+def keep_first(keys, timestamps, window_ns):
+    """Mask of the events to keep, an event within window_ns of the one before it with the same key is dropped"""
+    if len(keys) == 0 or window_ns <= 0:
+        return np.ones(len(keys), dtype=bool)
+    order = np.lexsort((timestamps, keys))
+    sorted_keys, sorted_times = keys[order], timestamps[order]
+    repeat = np.zeros(len(keys), dtype=bool)
+    repeat[1:] = (sorted_keys[1:] == sorted_keys[:-1]) & (sorted_times[1:] - sorted_times[:-1] < window_ns)
+    keep = np.ones(len(keys), dtype=bool)
+    keep[order[repeat]] = False
+    return keep
+
+def read_serial_capture(path, site=DEFAULT_SITE, date=None, debounce_sec=DEBOUNCE_SEC):
+    """Presses in a capture of the RadioReceiver's text output, read like RadioProtocolHandler.handle_line:
+       the button ID picks the event in RADIO_BUTTON_EVENTS and heartbeats are skipped.
+       Returns ({site: (timestamps, deltas)}, stats)"""
+    stats = {'lines': 0, 'buttons': 0, 'hearts': 0, 'unexpected': 0, 'debounced': 0}
+    stamp_blocks, delta_blocks = list(), list()
+    # button ID to delta, 0 for the IDs that do not count
+    id_deltas = np.zeros(len(RADIO_BUTTON_EVENTS) + 1, dtype=np.int32)
+    for index, event in enumerate(RADIO_BUTTON_EVENTS):
+        id_deltas[index + 1] = EVENT_DELTAS.get(event, 0)
+    for block in read_blocks(path):
+        lines = block.splitlines()
+        matches = SERIAL_LINE.findall(block)
+        stats['lines'] += len(lines)
+        blank = sum(1 for line in lines if not line.strip())
+        stats['unexpected'] += len(lines) - len(matches) - blank
+        if not matches:
+            continue
+        stamps, names, numbers = zip(*matches)
+        is_button = np.array(names) == b"Button"
+        stats['buttons'] += int(is_button.sum())
+        stats['hearts'] += int((~is_button).sum())
+        button_ids = np.array(numbers, dtype=np.int64)[is_button]
+        deltas = np.where(button_ids < len(id_deltas), id_deltas[np.minimum(button_ids, len(id_deltas) - 1)], 0)
+        counted = deltas != 0
+        stamp_blocks.append(np.array(stamps)[is_button][counted])
+        delta_blocks.append(deltas[counted].astype(np.int32))
+    # the time stamps are converted together, so a time only capture that runs past midnight rolls over once
+    timestamps = parse_timestamps(np.concatenate(stamp_blocks) if stamp_blocks else [], date)
+    deltas = np.concatenate(delta_blocks) if delta_blocks else np.zeros(0, dtype=np.int32)
+    # the radio text lines have no sequence number, so presses are debounced like the live radio presses
+    keep = keep_first(deltas, timestamps, int(debounce_sec * NS_PER_SEC))
+    stats['debounced'] = int(np.count_nonzero(~keep))
+    return {site: (timestamps[keep], deltas[keep])}, stats
+
+def read_mqtt_capture(path, date=None, debounce_sec=0, dedupe_window_sec=DEDUPE_WINDOW_SEC):
+    """Presses in a dump of the broker's messages, the topics are routed to a site and event like the tracker's
+       MQTT_ROUTES. A message ID in the payload is only counted once, presses without one are debounced
+       like the tracker does, which by default is not at all.
+       Returns ({site: (timestamps, deltas)}, stats)"""
+    stats = {'lines': 0, 'messages': 0, 'unexpected': 0, 'debounced': 0, 'duplicates': 0}
+    stamp_blocks, topic_blocks, payload_blocks = list(), list(), list()
+    for block in read_blocks(path):
+        matches = MQTT_LINE.findall(block)
+        stats['lines'] += block.count(b'\n') + (not block.endswith(b'\n'))
+        if matches:
+            stamps, topics, payloads = zip(*matches)
+            stamp_blocks.append(np.array(stamps))
+            topic_blocks.append(np.array(topics))
+            payload_blocks.append(np.array(payloads, dtype=object))
+    if not stamp_blocks:
+        return dict(), stats
+    timestamps = parse_timestamps(np.concatenate(stamp_blocks), date)
+    topics = np.concatenate(topic_blocks)
+    payloads = np.concatenate(payload_blocks)
+    stats['messages'] = len(timestamps)
+
+    # a night has a handful of topics, each one is routed once
+    unique_topics, topic_index = np.unique(topics, return_inverse=True)
+    routes = [route_topic(topic.decode('utf-8', 'replace')) for topic in unique_topics.tolist()]
+    sites = np.array([route[0] for route in routes], dtype=object)[topic_index]
+    deltas = np.array([EVENT_DELTAS.get(route[1], 0) for route in routes], dtype=np.int32)[topic_index]
+    routed = deltas != 0
+    stats['unexpected'] = int(np.count_nonzero(~routed))
+    timestamps, sites, deltas, payloads = timestamps[routed], sites[routed], deltas[routed], payloads[routed]
+
+    message_ids = np.array([payload_message_id(payload) or "" for payload in payloads.tolist()], dtype=object)
+    has_id = message_ids != ""
+    keys = np.array([f"{site} {delta} {message_id}" for site, delta, message_id in
+                     zip(sites.tolist(), deltas.tolist(), message_ids.tolist())])
+    keep = np.ones(len(timestamps), dtype=bool)
+    keep[has_id] = keep_first(keys[has_id], timestamps[has_id], int(dedupe_window_sec * NS_PER_SEC))
+    keep[~has_id] = keep_first(keys[~has_id], timestamps[~has_id], int(debounce_sec * NS_PER_SEC))
+    stats['duplicates'] = int(np.count_nonzero(~keep & has_id))
+    stats['debounced'] = int(np.count_nonzero(~keep & ~has_id))
+    timestamps, sites, deltas = timestamps[keep], sites[keep], deltas[keep]
+    return {site: (timestamps[sites == site], deltas[sites == site]) for site in sorted(set(sites.tolist()))}, stats
+
+def route_topic(topic):
+    """(site, event) of a topic, (None, None) for a topic the tracker does not listen to"""
+    for topic_filter, event in MQTT_ROUTES:
+        captured = match_topic(topic_filter, topic)
+        if captured is not None:
+            return (captured[0] if captured else DEFAULT_SITE), event
+    return None, None
+
+def add_events(site_events, new_site_events):
+    """Add the events of new_site_events to site_events, both {site: (timestamps, deltas)}"""
+    for site, (timestamps, deltas) in new_site_events.items():
+        if site in site_events:
+            timestamps = np.concatenate([site_events[site][0], timestamps])
+            deltas = np.concatenate([site_events[site][1], deltas])
+        site_events[site] = (timestamps, deltas)
+    return site_events
+
+def fifteen_min_counts(timestamps, deltas):
+    """{15 minute block number: count}"""
+    blocks, block_index = np.unique(np.asarray(timestamps, dtype=np.int64) // FIFTEEN_MIN_NS, return_inverse=True)
+    counts = np.bincount(block_index, weights=deltas, minlength=len(blocks)).astype(np.int64)
+    return dict(zip(blocks.tolist(), counts.tolist()))
+
+def diff_report(before, after):
+    """DataFrame of the 15 minute blocks whose count changed, with the site, block start, count before and after
+       before, after - {site: (timestamps, deltas)}"""
+    import pandas as pd
+    rows = list()
+    for site in sorted(set(before) | set(after)):
+        before_counts = fifteen_min_counts(*before.get(site, (np.zeros(0), np.zeros(0))))
+        after_counts = fifteen_min_counts(*after.get(site, (np.zeros(0), np.zeros(0))))
+        for block in sorted(set(before_counts) | set(after_counts)):
+            old, new = before_counts.get(block, 0), after_counts.get(block, 0)
+            if old != new:
+                rows.append({'site': site, 'time': ns_to_datetime(block * FIFTEEN_MIN_NS),
+                             'before': old, 'after': new, 'change': new - old})
+    return pd.DataFrame(rows, columns=['site', 'time', 'before', 'after', 'change'])
+
+def backfill(site_events, log_dir, dry_run=False, match_sec=DEBOUNCE_SEC):
+    """Merge the captured events into the sites' event logs, returns (before, after) {site: (timestamps, deltas)}.
+       dry_run - work out the merge without writing the logs
+       match_sec - a captured press this close to a logged one is the same press, the tracker already counted it"""
+    bad_sites = [site for site in site_events if SITE_NAME.fullmatch(site) is None]
+    for site in bad_sites:
+        logging.warning("Site %r is not a site name, its %s captured events are skipped", site, len(site_events[site][0]))
+    site_events = {site: events for site, events in site_events.items() if site not in bad_sites}
+    # an offline import, every site in the capture is counted
+    counters = CounterGroup(list(site_events), None if dry_run else log_dir, max_sites=None)
+    if dry_run:
+        # the logs are read into memory only counters, so they are not opened for writing
+        for site in site_events:
+            log_path = os.path.join(log_dir, f"{site}{LOG_SUFFIX}")
+            if os.path.isfile(log_path):
+                events = EventBuffer()
+                replay_log(log_path, events)
+                counters.get_counter(site).load_events(events)
+    before, after = dict(), dict()
+    for site, (timestamps, deltas) in site_events.items():
+        counter = counters.get_counter(site)
+        before[site] = counter.snapshot()
+        added = counter.merge_events(timestamps, deltas, int(match_sec * NS_PER_SEC))
+        after[site] = counter.snapshot()
+        logging.info("Site %s: %s of %s captured events added", site, added, len(timestamps))
+    counters.close()
+    return before, after
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='backfill.py',
+                                     description='Add the presses in serial or MQTT captures to the event logs')
+    parser.add_argument('-r', required=False, nargs='*', default=[], help="Captures of the RadioReceiver serial output")
+    parser.add_argument('-q', required=False, nargs='*', default=[], help="Captures of the MQTT messages")
+    parser.add_argument('-s', required=False, default=DEFAULT_SITE, help="Site name the radio captures count into")
+    parser.add_argument('-t', required=False, default=None, help="Date (YYYY-MM-DD) of captures that only have the time of day")
+    parser.add_argument('-l', required=False, default=f"{datetime.today().year}_TrickOrTreatLog", help="Directory of the event logs to merge into")
+    parser.add_argument('-d', required=False, type=float, default=DEBOUNCE_SEC, help="Drop a radio press within this many seconds of the last one, 0 to keep every press")
+    parser.add_argument('-m', required=False, type=float, default=DEBOUNCE_SEC, help="A captured press within this many seconds of a logged one is not added, more if the capture's clock is off")
+    parser.add_argument('-o', required=False, default=None, help="Save the changed 15 minute counts to this CSV file")
+    parser.add_argument('-n', required=False, action='store_true', help="Show what would change without writing the logs")
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s %(message)s')
+
+    start = time.perf_counter()
+    captured = dict()
+    for capture in args.r:
+        site_events, stats = read_serial_capture(capture, args.s, args.t, args.d)
+        print(f"{capture}: {stats}")
+        add_events(captured, site_events)
+    for capture in args.q:
+        site_events, stats = read_mqtt_capture(capture, args.t)
+        print(f"{capture}: {stats}")
+        add_events(captured, site_events)
+    before, after = backfill(captured, args.l, args.n, args.m)
+    print(f"Read and merged in {time.perf_counter() - start:.2f} seconds")
+
+    for site in sorted(after):
+        old_total, new_total = int(before[site][1].sum()), int(after[site][1].sum())
+        print(f"{site} Count: {old_total} -> {new_total} ({new_total - old_total:+d})")
+    report = diff_report(before, after)
+    if len(report):
+        print(report.to_string(index=False))
+    if args.o is not None:
+        report.to_csv(args.o, index=False, encoding='utf-8')
+    if args.n:
+        print("Dry run, the event logs were not changed")
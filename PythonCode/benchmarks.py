@@ -0,0 +1,129 @@
+# -----------------------------------------------------------
+# pytest-benchmark suite for the counting, reporting and parsing
+#  hot paths. Run it with
+#      python benchmarks.py
+#  each run is saved as JSON in benchmark_results/, compare with
+#  the last saved run and fail on a 25% slow down with
+#      python benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:25%
+#  (needs: pip install -r requirements-dev.txt)
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Event
+import sys
+import numpy as np
+import pytest
+
+from TrickCount import trick_count
+from event_store import EventBuffer, local_time_ns, NS_PER_SEC
+from serial_interface import RadioInterface, RadioProtocolHandler, TEST_PORT
+
+HISTORY_SIZES = [1_000, 100_000, 1_000_000]
+PARSE_LINES = 10_000
+RESULTS_DIR = "benchmark_results"
+
+def make_counter(size):
+    """Counter holding size presses spread over the last 3 hours"""
+    now = local_time_ns()
+    timestamps = np.sort(np.random.randint(now - 3 * 3600 * NS_PER_SEC, now, size)).astype(np.int64)
+    events = EventBuffer(size)
+    events.extend(timestamps, np.ones(size, dtype=np.int32))
+    counter = trick_count()
+    counter.load_events(events)
+    return counter
+
+@pytest.fixture(params=HISTORY_SIZES, ids=lambda size: f"{size}_events")
+def counter(request):
+    return make_counter(request.param)
+
+def test_increase(benchmark, counter):
+    benchmark(counter.increase)
+
+def test_decrease(benchmark, counter):
+    benchmark.pedantic(counter.decrease, setup=counter.increase, rounds=2000, iterations=1)
+
+def test_mark(benchmark, counter):
+    benchmark(counter.mark)
+
+def test_get_last_minute_count(benchmark, counter):
+    benchmark(counter.get_last_minute_count)
+
+def test_get_total_count(benchmark, counter):
+    benchmark(counter.get_total_count)
+
+def test_handle_line_parse(benchmark):
+    """Parse throughput of the protocol handler, the serial port is left out"""
+    presses = list()
+    handler = RadioProtocolHandler()
+    handler.set_button_callback([lambda: presses.append(1), None, None])
+    block = b"".join(f"Button: 1\r\nHeart: {index}\r\n".encode() for index in range(PARSE_LINES // 2))
+    benchmark(handler.data_received, block)
+
+def test_serial_loop_parse(benchmark):
+    """Lines written to a loop:// port until the reader thread has called back for all of them"""
+    done = Event()
+    seen = [0]
+    def press():
+        seen[0] += 1
+        if seen[0] == PARSE_LINES:
+            done.set()
+    radio = RadioInterface()
+    radio.start(TEST_PORT, button_callbacks = [press])
+    block = b"Button: 1\r\n" * PARSE_LINES
+
+    def send_block():
+        seen[0] = 0
+        done.clear()
+        radio.transport.write(block)
+        assert done.wait(10)
+    benchmark.pedantic(send_block, rounds=10, iterations=1)
+    radio.exit()
+
+class StubMqtt:
+    """Stands in for the mqtt interface, signals each publish. Counts are not held back, so every press publishes"""
+    flush_window = 0
+    def __init__(self, mqtt_config, message_callback, subscribe_list, *args, **kwargs):
+        self.message_callback = message_callback
+        self.published = Event()
+    def publish(self, topic, msg_data, *args, **kwargs):
+        self.published.set()
+    def publish_state(self, topic, msg_data):
+        self.published.set()
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class StubAdafruitIo:
+    """Stands in for the Adafruit IO interface"""
+    def __init__(self, config, feed_list, *args, **kwargs):
+        pass
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+@pytest.fixture
+def tracker(monkeypatch):
+    import TrickOrTreaters
+    monkeypatch.setattr(TrickOrTreaters, 'mqtt', StubMqtt)
+    monkeypatch.setattr(TrickOrTreaters, 'adafruit_io_interface', StubAdafruitIo)
+    tracker = TrickOrTreaters.TrickOrTreaterTracker({}, {}, TEST_PORT, debounce_sec=0)
+    yield tracker
+    tracker.radios.exit()
+
+def test_press_to_publish_mqtt(benchmark, tracker):
+    """MQTT press message to the local count publish, on the caller's thread"""
+    benchmark(tracker.mqtt_interface.message_callback, "Halloween/front/ButtonPress")
+
+def test_press_to_publish_serial(benchmark, tracker):
+    """Radio button line on the serial port to the local count publish, through the reader thread"""
+    published = tracker.mqtt_interface.published
+    def press():
+        published.clear()
+        tracker.radios.send_data("Button: 1")
+        assert published.wait(5)
+    benchmark.pedantic(press, rounds=200, iterations=1)
+
+if __name__ == '__main__':
+    """Run the suite and save the results, extra arguments are passed on to pytest"""
+    sys.exit(pytest.main([__file__, '-q', '-p', 'no:cacheprovider',
+                          f"--benchmark-storage=file://{RESULTS_DIR}", '--benchmark-autosave'] + sys.argv[1:]))
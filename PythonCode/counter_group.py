@@ -0,0 +1,151 @@
+# -----------------------------------------------------------
+# Holds a set of named trick_count counters, one per site or
+#  button ID, and provides a combined view across all of them
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+import heapq
+import logging
+import os
+import re
+from threading import Lock
+import numpy as np
+
+from TrickCount import trick_count
+from event_store import EventBuffer, ns_to_datetime
+from rollup import FIFTEEN_MIN_NS
+
+DEFAULT_SITE = "default"
+LOG_SUFFIX = "_events.log"
+# a site name goes into file, shared memory and topic names
+SITE_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
+# each site has an event log, a shared memory segment and threads, a bad publisher must not make them without end
+MAX_SITES = 16
+
+class CounterGroup:
+    """Each site's counter has its own lock, so presses for different sites never wait on each other.
+       The group's lock is only taken when a new site is added"""
+    def __init__(self, site_names=(DEFAULT_SITE,), log_dir=None, live_prefix=None, retention=(None, None),
+                 site_list=None, max_sites=MAX_SITES):
+        """Create the group
+           site_names - counters to create up front, others are created when first used
+           log_dir - directory for the per site event logs, None to keep the events in memory only.
+                     every site with a log in the directory is restored
+           live_prefix - publish each site's live state in shared memory named <live_prefix>_<site>, None to not
+           retention - (raw horizon, minute horizon) in seconds of each counter's retention policy, see trick_count
+           site_list - the only sites that can be created besides site_names, None allows any name matching SITE_NAME
+           max_sites - most sites the group holds, a new site past it is refused. None for no limit"""
+        self.counters = dict()
+        self.lock = Lock()
+        self.log_dir = log_dir
+        self.live_prefix = live_prefix
+        self.retention = retention
+        self.site_list = None if site_list is None else set(site_list) | set(site_names)
+        self.max_sites = max_sites
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+        for name in site_names:
+            self.get_counter(name)
+        if log_dir is not None:
+            for file_name in sorted(os.listdir(log_dir)):
+                name = file_name[:-len(LOG_SUFFIX)]
+                if not file_name.endswith(LOG_SUFFIX) or name in self.counters:
+                    continue
+                if self.accepts(name):
+                    self.get_counter(name)
+                else:
+                    logging.warning("Event log %s not restored, %s is not an allowed site", file_name, name)
+
+    def accepts(self, name):
+        """True if the site has a counter or one can be made for it"""
+        if name in self.counters:
+            return True
+        if SITE_NAME.fullmatch(name) is None:
+            return False
+        if self.max_sites is not None and len(self.counters) >= self.max_sites:
+            return False
+        return self.site_list is None or name in self.site_list
+
+    def get_counter(self, name):
+        """Return the counter for a site, creating it if this is the first time the site is seen.
+           ValueError for a site that is not allowed, see accepts()"""
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.get(name)
+                if counter is None:
+                    if not self.accepts(name):
+                        raise ValueError(f"Site {name!r} is not allowed, or there are already {len(self.counters)} sites")
+                    log_path = None
+                    if self.log_dir is not None:
+                        log_path = os.path.join(self.log_dir, f"{name}{LOG_SUFFIX}")
+                    live_name = None if self.live_prefix is None else f"{self.live_prefix}_{name}"
+                    counter = trick_count(log_path, live_name = live_name, raw_horizon_sec = self.retention[0],
+                                          minute_horizon_sec = self.retention[1])
+                    self.counters[name] = counter
+        return counter
+
+    def site_names(self):
+        """List of the site names in the group"""
+        return list(self.counters)
+
+    def close(self):
+        """Flush and close every counter's event log"""
+        for counter in list(self.counters.values()):
+            counter.close()
+
+    def get_total_count(self):
+        """Return the Total Count of all Trick-or-Treaters across every site"""
+        return sum(counter.get_total_count() for counter in list(self.counters.values()))
+
+    def get_last_minute_count(self):
+        """returns the previous minute's count summed across every site"""
+        return sum(counter.get_last_minute_count() for counter in list(self.counters.values()))
+
+    def get_last_fifteen_minute_count(self):
+        """returns the previous 15 minute block's count summed across every site"""
+        return sum(counter.get_last_fifteen_minute_count() for counter in list(self.counters.values()))
+
+    def get_count_between(self, start, end):
+        """Count with start <= time < end across every site, to the minute"""
+        return sum(counter.get_count_between(start, end) for counter in list(self.counters.values()))
+
+    def get_rolling_count(self, minutes):
+        """Count of the last number of minutes across every site"""
+        return sum(counter.get_rolling_count(minutes) for counter in list(self.counters.values()))
+
+    def get_rolling_rate(self, minutes):
+        """Trick-or-Treaters per minute over the last number of minutes across every site"""
+        return self.get_rolling_count(minutes) / minutes
+
+    def get_busiest_windows(self, count=1):
+        """The busiest 15 minute blocks across every site as a list of (block start datetime, count).
+           A block that is busy across the sites may not be the busiest at any one site, so each site's
+           blocks are added up, a night only has about a hundred of them"""
+        counters = list(self.counters.values())
+        if len(counters) == 1:
+            return counters[0].get_busiest_windows(count)
+        totals = dict()
+        for counter in counters:
+            for window, window_count in counter.get_window_counts().items():
+                totals[window] = totals.get(window, 0) + window_count
+        busiest = heapq.nlargest(count, ((window_count, window) for window, window_count in totals.items() if window_count > 0))
+        return [(ns_to_datetime(window * FIFTEEN_MIN_NS), window_count) for window_count, window in busiest]
+
+    def snapshot(self):
+        """(timestamps, deltas) of every site's events, not in time order"""
+        snapshots = [counter.snapshot() for counter in list(self.counters.values())]
+        return np.concatenate([snapshot[0] for snapshot in snapshots]), np.concatenate([snapshot[1] for snapshot in snapshots])
+
+    def combined_count(self):
+        """Build a single trick_count holding the events of every site, merged in time order"""
+        timestamps, deltas = self.snapshot()
+        order = np.argsort(timestamps, kind='stable')
+
+        combined = trick_count()
+        merged = EventBuffer(len(order))
+        merged.extend(timestamps[order], deltas[order])
+        combined.load_events(merged)
+        return combined
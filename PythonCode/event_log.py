@@ -0,0 +1,186 @@
+# -----------------------------------------------------------
+# Append-only binary write-ahead log of the count events, so a
+#  crash or restart does not lose the night. Records are a fixed
+#  size, they are buffered in memory and written + fsync'ed in
+#  batches, and the log is read back with mmap in one pass
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Thread, Lock, Event
+import logging
+import mmap
+import os
+import struct
+import numpy as np
+
+LOG_MAGIC = b'TOTEVLOG'
+LOG_VERSION = 1
+HEADER = struct.Struct('<8sII')
+RECORD = struct.Struct('<qiB3x')
+RECORD_DTYPE = np.dtype({'names': ['timestamp', 'delta', 'kind'],
+                         'formats': ['<i8', '<i4', 'u1'],
+                         'offsets': [0, 8, 12],
+                         'itemsize': RECORD.size})
+
+KIND_APPEND = 0
+KIND_POP = 1
+
+FLUSH_INTERVAL_SEC = 1.0
+FLUSH_BATCH_RECORDS = 256
+
+class EventLog:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL_SEC, batch_records=FLUSH_BATCH_RECORDS):
+        """Open the log for appending, creating it if needed
+           path - file to write
+           flush_interval - seconds between background write + fsync, 0 writes and fsyncs every record
+           batch_records - number of buffered records that forces a write + fsync before the interval"""
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_records = batch_records
+        self.lock = Lock()
+        self.buffer = bytearray()
+        self.buffered_records = 0
+        self.file = self.__open(path)
+        self.stop_event = Event()
+        self.flush_thread = None
+        if flush_interval > 0:
+            self.flush_thread = Thread(target=self.__flush_thread, args=(), daemon=True, name='EventLogFlush')
+            self.flush_thread.start()
+
+    def append(self, timestamp_ns, delta):
+        """Record a new event"""
+        self.__write(RECORD.pack(timestamp_ns, delta, KIND_APPEND))
+
+    def pop(self, timestamp_ns):
+        """Record that the last event was removed"""
+        self.__write(RECORD.pack(timestamp_ns, 0, KIND_POP))
+
+    def flush(self):
+        """Write the buffered records and fsync them to disk"""
+        with self.lock:
+            self.__flush_locked()
+
+    def end_offset(self):
+        """File offset after the last record, buffered ones included. Pass it to rewrite() to keep the records after it"""
+        with self.lock:
+            return self.file.tell() + len(self.buffer)
+
+    def rewrite(self, timestamps_ns, deltas, keep_from=None):
+        """Replace the log with these events, used after events are merged in out of order or compacted.
+           The new log is written beside the old one and swapped in, so a crash leaves one or the other
+           keep_from - end_offset() when the events were copied, the records written since are kept after them.
+                       The events are written out before taking the lock, so records can still be added meanwhile.
+                       None drops every record, the events hold them all"""
+        records = np.zeros(len(timestamps_ns), dtype=RECORD_DTYPE)
+        records['timestamp'] = timestamps_ns
+        records['delta'] = deltas
+        records['kind'] = KIND_APPEND
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(HEADER.pack(LOG_MAGIC, LOG_VERSION, RECORD.size))
+            temp_file.write(records.tobytes())
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        with self.lock:
+            if keep_from is None:
+                # the buffered records are in the new events too
+                self.buffer = bytearray()
+                self.buffered_records = 0
+            else:
+                self.__flush_locked()
+                self.file.seek(keep_from)
+                with open(temp_path, 'ab') as temp_file:
+                    temp_file.write(self.file.read())
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = self.__open(self.path)
+
+    def close(self):
+        """Flush and close the log"""
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+        with self.lock:
+            self.__flush_locked()
+            self.file.close()
+
+    def __write(self, record):
+        with self.lock:
+            self.buffer += record
+            self.buffered_records += 1
+            if self.flush_interval <= 0 or self.buffered_records >= self.batch_records:
+                self.__flush_locked()
+
+    def __flush_locked(self):
+        if not self.buffer or self.file.closed:
+            return
+        self.file.write(self.buffer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer = bytearray()
+        self.buffered_records = 0
+
+    def __flush_thread(self):
+        """Write and fsync the buffered records every flush interval"""
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as err:
+                logging.error("Event log flush failed: %s", err)
+
+    @staticmethod
+    def __open(path):
+        """Open the log for appending, writing the header to a new file and dropping a torn last record"""
+        file = open(path, 'a+b')
+        size = file.seek(0, os.SEEK_END)
+        if size < HEADER.size:
+            file.truncate(0)
+            file.write(HEADER.pack(LOG_MAGIC, LOG_VERSION, RECORD.size))
+            file.flush()
+            os.fsync(file.fileno())
+        else:
+            file.seek(0)
+            check_header(file.read(HEADER.size), path)
+            torn = (size - HEADER.size) % RECORD.size
+            if torn:
+                logging.warning("Event log %s ends with a partial record, %s bytes dropped", path, torn)
+                file.truncate(size - torn)
+            file.seek(0, os.SEEK_END)
+        return file
+
+def check_header(header, path):
+    """Raise a ValueError if the header is not one this code writes"""
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != LOG_MAGIC or version != LOG_VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a version {LOG_VERSION} event log")
+
+def read_log(path):
+    """Memory map the log and return its records as a numpy structured array (timestamp, delta, kind)
+       the array is a copy, so the file is not held open"""
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < HEADER.size:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            check_header(mapped[:HEADER.size], path)
+            count = (size - HEADER.size) // RECORD.size
+            records = np.frombuffer(mapped, dtype=RECORD_DTYPE, count=count, offset=HEADER.size).copy()
+    return records
+
+def replay_log(path, events):
+    """Replay the log into an EventBuffer, appends are copied in blocks and each pop removes the last event"""
+    records = read_log(path)
+    pops = np.flatnonzero(records['kind'] == KIND_POP)
+    start = 0
+    for pop_index in np.append(pops, len(records)).tolist():
+        segment = records[start:pop_index]
+        if len(segment):
+            events.extend(segment['timestamp'], segment['delta'])
+        if pop_index < len(records):
+            events.pop()
+        start = pop_index + 1
+    return len(records)
@@ -0,0 +1,150 @@
+# -----------------------------------------------------------
+# Append-only columnar storage for the time stamped count events.
+#  Time stamps are held as int64 nanoseconds in a preallocated numpy
+#  array that grows by doubling, next to an array of count deltas.
+#  A pandas view is only built when a report asks for one.
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from datetime import datetime, timedelta
+import time
+import numpy as np
+
+INITIAL_CAPACITY = 1024
+NS_PER_SEC = 1_000_000_000
+EPOCH = datetime(1970, 1, 1)
+
+def local_time_ns():
+    """Return the local wall clock time in nanoseconds, the same naive clock datetime.now() uses"""
+    now_ns = time.time_ns()
+    return now_ns + time.localtime(now_ns // NS_PER_SEC).tm_gmtoff * NS_PER_SEC
+
+def ns_to_datetime(timestamp_ns):
+    """Convert a local nanosecond time stamp back into a naive datetime"""
+    return EPOCH + timedelta(microseconds=int(timestamp_ns) // 1000)
+
+def datetime_to_ns(time_stamp):
+    """Convert a naive datetime into a local nanosecond time stamp"""
+    delta = time_stamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * NS_PER_SEC + delta.microseconds * 1000
+
+def events_to_frame(timestamps_ns, deltas):
+    """Build a pandas DataFrame from event arrays, indexed by time stamp with a 'count' column"""
+    import pandas as pd
+    index = pd.DatetimeIndex(np.asarray(timestamps_ns).astype('datetime64[ns]'))
+    return pd.DataFrame({'count': np.asarray(deltas).astype(np.int64)}, index=index)
+
+def merge_events(timestamps_ns, deltas, new_timestamps_ns, new_deltas, window_ns=0):
+    """Merge a block of new events into stored events in time order, returns (timestamps, deltas, added).
+       A new event within window_ns of a stored event with the same delta is taken to be that event and
+       skipped, so the same press seen by another source is only counted once. With no window only exact
+       repeats are skipped. One sort of both blocks, not an insert per event"""
+    stored_timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+    stored_deltas = np.asarray(deltas, dtype=np.int32)
+    new_timestamps = np.asarray(new_timestamps_ns, dtype=np.int64)
+    new_deltas = np.asarray(new_deltas, dtype=np.int32)
+    repeat = np.zeros(len(new_timestamps), dtype=bool)
+    # a block only has a few different deltas, the stored events of each one are searched for the nearest event
+    for delta in np.unique(new_deltas).tolist():
+        stored = np.sort(stored_timestamps[stored_deltas == delta])
+        if len(stored) == 0:
+            continue
+        is_delta = new_deltas == delta
+        times = new_timestamps[is_delta]
+        after = np.searchsorted(stored, times)
+        next_gap = stored[np.minimum(after, len(stored) - 1)] - times
+        last_gap = times - stored[np.maximum(after - 1, 0)]
+        repeat[is_delta] = (((after < len(stored)) & (next_gap <= window_ns)) |
+                            ((after > 0) & (last_gap <= window_ns)))
+    timestamps = np.concatenate([stored_timestamps, new_timestamps[~repeat]])
+    merged_deltas = np.concatenate([stored_deltas, new_deltas[~repeat]])
+    is_new = np.arange(len(timestamps)) >= len(stored_timestamps)
+    order = np.lexsort((is_new, merged_deltas, timestamps))
+    return timestamps[order], merged_deltas[order], int(np.count_nonzero(~repeat))
+
+def downsample_events(timestamps_ns, deltas, cutoff_ns, bucket_ns):
+    """Sum the events before cutoff_ns into one event at the start of each bucket, the cutoff is rounded
+       down to a bucket so no bucket is split. Returns (timestamps, deltas, bucket count), the buckets come
+       first followed by the newer events as they were"""
+    timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=np.int32)
+    old = timestamps < cutoff_ns // bucket_ns * bucket_ns
+    buckets, inverse = np.unique(timestamps[old] // bucket_ns, return_inverse=True)
+    sums = np.bincount(inverse, weights=deltas[old], minlength=len(buckets)).round().astype(np.int32)
+    return (np.concatenate([buckets * bucket_ns, timestamps[~old]]),
+            np.concatenate([sums, deltas[~old]]), len(buckets))
+
+class EventBuffer:
+    """Growable pair of arrays, timestamps (int64 ns) and deltas (+1 count, -1 remove, 0 mark)"""
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.timestamps = np.empty(max(capacity, 1), dtype=np.int64)
+        self.deltas = np.empty(max(capacity, 1), dtype=np.int32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp_ns, delta):
+        """Add one event to the end of the buffer, amortized O(1)"""
+        if self.size == len(self.timestamps):
+            self.__grow(self.size * 2)
+        self.timestamps[self.size] = timestamp_ns
+        self.deltas[self.size] = delta
+        self.size += 1
+
+    def extend(self, timestamps_ns, deltas):
+        """Add a block of events to the end of the buffer"""
+        count = len(timestamps_ns)
+        needed = self.size + count
+        if needed > len(self.timestamps):
+            self.__grow(max(needed, self.size * 2))
+        self.timestamps[self.size:needed] = timestamps_ns
+        self.deltas[self.size:needed] = deltas
+        self.size = needed
+
+    def pop(self):
+        """Remove the last event, returns (timestamp_ns, delta) or None if the buffer is empty"""
+        if self.size == 0:
+            return None
+        self.size -= 1
+        return int(self.timestamps[self.size]), int(self.deltas[self.size])
+
+    def get_timestamps(self):
+        """Read only view of the stored time stamps"""
+        view = self.timestamps[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def get_deltas(self):
+        """Read only view of the stored deltas"""
+        view = self.deltas[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def copy_arrays(self):
+        """Return copies of the stored (timestamps, deltas), safe to use after the buffer changes"""
+        return self.timestamps[:self.size].copy(), self.deltas[:self.size].copy()
+
+    def to_frame(self):
+        """Build a pandas DataFrame of the events, indexed by time stamp with a 'count' column"""
+        return events_to_frame(self.timestamps[:self.size], self.deltas[:self.size])
+
+    @classmethod
+    def from_frame(cls, df):
+        """Create a buffer from a DataFrame indexed by time stamp with a 'count' column"""
+        import pandas as pd
+        timestamps = pd.DatetimeIndex(df.index).as_unit('ns').asi8
+        buffer = cls(len(df))
+        buffer.extend(timestamps, df['count'].to_numpy())
+        return buffer
+
+    def __grow(self, capacity):
+        """Reallocate the arrays to the new capacity, keeping the stored events"""
+        timestamps = np.empty(capacity, dtype=np.int64)
+        deltas = np.empty(capacity, dtype=np.int32)
+        timestamps[:self.size] = self.timestamps[:self.size]
+        deltas[:self.size] = self.deltas[:self.size]
+        self.timestamps = timestamps
+        self.deltas = deltas
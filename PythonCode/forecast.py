@@ -0,0 +1,145 @@
+# -----------------------------------------------------------
+# Forecast of the rest of the night, to know when to restock the
+#  candy and when to turn the lights off. The prior years give the
+#  shape of a night (what share of the trick-or-treaters come in
+#  each minute), tonight's minute counts give the pace, and the two
+#  together predict the arrivals still to come and the end of night
+#  total. The pace is exponentially smoothed, so each closed minute
+#  is one O(1) update, and a restart catches up in one vectorized
+#  pass over the events
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+import glob
+import logging
+import os
+import re
+import numpy as np
+
+from history import HistoryStore, import_raw_csv, minutes_by_time_of_night, RAW_CSV_SUFFIX, NIGHT_START_NS, DAY_NS
+from rollup import MINUTE_NS
+
+MINUTES_PER_NIGHT = DAY_NS // MINUTE_NS
+# about the last 10 minutes set the pace
+SMOOTHING = 0.1
+# the prior years' average total counts as much as this share of a night of tonight's arrivals,
+#  so the first few minutes do not swing the forecast wildly
+PRIOR_SHARE = 0.05
+# with no history the arrivals are expected to keep their pace until this time
+DEFAULT_NIGHT_END = "21:00"
+SHAPE_SMOOTH_MINUTES = 15
+NEXT_MINUTES = 15
+
+def night_slot(minute):
+    """Minute of the night of an absolute minute number (time stamp // MINUTE_NS), slot 0 is 12:00 noon"""
+    return (minute - NIGHT_START_NS // MINUTE_NS) % MINUTES_PER_NIGHT
+
+def clock_slot(clock_time):
+    """Minute of the night of a 'HH:MM' clock time"""
+    hours, minutes = (int(part) for part in clock_time.split(':'))
+    return night_slot(hours * 60 + minutes)
+
+def load_prior_years(history_dir='.', exclude_year=None):
+    """Return (shape, average total) of the prior years in the history directory, read from the Arrow history
+       files and the raw CSV files of years that have no Arrow file. (None, None) when there are none.
+       Each year is scaled to its own total before they are averaged, so a busy year does not outweigh the others"""
+    years = dict()
+    store = HistoryStore(history_dir)
+    for year in store.years():
+        try:
+            years[year] = store.load_year(year)
+        except ImportError as err:
+            logging.warning("History %s not read: %s", year, err)
+    for csv_file in glob.glob(os.path.join(history_dir, f"*{RAW_CSV_SUFFIX}")):
+        year_match = re.match(r'(\d{4})' + re.escape(RAW_CSV_SUFFIX) + '$', os.path.basename(csv_file))
+        if year_match is not None and int(year_match.group(1)) not in years:
+            years[int(year_match.group(1))] = import_raw_csv(csv_file)
+    years.pop(exclude_year, None)
+    if not years:
+        return None, None
+
+    curves = np.array([minutes_by_time_of_night(*years[year]) for year in sorted(years)])
+    totals = curves.sum(axis=1)
+    curves, totals = curves[totals > 0], totals[totals > 0]
+    if len(totals) == 0:
+        return None, None
+    shape = (curves / totals[:, None]).mean(axis=0)
+    # the years are a handful of samples per minute, smooth them so one busy minute does not make a spike
+    shape = np.convolve(shape, np.ones(SHAPE_SMOOTH_MINUTES) / SHAPE_SMOOTH_MINUTES, mode='same')
+    logging.info("Forecast from %s prior years, average total %.0f", len(totals), totals.mean())
+    return shape / shape.sum(), float(totals.mean())
+
+class ArrivalForecast:
+    def __init__(self, shape=None, prior_total=None, smoothing=SMOOTHING, night_end=DEFAULT_NIGHT_END):
+        """shape - share of the night's arrivals expected in each minute of the night (slot 0 is noon),
+                   None expects the arrivals to keep their pace until night_end
+           prior_total - average total of the prior years, None to go on tonight's arrivals alone
+           smoothing - weight of each new minute in the pace, higher follows the last few minutes more closely"""
+        if shape is None:
+            shape = np.zeros(MINUTES_PER_NIGHT)
+            shape[:clock_slot(night_end)] = 1
+        shape = np.asarray(shape, dtype=np.float64)
+        self.shape = shape / shape.sum()
+        self.cumulative = np.concatenate([[0.0], np.cumsum(self.shape)])
+        self.prior_total = prior_total
+        self.smoothing = smoothing
+        self.observed_level = 0.0
+        self.expected_level = 0.0
+        self.last_minute = None
+
+    def catch_up(self, timestamps_ns, deltas, now_ns):
+        """Smooth every closed minute of tonight's events in one pass, used when starting part way through the night"""
+        now_minute = now_ns // MINUTE_NS
+        minutes = np.asarray(timestamps_ns, dtype=np.int64) // MINUTE_NS
+        deltas = np.asarray(deltas)
+        tonight = (minutes < now_minute) & (minutes > now_minute - MINUTES_PER_NIGHT)
+        self.observed_level = self.expected_level = 0.0
+        self.last_minute = now_minute - 1
+        if not tonight.any():
+            return
+        first_minute = int(minutes[tonight].min())
+        observed = np.bincount(minutes[tonight] - first_minute, weights=deltas[tonight], minlength=now_minute - first_minute)
+        expected = self.shape[night_slot(np.arange(first_minute, now_minute))]
+        # both start from zero, so the early minutes are under weighted the same in each and their ratio is not
+        weights = self.smoothing * (1 - self.smoothing) ** np.arange(len(observed) - 1, -1, -1)
+        self.observed_level = float(weights @ observed)
+        self.expected_level = float(weights @ expected)
+
+    def add_minute(self, minute, count):
+        """Smooth in one closed minute, O(1)"""
+        self.observed_level += self.smoothing * (count - self.observed_level)
+        self.expected_level += self.smoothing * (self.shape[night_slot(minute)] - self.expected_level)
+        self.last_minute = minute
+
+    def advance(self, now_ns, count_between):
+        """Add the minutes that closed since the last call
+           count_between - function of (start ns, end ns) that returns the count in that time, like CounterGroup.get_count_between"""
+        now_minute = now_ns // MINUTE_NS
+        if self.last_minute is None or now_minute - self.last_minute > MINUTES_PER_NIGHT:
+            self.last_minute = now_minute - 1
+        for minute in range(self.last_minute + 1, now_minute):
+            self.add_minute(minute, count_between(minute * MINUTE_NS, (minute + 1) * MINUTE_NS))
+
+    def night_size(self):
+        """Estimate of tonight's total from the pace against the shape. The prior years' total is blended in
+           as if it had been seen over PRIOR_SHARE of the night, so it matters less as tonight goes on"""
+        # the smoothed levels are averages, dividing by the smoothing turns them into totals over the smoothed minutes
+        observed = self.observed_level / self.smoothing
+        expected = self.expected_level / self.smoothing
+        if self.prior_total is not None:
+            return (observed + PRIOR_SHARE * self.prior_total) / (expected + PRIOR_SHARE)
+        return observed / expected if expected > 0 else 0.0
+
+    def forecast(self, total, now_ns):
+        """Dictionary of the forecast: arrivals still to come (remaining), the end of night total,
+           arrivals expected in the next NEXT_MINUTES minutes and the expected rate per minute now"""
+        slot = night_slot(now_ns // MINUTE_NS)
+        size = self.night_size()
+        done = self.cumulative[slot]
+        remaining = max(size * (1 - done), 0.0)
+        return {'remaining': int(round(remaining)),
+                'expected_total': int(round(total + remaining)),
+                'next': int(round(max(size * (self.cumulative[min(slot + NEXT_MINUTES, MINUTES_PER_NIGHT)] - done), 0.0))),
+                'rate': round(float(size * self.shape[slot]), 2)}
@@ -0,0 +1,199 @@
+# -----------------------------------------------------------
+# Columnar history of past years. Each year's events are saved
+#  as an Arrow IPC file, which is memory mapped when it is read
+#  back so many years can be opened and queried by time range
+#  without loading or parsing them. Old raw CSV files can be
+#  imported, and the years can be compared on one graph
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from datetime import datetime
+import argparse
+import glob
+import os
+import re
+import numpy as np
+
+from event_store import datetime_to_ns
+from rollup import FIFTEEN_MIN_NS, MINUTE_NS
+from trick_report import CountRollups, new_figure
+
+ARROW_SUFFIX = "_TrickOrTreatData.arrow"
+RAW_CSV_SUFFIX = "_RawTrickOrTreatData.csv"
+DAY_NS = 24 * 60 * MINUTE_NS
+# the night is lined up from noon, so an evening that runs past midnight stays in one piece
+NIGHT_START_NS = 12 * 60 * MINUTE_NS
+SLOTS_PER_NIGHT = DAY_NS // FIFTEEN_MIN_NS
+
+def import_pyarrow():
+    """pyarrow is only needed for the history files, so it is imported when they are used"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError as err:
+        raise ImportError("pyarrow is needed for the history files: pip install pyarrow") from err
+    return pyarrow
+
+def export_year(timestamps_ns, deltas, year=None, output_dir='.'):
+    """Save a year's events to an Arrow file, sorted by time, returns the file name"""
+    pa = import_pyarrow()
+    year = datetime.today().year if year is None else year
+    timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+    order = np.argsort(timestamps, kind='stable')
+    table = pa.table({'timestamp': pa.array(timestamps[order].astype('datetime64[ns]')),
+                      'count': pa.array(np.asarray(deltas, dtype=np.int32)[order])})
+    file_name = os.path.join(output_dir, f"{year}{ARROW_SUFFIX}")
+    with pa.OSFile(file_name, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=len(table) or None)
+    return file_name
+
+def import_raw_csv(csv_file):
+    """Read a raw CSV file written by plot_output, returns (timestamps, deltas)"""
+    import pandas as pd
+    df = pd.read_csv(csv_file, index_col=0, usecols=[0, 1])
+    timestamps = pd.DatetimeIndex(pd.to_datetime(df.index)).as_unit('ns').asi8
+    return timestamps, df['count'].to_numpy(dtype=np.int32)
+
+class HistoryStore:
+    def __init__(self, history_dir='.'):
+        """Find the yearly Arrow files in the directory, they are memory mapped the first time they are used"""
+        self.history_dir = history_dir
+        self.files = dict()
+        self.loaded = dict()
+        for file_name in glob.glob(os.path.join(history_dir, f"*{ARROW_SUFFIX}")):
+            match = re.match(r'(\d{4})' + re.escape(ARROW_SUFFIX) + '$', os.path.basename(file_name))
+            if match:
+                self.files[int(match.group(1))] = file_name
+
+    def years(self):
+        """Sorted list of the years in the store"""
+        return sorted(self.files)
+
+    def load_year(self, year):
+        """Return (timestamps, deltas) for a year, the arrays are views of the memory mapped file"""
+        if year not in self.loaded:
+            pa = import_pyarrow()
+            source = pa.memory_map(self.files[year], 'r')
+            table = pa.ipc.open_file(source).read_all().combine_chunks()
+            timestamps = table.column('timestamp').chunk(0).to_numpy(zero_copy_only=True).view(np.int64) \
+                if len(table) else np.zeros(0, dtype=np.int64)
+            deltas = table.column('count').chunk(0).to_numpy(zero_copy_only=True) \
+                if len(table) else np.zeros(0, dtype=np.int32)
+            self.loaded[year] = (table, timestamps, deltas)
+        return self.loaded[year][1], self.loaded[year][2]
+
+    def query(self, start, end):
+        """Return (timestamps, deltas) of every event with start <= time < end across all years,
+           start and end are datetimes or nanosecond time stamps"""
+        start_ns = datetime_to_ns(start) if isinstance(start, datetime) else int(start)
+        end_ns = datetime_to_ns(end) if isinstance(end, datetime) else int(end)
+        found_timestamps = list()
+        found_deltas = list()
+        for year in self.years():
+            if year < ns_year(start_ns) or year > ns_year(end_ns - 1):
+                continue
+            timestamps, deltas = self.load_year(year)
+            first, last = np.searchsorted(timestamps, [start_ns, end_ns])
+            found_timestamps.append(timestamps[first:last])
+            found_deltas.append(deltas[first:last])
+        if not found_timestamps:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return np.concatenate(found_timestamps), np.concatenate(found_deltas)
+
+    def count_between(self, start, end):
+        """Total count of the events with start <= time < end"""
+        return int(self.query(start, end)[1].sum())
+
+def ns_year(timestamp_ns):
+    """Calendar year of a nanosecond time stamp"""
+    return int(np.datetime64(int(timestamp_ns), 'ns').astype('datetime64[Y]').astype(int)) + 1970
+
+def minutes_by_time_of_night(timestamps_ns, deltas):
+    """Fold the events onto one night a minute at a time, slot 0 is 12:00 noon"""
+    timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+    slots = ((timestamps - NIGHT_START_NS) % DAY_NS) // MINUTE_NS
+    return np.bincount(slots, weights=deltas, minlength=DAY_NS // MINUTE_NS)
+
+def fifteen_min_by_time_of_night(timestamps_ns, deltas):
+    """Fold the 15 minute rollup of the events onto one night, slot 0 is 12:00 noon"""
+    rollups = CountRollups(timestamps_ns, deltas)
+    if len(rollups.fifteen_min_counts) == 0:
+        return np.zeros(SLOTS_PER_NIGHT, dtype=np.int64)
+    starts = rollups.fifteen_min_times().astype(np.int64)
+    slots = ((starts - NIGHT_START_NS) % DAY_NS) // FIFTEEN_MIN_NS
+    return np.bincount(slots, weights=rollups.fifteen_min_counts, minlength=SLOTS_PER_NIGHT).round().astype(np.int64)
+
+def year_over_year(store, years=None, current=None):
+    """DataFrame of the 15 minute counts of each year, lined up by time of night
+       years - the years to include, None for all of them
+       current - optional (year, timestamps, deltas) of a year that is not in the store yet, like tonight"""
+    import pandas as pd
+    columns = dict()
+    for year in (store.years() if years is None else years):
+        columns[year] = fifteen_min_by_time_of_night(*store.load_year(year))
+    if current is not None:
+        columns[current[0]] = fifteen_min_by_time_of_night(current[1], current[2])
+    slot_times = NIGHT_START_NS + np.arange(SLOTS_PER_NIGHT, dtype=np.int64) * FIFTEEN_MIN_NS
+    labels = pd.DatetimeIndex(slot_times.astype('datetime64[ns]')).strftime('%I:%M %p')
+    table = pd.DataFrame(columns, index=labels)
+
+    active = np.flatnonzero(table.to_numpy().any(axis=1)) if len(columns) else []
+    if len(active):
+        table = table.iloc[active[0]:active[-1] + 1]
+    return table
+
+def plot_year_over_year(table, show=True, image_format=None, output_dir='.'):
+    """Draw each year's 15 minute counts and running totals over the same night, returns the saved file names"""
+    figure = new_figure(not show, figsize=(10, 6))
+    count_axes = figure.add_subplot(2, 1, 1)
+    total_axes = figure.add_subplot(2, 1, 2, sharex=count_axes)
+    positions = np.arange(len(table))
+    for year in table.columns:
+        count_axes.plot(positions, table[year].to_numpy(), marker='.', label=str(year))
+        total_axes.plot(positions, table[year].cumsum().to_numpy(), label=str(year))
+    count_axes.set_ylabel("Count (15 Min)")
+    count_axes.set_title("Trick-or-Treaters Year over Year")
+    count_axes.legend()
+    total_axes.set_ylabel("Total Count")
+    total_axes.set_xlabel("Time")
+    step = max(1, len(table) // 12)
+    total_axes.set_xticks(positions[::step], table.index[::step])
+    figure.tight_layout()
+
+    saved_files = list()
+    csv_file = os.path.join(output_dir, "YearOverYear15minTrickOrTreatData.csv")
+    table.to_csv(csv_file, encoding='utf-8')
+    saved_files.append(csv_file)
+    if image_format is not None:
+        image_file = os.path.join(output_dir, f"YearOverYearTrickOrTreatGraph.{image_format}")
+        figure.savefig(image_file, format=image_format)
+        saved_files.append(image_file)
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return saved_files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='history.py',
+                                     description='Convert old raw CSV files to the history format and compare the years')
+    parser.add_argument('-d', required=False, default='.', help="Directory of the history files")
+    parser.add_argument('-c', required=False, nargs='*', default=[], help=f"Raw CSV files (YYYY{RAW_CSV_SUFFIX}) to import")
+    parser.add_argument('-y', required=False, nargs='*', type=int, default=None, help="Years to compare, default all")
+    parser.add_argument('-i', required=False, choices=['png', 'svg'], default=None, help="Save the graph as an image in this format")
+    parser.add_argument('-n', required=False, action='store_true', help="Do not open a window for the graph")
+    args = parser.parse_args()
+
+    for csv_file in args.c:
+        year_match = re.match(r'(\d{4})', os.path.basename(csv_file))
+        if year_match is None:
+            raise SystemExit(f"Can not tell the year of {csv_file}, the name should start with it")
+        print(f"Imported {export_year(*import_raw_csv(csv_file), int(year_match.group(1)), args.d)}")
+
+    history = HistoryStore(args.d)
+    print(f"Years: {history.years()}")
+    yoy_table = year_over_year(history, args.y)
+    print(yoy_table.sum().to_string())
+    plot_year_over_year(yoy_table, show=not args.n, image_format=args.i, output_dir=args.d)
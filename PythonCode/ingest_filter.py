@@ -0,0 +1,147 @@
+# -----------------------------------------------------------
+# Ingest filter that sits in front of the counters. A press that
+#  comes in again from the same source too quickly is debounced,
+#  a press that carries a message ID (the radio address and
+#  sequence number, or the ID in an MQTT payload) is only counted
+#  once no matter which source it came in on, and a press for the
+#  same site and event on another source just after is taken to be
+#  the same press
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from collections import deque
+from threading import Lock
+import time
+
+from event_store import NS_PER_SEC
+
+SOURCE_RADIO = "radio"
+SOURCE_MQTT = "mqtt"
+DEBOUNCE_SEC = 0.1
+DEDUPE_WINDOW_SEC = 5.0
+MATCH_WINDOW_SEC = 1.0
+RING_SIZE = 64
+# message IDs are kept apart by where they came from, a bridge that republishes a radio press sends the radio ID
+RADIO_ID_PREFIX = "radio:"
+MQTT_ID_PREFIX = "mqtt:"
+
+def radio_message_id(sender, seq):
+    """Message ID of a radio packet, the sequence number is only unique for one remote"""
+    return f"{RADIO_ID_PREFIX}{sender}:{seq}"
+
+def payload_message_id(payload):
+    """Message ID sent after the value in an MQTT payload, like b"1 42", None when there is none.
+       A radio ID (b"1 radio:2:17") is kept as it is, any other ID is an MQTT one"""
+    words = payload.split()
+    if len(words) < 2:
+        return None
+    message_id = words[1].decode('ascii', 'replace')
+    return message_id if message_id.startswith(RADIO_ID_PREFIX) else MQTT_ID_PREFIX + message_id
+
+class IngestFilter:
+    def __init__(self, debounce_sec={SOURCE_RADIO: DEBOUNCE_SEC}, dedupe_window_sec=DEDUPE_WINDOW_SEC, ring_size=RING_SIZE,
+                 match_window_sec=MATCH_WINDOW_SEC):
+        """Filter for the incoming events
+           debounce_sec - an event from a source within this time of the last one it let through for the same
+                          site and event is dropped, a number for every source or a dictionary of {source: seconds}.
+                          Only the radio buttons bounce, so by default only they are debounced
+           dedupe_window_sec - an event with a message ID already seen within this time is dropped
+           ring_size - number of recent message IDs remembered, and of recent events kept for each site and event
+           match_window_sec - an event from another source within this time of one let through for the same site and
+                              event is the same press, each event is matched once. 0 turns it off"""
+        self.lock = Lock()
+        if isinstance(debounce_sec, dict):
+            self.debounce_ns = {source: int(seconds * NS_PER_SEC) for source, seconds in debounce_sec.items()}
+            self.default_debounce_ns = 0
+        else:
+            self.debounce_ns = dict()
+            self.default_debounce_ns = int(debounce_sec * NS_PER_SEC)
+        self.dedupe_window_ns = int(dedupe_window_sec * NS_PER_SEC)
+        self.last_accepted = dict()
+        # ring of the recent message keys, the dictionary finds a key and the slot it is in
+        self.ring = [None] * ring_size
+        self.ring_index = 0
+        self.recent = dict()
+        self.match_window_ns = int(match_window_sec * NS_PER_SEC)
+        # events let through that have not been matched to one from another source yet, by (site, event)
+        self.unmatched = dict()
+        self.stats = dict()
+
+    def accept(self, source, site, event, message_id=None, now_ns=None):
+        """Returns True if the event should be counted, False if it is a bounce or a duplicate
+           message_id - ID of the message, the same press from two sources has the same ID. None if it has none,
+                        events without an ID are debounced instead"""
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        with self.lock:
+            stats = self.stats.get(source)
+            if stats is None:
+                stats = self.stats[source] = {'passed': 0, 'debounced': 0, 'duplicates': 0}
+            if message_id is not None:
+                if self.__seen(site, event, message_id, now_ns):
+                    stats['duplicates'] += 1
+                    self.__forget_match(source, site, event, message_id)
+                    return False
+            else:
+                key = (source, site, event)
+                last = self.last_accepted.get(key)
+                if last is not None and now_ns - last < self.debounce_ns.get(source, self.default_debounce_ns):
+                    stats['debounced'] += 1
+                    return False
+                self.last_accepted[key] = now_ns
+            if self.match_window_ns > 0 and self.__match(source, site, event, message_id, now_ns):
+                stats['duplicates'] += 1
+                return False
+            stats['passed'] += 1
+            return True
+
+    def get_stats(self):
+        """Copy of the counters, {source: {'passed', 'debounced', 'duplicates'}}"""
+        with self.lock:
+            return {source: dict(stats) for source, stats in self.stats.items()}
+
+    def get_suppressed_count(self):
+        """Total events dropped from every source"""
+        with self.lock:
+            return sum(stats['debounced'] + stats['duplicates'] for stats in self.stats.values())
+
+    def __match(self, source, site, event, message_id, now_ns):
+        """Look for an unmatched event from another source within the match window, a match is used up.
+           Two events that both have a message ID are different presses unless the IDs are the same.
+           An event with no match is kept to be matched later"""
+        unmatched = self.unmatched.get((site, event))
+        if unmatched is None:
+            unmatched = self.unmatched[(site, event)] = deque(maxlen=len(self.ring))
+        while unmatched and now_ns - unmatched[0][0] >= self.match_window_ns:
+            unmatched.popleft()
+        for index, (_, other_source, other_id) in enumerate(unmatched):
+            if other_source != source and (message_id is None or other_id is None):
+                del unmatched[index]
+                return True
+        unmatched.append((now_ns, source, message_id))
+        return False
+
+    def __forget_match(self, source, site, event, message_id):
+        """The copy of an event from another source came in with its message ID, so it is matched already"""
+        unmatched = self.unmatched.get((site, event), ())
+        for index, (_, other_source, other_id) in enumerate(unmatched):
+            if other_id == message_id and other_source != source:
+                del unmatched[index]
+                return
+
+    def __seen(self, site, event, message_id, now_ns):
+        """Check the ring for the message, a new message takes the oldest slot"""
+        key = (site, event, message_id)
+        entry = self.recent.get(key)
+        if entry is not None and now_ns - entry[0] < self.dedupe_window_ns:
+            return True
+        slot = self.ring_index
+        old_key = self.ring[slot]
+        # only forget the old key if it was not seen again since, then it lives in a newer slot
+        if old_key is not None and self.recent[old_key][1] == slot:
+            del self.recent[old_key]
+        self.ring[slot] = key
+        self.recent[key] = (now_ns, slot)
+        self.ring_index = (slot + 1) % len(self.ring)
+        return False
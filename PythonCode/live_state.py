@@ -0,0 +1,218 @@
+# -----------------------------------------------------------
+# Live count state in shared memory, so a display or a script on
+#  the same machine can read the count without going through the
+#  MQTT broker. A counter writes its total and a ring of the recent
+#  minute counts into a named segment, and readers take consistent
+#  snapshots with a sequence lock: the writer makes the sequence
+#  odd while it writes and even when it is done, a reader that saw
+#  it change or odd tries again. Readers never block the writer
+#      python live_state.py -n trick_default
+#  prints the live count of the default site every second
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from multiprocessing import shared_memory, resource_tracker
+import argparse
+import logging
+import os
+import struct
+import time
+import numpy as np
+
+from event_store import local_time_ns, ns_to_datetime
+from rollup import MINUTE_NS
+
+LIVE_MAGIC = b'TOTLIVE\0'
+LIVE_VERSION = 1
+# magic, version, minute count
+HEADER = struct.Struct('<8sII')
+# sequence, total, updated time stamp, the int64 fields that follow the header
+SEQUENCE, TOTAL, UPDATED = range(3)
+FIELD_COUNT = 3
+LIVE_MINUTES = 60
+READ_TIMEOUT_SEC = 1
+
+# segments written by this process, Python already tracks those
+written_names = set()
+
+def segment_size(minute_count):
+    """Bytes of a segment holding minute_count minutes, the fields then the minute numbers and their counts"""
+    return HEADER.size + (FIELD_COUNT + 2 * minute_count) * 8
+
+def map_arrays(buffer, minute_count):
+    """(fields, minute numbers, minute counts) int64 arrays over the segment's memory, no copies"""
+    fields = np.ndarray((FIELD_COUNT,), dtype='<i8', buffer=buffer, offset=HEADER.size)
+    minute_offset = HEADER.size + FIELD_COUNT * 8
+    minutes = np.ndarray((minute_count,), dtype='<i8', buffer=buffer, offset=minute_offset)
+    counts = np.ndarray((minute_count,), dtype='<i8', buffer=buffer, offset=minute_offset + minute_count * 8)
+    return fields, minutes, counts
+
+def open_untracked(name):
+    """Open an existing segment. Python tracks every segment a process opens and removes them when it exits,
+       a reader does not own the segment so it is opened without that (track=False is Python 3.13 and later)"""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name)
+        # only POSIX segments are tracked, under their name with a leading slash
+        if os.name == 'posix' and name not in written_names:
+            resource_tracker.unregister('/' + memory.name.lstrip('/'), 'shared_memory')
+        return memory
+
+class LiveStateWriter:
+    def __init__(self, name, minute_count=LIVE_MINUTES):
+        """Create the shared memory segment, one left behind by a tracker that crashed is replaced
+           name - segment name the readers open, one writer per name
+           minute_count - number of recent minutes kept"""
+        self.name = name
+        self.minute_count = minute_count
+        try:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=segment_size(minute_count))
+        except FileExistsError:
+            logging.info("Replacing the live state %s", name)
+            old_memory = shared_memory.SharedMemory(name)
+            old_memory.close()
+            old_memory.unlink()
+            self.memory = shared_memory.SharedMemory(name, create=True, size=segment_size(minute_count))
+        written_names.add(name)
+        self.fields, self.minutes, self.counts = map_arrays(self.memory.buf, minute_count)
+        self.fields[:] = 0
+        self.minutes[:] = -1
+        self.counts[:] = 0
+        # the magic goes in last, so a reader never sees a half set up segment
+        HEADER.pack_into(self.memory.buf, 0, LIVE_MAGIC, LIVE_VERSION, minute_count)
+
+    def update(self, total, timestamp_ns, delta):
+        """Set the total and add the delta to the minute of the time stamp, O(1).
+           Minutes older than the ring holds only change the total"""
+        minute = timestamp_ns // MINUTE_NS
+        slot = minute % self.minute_count
+        self.__begin()
+        self.fields[TOTAL] = total
+        held = self.minutes[slot]
+        if held < minute:
+            self.minutes[slot] = minute
+            self.counts[slot] = delta
+        elif held == minute:
+            self.counts[slot] += delta
+        self.__end()
+
+    def load(self, total, timestamps_ns, deltas):
+        """Rewrite the state from every event, used when the counter's events are replaced"""
+        minute_numbers = np.asarray(timestamps_ns, dtype=np.int64) // MINUTE_NS
+        deltas = np.asarray(deltas)
+        self.__begin()
+        self.fields[TOTAL] = total
+        self.minutes[:] = -1
+        self.counts[:] = 0
+        if len(minute_numbers):
+            keep = minute_numbers > minute_numbers.max() - self.minute_count
+            unique_minutes, inverse = np.unique(minute_numbers[keep], return_inverse=True)
+            sums = np.bincount(inverse, weights=deltas[keep], minlength=len(unique_minutes))
+            self.minutes[unique_minutes % self.minute_count] = unique_minutes
+            self.counts[unique_minutes % self.minute_count] = sums.astype(np.int64)
+        self.__end()
+
+    def close(self, unlink=True):
+        """Close the segment, unlink removes it so readers see it is gone once they close it"""
+        self.fields = self.minutes = self.counts = None
+        self.memory.close()
+        written_names.discard(self.name)
+        if unlink:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __begin(self):
+        self.fields[SEQUENCE] += 1
+
+    def __end(self):
+        self.fields[UPDATED] = local_time_ns()
+        self.fields[SEQUENCE] += 1
+
+class LiveStateReader:
+    def __init__(self, name):
+        """Open a segment made by a LiveStateWriter, FileNotFoundError if the tracker is not running"""
+        self.name = name
+        self.memory = open_untracked(name)
+        magic, version, minute_count = HEADER.unpack_from(self.memory.buf, 0)
+        if magic != LIVE_MAGIC or version != LIVE_VERSION:
+            self.memory.close()
+            raise ValueError(f"{name} is not a version {LIVE_VERSION} live state")
+        self.minute_count = minute_count
+        self.fields, self.minutes, self.counts = map_arrays(self.memory.buf, minute_count)
+        # the snapshot is copied into these, so reading does not allocate
+        self.snapshot_minutes = np.empty(minute_count, dtype=np.int64)
+        self.snapshot_counts = np.empty(minute_count, dtype=np.int64)
+        self.sequence = None
+        self.total = 0
+        self.updated_ns = 0
+
+    def read(self, timeout=READ_TIMEOUT_SEC):
+        """Take a consistent snapshot into total, updated_ns, snapshot_minutes and snapshot_counts.
+           Returns the sequence number, it only changes when the state does.
+           TimeoutError if the writer stopped part way through a write"""
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = int(self.fields[SEQUENCE])
+            if sequence % 2 == 0:
+                total = int(self.fields[TOTAL])
+                updated_ns = int(self.fields[UPDATED])
+                np.copyto(self.snapshot_minutes, self.minutes)
+                np.copyto(self.snapshot_counts, self.counts)
+                if int(self.fields[SEQUENCE]) == sequence:
+                    self.sequence, self.total, self.updated_ns = sequence, total, updated_ns
+                    return sequence
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Live state {self.name} is stuck part way through a write")
+            time.sleep(0)
+
+    def changed(self):
+        """True if the state has changed since the last read, without taking a snapshot"""
+        return int(self.fields[SEQUENCE]) != self.sequence
+
+    def get_total_count(self):
+        """Return the Total Count"""
+        self.read()
+        return self.total
+
+    def get_minute_counts(self, now_ns=None):
+        """Array of the counts of the recent minutes, oldest first, the last one is the current minute"""
+        self.read()
+        now_minute = (local_time_ns() if now_ns is None else now_ns) // MINUTE_NS
+        wanted = np.arange(now_minute - self.minute_count + 1, now_minute + 1)
+        slots = wanted % self.minute_count
+        return np.where(self.snapshot_minutes[slots] == wanted, self.snapshot_counts[slots], 0)
+
+    def get_last_minute_count(self):
+        """returns the count of the previous minute"""
+        return int(self.get_minute_counts()[-2])
+
+    def get_rolling_count(self, minutes):
+        """Count of the last number of minutes, including the current minute, up to the minutes kept"""
+        return int(self.get_minute_counts()[-minutes:].sum())
+
+    def close(self):
+        self.fields = self.minutes = self.counts = None
+        self.memory.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='live_state.py', description='Print the live count from a running tracker')
+    parser.add_argument('-n', required=False, default='trick_default', help="Shared memory name, <prefix>_<site> of the tracker's -sh prefix")
+    parser.add_argument('-t', required=False, type=float, default=1, help="Seconds between prints")
+    args = parser.parse_args()
+
+    reader = LiveStateReader(args.n)
+    try:
+        while True:
+            minute_counts = reader.get_minute_counts()
+            print(f"{ns_to_datetime(reader.updated_ns):%H:%M:%S} Total: {reader.total} "
+                  f"Last Min: {minute_counts[-2]} Last Hour: {minute_counts.sum()}")
+            time.sleep(args.t)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
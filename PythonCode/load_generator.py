@@ -0,0 +1,241 @@
+# -----------------------------------------------------------
+# Synthetic load generator and replay harness. Button presses are
+#  sent through a real input path (in-process, MQTT through a local
+#  broker, or the serial radio interface on a loop:// port) following
+#  a Poisson, bursty or recorded arrival pattern into a tracker whose
+#  MQTT and Adafruit IO clients are stubbed out, and the harness
+#  reports the ingest rate, callback latency and lost presses
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Lock, Event
+from unittest import mock
+import argparse
+import contextlib
+import json
+import os
+import time
+import numpy as np
+
+from counter_group import DEFAULT_SITE
+from event_store import NS_PER_SEC
+
+LOAD_TOPIC = "Halloween/load/ButtonPress"
+DRAIN_TIMEOUT_SEC = 5
+SPIN_THRESHOLD_SEC = 0.001
+
+def poisson_arrivals(rate, count, rng=None):
+    """Send offsets in seconds for count presses arriving at random with an average rate per second"""
+    rng = np.random.default_rng() if rng is None else rng
+    return np.cumsum(rng.exponential(1 / rate, count))
+
+def bursty_arrivals(rate, count, burst_size=20, burst_speedup=50, rng=None):
+    """Send offsets for presses that come in bursts (a group at the door), the average rate is kept
+       burst_size - average presses in a burst
+       burst_speedup - how much faster the presses in a burst are than the average rate"""
+    rng = np.random.default_rng() if rng is None else rng
+    in_burst_gap = 1 / (rate * burst_speedup)
+    gaps = rng.exponential(in_burst_gap, count)
+    starts_burst = rng.random(count) < 1 / burst_size
+    # the quiet time between bursts makes up the rest of the average rate
+    quiet_gap = max(burst_size / rate - burst_size * in_burst_gap, 0)
+    gaps[starts_burst] += rng.exponential(quiet_gap, int(starts_burst.sum())) if quiet_gap else 0
+    return np.cumsum(gaps)
+
+def trace_arrivals(trace_file, speed=1.0):
+    """Send offsets replayed from a recorded raw CSV or Arrow history file, speed > 1 replays faster"""
+    if trace_file.endswith('.arrow'):
+        from history import HistoryStore
+        store = HistoryStore(os.path.dirname(trace_file) or '.')
+        year = int(os.path.basename(trace_file)[:4])
+        timestamps, deltas = store.load_year(year)
+    else:
+        from history import import_raw_csv
+        timestamps, deltas = import_raw_csv(trace_file)
+    presses = np.sort(timestamps[deltas > 0])
+    return (presses - presses[0]) / NS_PER_SEC / speed
+
+class StubMqtt:
+    """Stands in for the tracker's MQTT interface, each total count publish is passed to the harness.
+       Counts are not held back, so every press publishes"""
+    flush_window = 0
+    def __init__(self, harness, mqtt_config, message_callback, subscribe_list, *args, **kwargs):
+        self.harness = harness
+        self.message_callback = message_callback
+    def publish_state(self, topic, msg_data):
+        if topic == self.harness.count_topic:
+            self.harness.count_published()
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class StubAdafruitIo:
+    """Stands in for the Adafruit IO interface"""
+    def __init__(self, config, feed_list, *args, **kwargs):
+        pass
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class LoadHarness:
+    """A tracker with stubbed MQTT and Adafruit IO clients that takes the presses for a run through its dispatch,
+       the radio is on a loop:// port. Records when each press was counted"""
+    def __init__(self, expected):
+        import TrickOrTreaters
+        from serial_interface import TEST_PORT
+        self.count_topic = TrickOrTreaters.MQTT_PUBLISH_COUNT
+        self.lock = Lock()
+        self.receive_times = np.zeros(expected, dtype=np.int64)
+        self.received = 0
+        self.extra = 0
+        self.all_received = Event()
+        with mock.patch.object(TrickOrTreaters, 'mqtt', lambda *args, **kwargs: StubMqtt(self, *args, **kwargs)), \
+             mock.patch.object(TrickOrTreaters, 'adafruit_io_interface', StubAdafruitIo):
+            # every press is sent on purpose, none are bounces
+            self.tracker = TrickOrTreaters.TrickOrTreaterTracker({}, {}, TEST_PORT, show_graphs=False, debounce_sec=0)
+
+    def get_total_count(self):
+        """Presses the tracker counted"""
+        return self.tracker.counters.get_total_count()
+
+    def close(self):
+        """Stop the tracker's radio and counters"""
+        self.tracker.radios.exit()
+        self.tracker.counters.close()
+
+    def count_published(self):
+        """Called when the tracker publishes the count after a press, stamps the time the press was counted"""
+        now = time.perf_counter_ns()
+        with self.lock:
+            if self.received < len(self.receive_times):
+                self.receive_times[self.received] = now
+                self.received += 1
+                if self.received == len(self.receive_times):
+                    self.all_received.set()
+            else:
+                self.extra += 1
+
+class InProcessSource:
+    """Calls the tracker's dispatch directly, this measures the filter, counter and publish cost alone"""
+    name = 'inproc'
+    def __init__(self, harness, options):
+        from TrickOrTreaters import EVENT_COUNT, SOURCE_LOCAL
+        self.dispatch = harness.tracker.dispatch
+        self.event = EVENT_COUNT
+        self.source = SOURCE_LOCAL
+
+    def send(self):
+        self.dispatch(DEFAULT_SITE, self.event, self.source)
+
+    def close(self):
+        pass
+
+class MqttSource:
+    """Publishes presses to a local broker, they are received by a real mqtt interface that calls the tracker's callback"""
+    name = 'mqtt'
+    def __init__(self, harness, options):
+        from mqtt_interface import mqtt
+        with open(options.fm) as config_file:
+            mqtt_config = json.load(config_file)
+        self.receiver = mqtt(mqtt_config, harness.tracker.mqtt_interface.message_callback, [LOAD_TOPIC])
+        self.sender = mqtt(mqtt_config, None, [])
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SEC
+        while not (self.receiver.client.is_connected() and self.sender.client.is_connected()):
+            if time.monotonic() > deadline:
+                raise ConnectionError("Could not connect to the MQTT broker")
+            time.sleep(0.05)
+        # let the subscribe finish before the first press
+        time.sleep(0.5)
+
+    def send(self):
+        self.sender.client.publish(LOAD_TOPIC, 1)
+
+    def close(self):
+        self.sender.client.loop_stop()
+        self.receiver.client.loop_stop()
+        self.sender.client.disconnect()
+        self.receiver.client.disconnect()
+
+class SerialSource:
+    """Writes "Button: 1" lines to the tracker's loop:// radio port, like a RadioReceiver would"""
+    name = 'serial'
+    def __init__(self, harness, options):
+        self.radios = harness.tracker.radios
+
+    def send(self):
+        self.radios.send_data("Button: 1")
+
+    def close(self):
+        pass
+
+SOURCES = {source.name: source for source in [InProcessSource, MqttSource, SerialSource]}
+
+def run_load(source_class, offsets, options):
+    """Send a press at each offset through the source, returns a dictionary of results"""
+    count = len(offsets)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        harness = LoadHarness(count)
+        source = source_class(harness, options)
+        send_times = np.zeros(count, dtype=np.int64)
+        start = time.perf_counter()
+        for index, offset in enumerate(offsets.tolist()):
+            wait = start + offset - time.perf_counter()
+            if wait > SPIN_THRESHOLD_SEC:
+                time.sleep(wait)
+            send_times[index] = time.perf_counter_ns()
+            source.send()
+        send_elapsed = time.perf_counter() - start
+        harness.all_received.wait(DRAIN_TIMEOUT_SEC)
+        source.close()
+        counted = int(harness.get_total_count())
+        harness.close()
+
+    received = harness.received
+    # presses arrive in the order they were sent, so the n'th arrival is matched to the n'th send
+    latency_us = (harness.receive_times[:received] - send_times[:received]) / 1000
+    ingest_elapsed = (harness.receive_times[received - 1] - send_times[0]) / NS_PER_SEC if received else 0
+    return {'source': source_class.name,
+            'sent': count,
+            'received': received,
+            'dropped': count - received,
+            'duplicates': harness.extra,
+            'counted': counted,
+            'offered_rate': count / offsets[-1] if count and offsets[-1] > 0 else float('inf'),
+            'send_rate': count / send_elapsed if send_elapsed > 0 else float('inf'),
+            'ingest_rate': received / ingest_elapsed if ingest_elapsed > 0 else float('inf'),
+            'latency_p50_us': float(np.percentile(latency_us, 50)) if received else None,
+            'latency_p99_us': float(np.percentile(latency_us, 99)) if received else None,
+            'latency_max_us': float(latency_us.max()) if received else None}
+
+def make_offsets(options):
+    """Build the arrival offsets from the command line options"""
+    rng = np.random.default_rng(options.seed)
+    if options.arrivals == 'poisson':
+        return poisson_arrivals(options.rate, options.count, rng)
+    if options.arrivals == 'bursty':
+        return bursty_arrivals(options.rate, options.count, options.burst, rng=rng)
+    return trace_arrivals(options.trace, options.speed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='load_generator.py',
+                                     description='Drive presses through the input paths and measure throughput, latency and loss')
+    parser.add_argument('-s', '--source', choices=list(SOURCES), default='inproc', help="Input path to drive")
+    parser.add_argument('-a', '--arrivals', choices=['poisson', 'bursty', 'trace'], default='poisson', help="Arrival pattern")
+    parser.add_argument('-r', '--rate', type=float, default=2000, help="Average presses per second")
+    parser.add_argument('-n', '--count', type=int, default=20000, help="Number of presses")
+    parser.add_argument('-b', '--burst', type=int, default=20, help="Average presses per burst (bursty)")
+    parser.add_argument('-t', '--trace', default=None, help="Raw CSV or Arrow file to replay (trace)")
+    parser.add_argument('-x', '--speed', type=float, default=60, help="Replay speed up (trace)")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for repeatable runs")
+    parser.add_argument('-fm', default="mqtt_keys.json", help="Json Config File for the local MQTT broker (mqtt)")
+    parser.add_argument('-o', default=None, help="Save the results to this JSON file")
+    args = parser.parse_args()
+    if args.arrivals == 'trace' and args.trace is None:
+        parser.error("trace arrivals need a file, use -t")
+
+    results = run_load(SOURCES[args.source], make_offsets(args), args)
+    for name, value in results.items():
+        print(f"{name:>16}: {value:.1f}" if isinstance(value, float) else f"{name:>16}: {value}")
+    if args.o is not None:
+        with open(args.o, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
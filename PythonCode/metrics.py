@@ -0,0 +1,317 @@
+# -----------------------------------------------------------
+# Metrics for the tracker and its interfaces. Counters, gauges
+#  and latency histograms are kept in memory and served in the
+#  Prometheus text format from a small local HTTP server, which
+#  can also turn cProfile and tracemalloc on and off while the
+#  tracker is running
+#      /metrics                     - all the metrics
+#      /profile/start, /profile/stop - profile the event and report paths
+#      /memory/start, /memory/stop   - trace memory allocations
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Condition, local, get_ident
+import bisect
+import cProfile
+import io
+import logging
+import math
+import pstats
+import sys
+import tracemalloc
+
+HOST = "127.0.0.1"
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+PROFILE_TOP_COUNT = 30
+PROFILE_STOP_WAIT_SEC = 5
+# from Python 3.12 cProfile sees every thread and only one profile can be enabled at a time
+SHARED_PROFILE = sys.version_info >= (3, 12)
+
+def format_labels(label_names, label_values, extra=()):
+    """Prometheus label text like {source="radio",event="count"}, empty when there are no labels"""
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    text = ",".join(f'{name}="{str(value)}"'.replace('\n', ' ') for name, value in pairs)
+    return "{" + text + "}"
+
+class Counter:
+    """Value that only goes up, one value per set of label values"""
+    kind = 'counter'
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.values = dict()
+        self.function = None
+
+    def inc(self, *label_values, amount=1):
+        """Add to the value for the label values"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set_function(self, function):
+        """Read the values from function when the metrics are collected instead of keeping them here,
+           the function returns a number, or a dictionary of {label values tuple: number}"""
+        self.function = function
+
+    def get(self, *label_values):
+        """Current value for the label values"""
+        return self.__read().get(label_values, 0)
+
+    def samples(self):
+        """Lines of the metric in the Prometheus text format"""
+        return [f"{self.name}{format_labels(self.label_names, labels)} {value}"
+                for labels, value in sorted(self.__read().items())]
+
+    def __read(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception as err:
+                logging.warning("Metric %s could not be read: %s", self.name, err)
+                return dict()
+            return values if isinstance(values, dict) else {(): values}
+        with self.lock:
+            return dict(self.values)
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = 'gauge'
+    def set(self, value, *label_values):
+        """Set the value for the label values"""
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram:
+    """Count of the observed values in each bucket, plus their sum, used for latencies in seconds"""
+    kind = 'histogram'
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.values = dict()
+
+    def observe(self, value, *label_values):
+        """Add a value, the bucket is found with a binary search"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get_count(self, *label_values):
+        """Number of values observed for the label values"""
+        with self.lock:
+            entry = self.values.get(label_values)
+            return entry[2] if entry else 0
+
+    def samples(self):
+        """Lines of the metric in the Prometheus text format, the buckets are cumulative"""
+        with self.lock:
+            values = {labels: (list(entry[0]), entry[1], entry[2]) for labels, entry in self.values.items()}
+        lines = list()
+        for labels, (bucket_counts, total, count) in sorted(values.items()):
+            running = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), bucket_counts):
+                running += bucket_count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, [('le', le)])} {running}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        """Collection of metrics by name, asking for a name again returns the same metric"""
+        self.lock = Lock()
+        self.metrics = dict()
+
+    def counter(self, name, help_text, label_names=()):
+        return self.__get_or_create(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.__get_or_create(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.__get_or_create(Histogram, name, help_text, label_names, buckets)
+
+    def render(self):
+        """Every metric in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = list()
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def __get_or_create(self, metric_class, name, help_text, label_names, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, help_text, label_names, *args)
+            elif type(metric) is not metric_class:
+                raise ValueError(f"Metric {name} is already a {metric.kind}")
+            return metric
+
+REGISTRY = MetricsRegistry()
+
+class Profiler:
+    """cProfile toggle for the instrumented paths. The lock only guards turning the profiles on and off, the
+       profiled calls run side by side like they do when profiling is off. From Python 3.12 a profile sees
+       every thread and only one can be enabled, so one profile is on while any profiled call runs (cProfile
+       mixes up the cumulative times of calls that overlap in different threads, the call counts and own times hold).
+       Before that a profile only sees its own thread, each thread has one and they are added up at the end"""
+    def __init__(self):
+        self.lock = Condition()
+        self.active = False
+        # {thread ID: profile}, the one shared profile is under None
+        self.profiles = dict()
+        self.running_count = 0
+        self.call_count = 0
+        self.thread_state = local()
+
+    def start(self):
+        """Start profiling the calls made through run()"""
+        with self.lock:
+            self.profiles = dict()
+            self.call_count = 0
+            self.active = True
+
+    def stop(self, top_count=PROFILE_TOP_COUNT):
+        """Stop profiling, returns the report of the slowest functions by cumulative time.
+           Waits a moment for the profiled calls that are running to finish"""
+        with self.lock:
+            self.active = False
+            self.lock.wait_for(lambda: self.running_count == 0, PROFILE_STOP_WAIT_SEC)
+            profiles, self.profiles = list(self.profiles.values()), dict()
+            call_count = self.call_count
+        if call_count == 0 or not profiles:
+            return "No profiled calls\n"
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(top_count)
+        return output.getvalue()
+
+    def run(self, function, *args, **kwargs):
+        """Call the function, under the profile when profiling is on"""
+        # a profiled call that makes another one is already being profiled
+        if not self.active or getattr(self.thread_state, 'profiling', False):
+            return function(*args, **kwargs)
+        profile = self.__enter()
+        if profile is None:
+            return function(*args, **kwargs)
+        self.thread_state.profiling = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.thread_state.profiling = False
+            self.__exit(profile)
+
+    def __enter(self):
+        """Turn the profile of this call on, returns it or None if the call is not profiled"""
+        with self.lock:
+            if not self.active:
+                return None
+            key = None if SHARED_PROFILE else get_ident()
+            profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = cProfile.Profile()
+            if not SHARED_PROFILE or self.running_count == 0:
+                try:
+                    profile.enable()
+                except ValueError as err:
+                    # another profiler is running, like python -m cProfile
+                    logging.debug("Call not profiled: %s", err)
+                    return None
+            self.running_count += 1
+            self.call_count += 1
+            return profile
+
+    def __exit(self, profile):
+        """Turn the profile off once the last call using it is done"""
+        with self.lock:
+            self.running_count -= 1
+            if not SHARED_PROFILE or self.running_count == 0:
+                profile.disable()
+            self.lock.notify_all()
+
+PROFILER = Profiler()
+
+def start_memory_trace():
+    """Start tracing memory allocations"""
+    tracemalloc.start()
+    return "Memory tracing started\n"
+
+def stop_memory_trace(top_count=PROFILE_TOP_COUNT):
+    """Stop tracing memory allocations, returns the lines that allocated the most"""
+    if not tracemalloc.is_tracing():
+        return "Memory tracing is not running\n"
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lines = [f"Current {current} bytes, peak {peak} bytes"]
+    lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:top_count])
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    def __init__(self, port, registry=REGISTRY, profiler=PROFILER):
+        """Create the server on the local host, port 0 picks a free port, the chosen one is in self.port"""
+        self.registry = registry
+        self.profiler = profiler
+        self.routes = {'/metrics': self.registry.render,
+                       '/profile/start': self.__start_profile,
+                       '/profile/stop': self.profiler.stop,
+                       '/memory/start': start_memory_trace,
+                       '/memory/stop': stop_memory_trace}
+        self.server = ThreadingHTTPServer((HOST, port), self.__make_handler())
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self.thread = Thread(target=self.server.serve_forever, args=(), daemon=True, name='Metrics')
+        self.thread.start()
+        logging.info("Metrics on http://%s:%s/metrics", HOST, self.port)
+        return self
+
+    def stop(self):
+        """Stop the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __start_profile(self):
+        self.profiler.start()
+        return "Profiling started\n"
+
+    def __make_handler(self):
+        routes = self.routes
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                route = routes.get(self.path.split('?')[0])
+                if route is None:
+                    self.send_error(404)
+                    return
+                body = route().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+        return MetricsHandler
@@ -8,59 +8,181 @@
 # email dvanvolk@ieee.org
 # -----------------------------------------------------------
 from paho.mqtt import client as mqtt_client
+from collections import OrderedDict, deque
+from functools import partial
+from threading import Lock, Timer
 import random
 import logging
 import time
 import json
 
+from metrics import REGISTRY
+from event_store import NS_PER_SEC
+
 PORT = 1883
 FIRST_RECONNECT_DELAY = 1
 RECONNECT_RATE = 2
-MAX_RECONNECT_COUNT = 12
 MAX_RECONNECT_DELAY = 60
+DEFAULT_QOS = 0
+DEFAULT_RETAIN = True
+OFFLINE_QUEUE_SIZE = 1000
+FLUSH_WINDOW_SEC = 0.1
+
+MQTT_PUBLISHED = REGISTRY.counter('mqtt_publish_total', "MQTT publishes by result", ['result'])
+MQTT_RECEIVED = REGISTRY.counter('mqtt_received_total', "MQTT messages received")
+MQTT_RECONNECTS = REGISTRY.counter('mqtt_reconnect_total', "MQTT reconnect attempts by result", ['result'])
+MQTT_OFFLINE_QUEUE = REGISTRY.gauge('mqtt_offline_queue_depth', "MQTT messages waiting for the connection to come back")
+
+def start_timer(delay, function):
+    """Call function on a timer thread after delay seconds"""
+    timer = Timer(delay, function)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+class CoalescingPublisher:
+    def __init__(self, publish_function, window_sec = FLUSH_WINDOW_SEC, timer_function = start_timer):
+        """Sits in front of a publish function for values where only the latest one matters, like a count.
+           The first value for a topic after it has been quiet for a window is sent straight away, values that
+           come in within the window of the last send are held and only the latest is sent when the window ends
+           publish_function - called with (topic, value) to send a value
+           window_sec - shortest time between sends on a topic, 0 sends every value
+           timer_function - called with (delay, function) to call function later, an asyncio loop's call_later
+                            can be used so the sends happen on the loop's thread"""
+        self.publish_function = publish_function
+        self.window_ns = int(window_sec * NS_PER_SEC)
+        self.timer_function = timer_function
+        self.lock = Lock()
+        self.last_sent = dict()
+        self.pending = dict()
+        self.timer_deadline = None
+        self.stats = {'published': 0, 'immediate': 0, 'batched': 0, 'coalesced': 0}
+
+    def publish(self, topic, value):
+        """Send the value now if the topic has been quiet for a window, otherwise hold it for the end of the window"""
+        now = time.monotonic_ns()
+        with self.lock:
+            last = self.last_sent.get(topic)
+            if topic not in self.pending and (last is None or now - last >= self.window_ns):
+                self.stats['immediate'] += 1
+                self.__send(topic, value, now)
+                return
+            if topic in self.pending:
+                self.stats['coalesced'] += 1
+            self.pending[topic] = value
+            self.__start_timer(last + self.window_ns, now)
+
+    def flush(self, everything = True):
+        """Send the held values, everything=False only sends the ones whose window has ended"""
+        now = time.monotonic_ns()
+        with self.lock:
+            self.timer_deadline = None
+            for topic, value in list(self.pending.items()):
+                if everything or now - self.last_sent[topic] >= self.window_ns:
+                    del self.pending[topic]
+                    self.stats['batched'] += 1
+                    self.__send(topic, value, now)
+            if self.pending:
+                self.__start_timer(min(self.last_sent[topic] for topic in self.pending) + self.window_ns, now)
+
+    def set_timer_function(self, timer_function):
+        """Change how the end of a window is waited for, see __init__"""
+        self.timer_function = timer_function
+
+    def get_stats(self):
+        """Copy of the counters: published, sent straight away (immediate), sent at the end of a window (batched)
+           and values replaced by a newer one before they were sent (coalesced)"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.pending)
+            return stats
+
+    def __send(self, topic, value, now):
+        """Send the value, the lock is held by the caller so the values for a topic go out in order"""
+        self.last_sent[topic] = now
+        self.stats['published'] += 1
+        self.publish_function(topic, value)
+
+    def __start_timer(self, deadline, now):
+        """Flush at the deadline, unless a flush is already due before it"""
+        if self.timer_deadline is not None and self.timer_deadline <= deadline:
+            return
+        self.timer_deadline = deadline
+        self.timer_function(max(deadline - now, 0) / NS_PER_SEC, partial(self.flush, False))
+
+def match_topic(topic_filter, topic):
+    """Match a topic against a subscription filter that may use the '+' and '#' wildcards,
+       returns the list of topic levels matched by the wildcards, or None if the topic does not match"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    captured = list()
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            captured.append('/'.join(topic_levels[index:]))
+            return captured
+        if index >= len(topic_levels):
+            return None
+        if level == '+':
+            captured.append(topic_levels[index])
+        elif level != topic_levels[index]:
+            return None
+    if len(topic_levels) != len(filter_levels):
+        return None
+    return captured
 
 class mqtt:
-    def __init__(self, mqtt_config, message_callback, subscribe_list):
+    def __init__(self, mqtt_config, message_callback, subscribe_list, start_loop = True):
         """Init The Class, 
-           mqtt_config - dictionary, with MQTT Configuration information,broker,username,password
-           message_callback - Callback function for new messages, None if None, function takes the topic as an argument
-           subscribe_list - List of messages to subscribe to """
+           mqtt_config - dictionary, with MQTT Configuration information,broker,username,password and optionally
+                         qos (QoS of the publishes and subscriptions), retain (keep the last state value on the broker)
+                         queue_size (messages kept while offline) and flush_window (seconds between count
+                         publishes on a topic, see CoalescingPublisher)
+           message_callback - Callback function for new messages, None if None, function takes the topic and payload as arguments
+           subscribe_list - List of messages to subscribe to
+           start_loop - start paho's network thread, False when the owner drives the network loop and reconnects itself"""
         self.msg_cb = message_callback
         self.sub_list = subscribe_list
+        self.auto_reconnect = start_loop
+        self.qos = mqtt_config.get('qos', DEFAULT_QOS)
+        self.retain = mqtt_config.get('retain', DEFAULT_RETAIN)
+        self.queue_size = mqtt_config.get('queue_size', OFFLINE_QUEUE_SIZE)
+        self.flush_window = mqtt_config.get('flush_window', FLUSH_WINDOW_SEC)
+        # messages sent while offline, state values are kept by topic so only the latest one is sent
+        self.lock = Lock()
+        self.connected = False
+        self.was_connected = False
+        self.offline_events = deque()
+        self.offline_state = OrderedDict()
+        MQTT_OFFLINE_QUEUE.set_function(self.get_queue_depth)
         self.client = self.__connect_mqtt(mqtt_config.get('broker'), mqtt_config.get('username'), mqtt_config.get('password'))
-        self.client.loop_start()
+        if start_loop:
+            self.client.loop_start()
 
     def __on_connect(self, client, userdata, flags, rc):
         if rc == 0 and client.is_connected():
-            print("Connected to MQTT Broker!")
+            logging.info("Connected to MQTT Broker!")
+            if self.was_connected:
+                MQTT_RECONNECTS.inc('ok')
             for topic in self.sub_list:
-                client.subscribe(topic)
+                client.subscribe(topic, self.qos)
+            self.__flush_offline()
         else:
-            print(f'Failed to connect, return code {rc}')
+            logging.error("Failed to connect, return code %s", rc)
+
+    def __on_connect_fail(self, client, userdata):
+        MQTT_RECONNECTS.inc('failed')
+        logging.error("Connect to the MQTT Broker failed, retrying")
 
     def __on_disconnect(self, client, userdata, rc):
+        """paho's network thread reconnects by itself with a back off, so nothing waits in here"""
+        with self.lock:
+            self.connected = False
         logging.info("Disconnected with result code: %s", rc)
-        reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-        while reconnect_count < MAX_RECONNECT_COUNT:
-            logging.info("Reconnecting in %d seconds...", reconnect_delay)
-            time.sleep(reconnect_delay)
-
-            try:
-                client.reconnect()
-                logging.info("Reconnected successfully!")
-                return
-            except Exception as err:
-                logging.error("%s. Reconnect failed. Retrying...", err)
-
-            reconnect_delay *= RECONNECT_RATE
-            reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-            reconnect_count += 1
-        logging.info("Reconnect failed after %s attempts. Exiting...", reconnect_count)
-        
 
     def __on_message(self, client, userdata, msg):
+        MQTT_RECEIVED.inc()
         if self.msg_cb is not None:
-            self.msg_cb( msg.topic )
+            self.msg_cb( msg.topic, msg.payload )
         # print(f'Received `{msg.payload.decode()}` from `{msg.topic}` topic')
 
     def __connect_mqtt(self, broker, username, password):
@@ -68,20 +190,81 @@ class mqtt:
         client = mqtt_client.Client(client_id)
         client.username_pw_set(username, password)
         client.on_connect = self.__on_connect
+        client.on_connect_fail = self.__on_connect_fail
         client.on_message = self.__on_message
-        client.connect(broker, PORT, keepalive=120)
         client.on_disconnect = self.__on_disconnect
+        client.reconnect_delay_set(FIRST_RECONNECT_DELAY, MAX_RECONNECT_DELAY)
+        # the network thread (or the owner's network loop) makes the first connection too,
+        #  so a broker that is down at start up is retried and nothing waits on it here
+        client.connect_async(broker, PORT, keepalive=120)
         return client
-    
-    def publish(self, topic, msg_data):
-        if self.client.is_connected():
-            result = self.client.publish(topic, msg_data)
+
+    def publish(self, topic, msg_data, qos = None, retain = False):
+        """Publish a message, while offline it is queued and sent when the connection comes back,
+           when the queue is full the oldest message is dropped"""
+        qos = self.qos if qos is None else qos
+        with self.lock:
+            self.__send(topic, msg_data, qos, retain, False)
+
+    def publish_state(self, topic, msg_data):
+        """Publish the current value of something, like a count. It is retained on the broker (unless retain is
+           turned off in the config) so a device that connects later gets it straight away,
+           while offline only the latest value for each topic is kept"""
+        with self.lock:
+            self.__send(topic, msg_data, self.qos, self.retain, True)
+
+    def get_queue_depth(self):
+        """Number of messages waiting to be sent"""
+        with self.lock:
+            return len(self.offline_events) + len(self.offline_state)
+
+    def __flush_offline(self):
+        """Send the messages queued while offline, called from on_connect"""
+        with self.lock:
+            self.connected = True
+            self.was_connected = True
+            events = list(self.offline_events)
+            states = list(self.offline_state.items())
+            self.offline_events.clear()
+            self.offline_state.clear()
+            for topic, msg_data, qos, retain in events:
+                self.__send(topic, msg_data, qos, retain, False)
+            for topic, msg_data in states:
+                self.__send(topic, msg_data, self.qos, self.retain, True)
+            if events or states:
+                logging.info("Sent %s messages queued while offline", len(events) + len(states))
+
+    def __send(self, topic, msg_data, qos, retain, state):
+        """Publish now if connected, otherwise queue the message, the lock is held by the caller"""
+        if self.connected:
+            result = self.client.publish(topic, msg_data, qos, retain)
             # result: [0, 1]
             status = result[0]
             if status == 0:
-                print(f'Send `{msg_data}` to topic `{topic}`')
-            else:
-                print(f'Failed to send message to topic {topic}')
-        else:
-            logging.error("publish: MQTT client is not connected!")
+                MQTT_PUBLISHED.inc('ok')
+                logging.debug("Send `%s` to topic `%s`", msg_data, topic)
+                return
+            if status != mqtt_client.MQTT_ERR_NO_CONN:
+                MQTT_PUBLISHED.inc('failed')
+                logging.warning("Failed to send message to topic %s", topic)
+                return
+            # the connection dropped before on_disconnect was called
+            self.connected = False
+        self.__queue(topic, msg_data, qos, retain, state)
 
+    def __queue(self, topic, msg_data, qos, retain, state):
+        """Keep a message until the connection comes back, state values replace the one queued for the topic"""
+        if state:
+            if topic in self.offline_state:
+                MQTT_PUBLISHED.inc('coalesced')
+                self.offline_state.move_to_end(topic)
+            elif len(self.offline_state) >= self.queue_size:
+                self.offline_state.popitem(last=False)
+                MQTT_PUBLISHED.inc('dropped')
+            self.offline_state[topic] = msg_data
+        else:
+            if len(self.offline_events) >= self.queue_size:
+                self.offline_events.popleft()
+                MQTT_PUBLISHED.inc('dropped')
+            self.offline_events.append((topic, msg_data, qos, retain))
+        MQTT_PUBLISHED.inc('queued')
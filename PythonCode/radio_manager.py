@@ -0,0 +1,332 @@
+# -----------------------------------------------------------
+# Manager for several RadioReceiver dongles. Every serial port is
+#  read from one thread, ports that can be selected on (a real port
+#  on Linux or macOS) wake it up with a selector and the others
+#  (Windows COM ports, loop://) are polled. Each radio's heartbeat
+#  age and packet rate is tracked, and a port that fails is closed
+#  and reopened with a back off while the other radios keep counting
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from collections import deque
+from functools import partial
+from threading import Thread, Lock
+import logging
+import selectors
+import socket
+import time
+
+from serial_interface import RadioProtocolHandler, PolledSerial, open_port, TEST_PORT, FRAME_SOURCES
+from metrics import REGISTRY
+
+POLL_SEC = 0.01
+IDLE_WAKE_SEC = 1
+HEALTH_SAMPLE_SEC = 1
+RATE_WINDOW_SEC = 60
+# the remote buttons send a heartbeat every 30 seconds, three missed beats is a problem
+HEART_TIMEOUT_SEC = 90
+FIRST_REOPEN_DELAY = 1
+REOPEN_RATE = 2
+MAX_REOPEN_DELAY = 60
+# a port that has had a heartbeat or stayed open this long is working again, its reopen delay starts over
+STABLE_SEC = MAX_REOPEN_DELAY
+# a port that is ready to read over and over with nothing to read has gone away
+MAX_EMPTY_READS = 100
+
+STATE_UP = 'up'
+STATE_DOWN = 'down'
+
+RADIO_REOPENS = REGISTRY.counter('radio_reopen_total', "Radio port reopen attempts by result", ['radio', 'result'])
+
+class RadioLink:
+    """One radio's port, parser and health, the protocol handler is kept when the port is reopened"""
+    def __init__(self, name, port, button_callbacks, heart_callback, binary):
+        self.name = name
+        self.port = port
+        self.protocol = RadioProtocolHandler(binary)
+        self.protocol.set_button_callback(button_callbacks)
+        self.protocol.set_heart_callback(partial(self.__heart, heart_callback))
+        self.transport = None
+        self.fileno = None
+        self.state = STATE_DOWN
+        self.last_error = None
+        self.reopen_delay = FIRST_REOPEN_DELAY
+        self.next_open = 0
+        self.empty_reads = 0
+        self.last_heart = None
+        self.stale_logged = False
+        self.opened_at = None
+        # (monotonic time, packets) taken every HEALTH_SAMPLE_SEC for the packet rate
+        self.samples = deque(maxlen=RATE_WINDOW_SEC // HEALTH_SAMPLE_SEC + 1)
+
+    def open(self):
+        """Open the port, returns the file number to select on or None if it has to be polled"""
+        self.protocol.buffer.clear()
+        self.transport = PolledSerial(open_port(self.port), lambda: self.protocol)
+        self.state = STATE_UP
+        self.empty_reads = 0
+        self.opened_at = time.monotonic()
+        try:
+            self.fileno = self.transport.serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.fileno = None
+        return self.fileno
+
+    def close(self):
+        """Close the port, errors from a port that has already gone away are ignored"""
+        if self.transport is None:
+            return
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+        self.transport = None
+        self.fileno = None
+
+    def packet_count(self):
+        stats = self.protocol.stats
+        return stats['buttons'] + stats['hearts']
+
+    def is_stable(self, now):
+        """True once the open port has had a heartbeat or stayed open for STABLE_SEC"""
+        if self.state != STATE_UP or self.opened_at is None:
+            return False
+        return (self.last_heart is not None and self.last_heart >= self.opened_at) or now - self.opened_at >= STABLE_SEC
+
+    def take_sample(self, now):
+        self.samples.append((now, self.packet_count()))
+
+    def health(self, now):
+        """Dictionary of the radio's state, heartbeat age and packets per minute"""
+        packet_rate = 0.0
+        if len(self.samples) > 1:
+            (first_time, first_count), (last_time, last_count) = self.samples[0], self.samples[-1]
+            if last_time > first_time:
+                packet_rate = (last_count - first_count) * 60 / (last_time - first_time)
+        # no heartbeat yet counts from when the port was opened
+        since = self.last_heart if self.last_heart is not None else self.opened_at
+        return {'port': self.port,
+                'state': self.state,
+                'heartbeat_age': None if since is None else round(now - since, 1),
+                'stale': since is not None and now - since > HEART_TIMEOUT_SEC,
+                'packets_per_min': round(packet_rate, 1),
+                'last_error': self.last_error}
+
+    def __heart(self, heart_callback):
+        self.last_heart = time.monotonic()
+        self.stale_logged = False
+        if heart_callback is not None:
+            heart_callback()
+
+class RadioManager:
+    def __init__(self):
+        """Owns the radio ports, add them with add() then read them with start() or by calling poll()"""
+        self.lock = Lock()
+        self.links = dict()
+        self.selector = selectors.DefaultSelector()
+        # written to wake the reader when a port is added or it is stopped
+        self.wake_read, self.wake_write = socket.socketpair()
+        self.wake_read.setblocking(False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+        self.running = False
+        self.thread = None
+        self.next_sample = 0
+        FRAME_SOURCES.add(self)
+        REGISTRY.gauge('radio_up', "1 if the radio's port is open", ['radio']).set_function(
+            lambda: {(name,): int(health['state'] == STATE_UP) for name, health in self.get_health().items()})
+        REGISTRY.gauge('radio_heartbeat_age_seconds', "Seconds since the last heartbeat from the radio", ['radio']).set_function(
+            lambda: {(name,): health['heartbeat_age'] for name, health in self.get_health().items()
+                     if health['heartbeat_age'] is not None})
+        REGISTRY.gauge('radio_packets_per_minute', "Buttons and heartbeats from the radio per minute", ['radio']).set_function(
+            lambda: {(name,): health['packets_per_min'] for name, health in self.get_health().items()})
+
+    def add(self, port=TEST_PORT, button_callbacks = list(), heart_callback = None, binary=False, name=None):
+        """Add a radio and open its port, a port that will not open is retried by the reader
+           name - name for the radio in the stats, defaults to the port
+           returns the name"""
+        with self.lock:
+            name = self.__unique_name(name or port)
+            link = RadioLink(name, port, button_callbacks, heart_callback, binary)
+            self.links[name] = link
+            self.__open(link, time.monotonic())
+        self.__wake()
+        return name
+
+    def names(self):
+        """Names of the radios"""
+        with self.lock:
+            return list(self.links)
+
+    def get_protocol(self, name):
+        """The protocol handler of a radio, its packet is the (sender, seq) of the packet being handled"""
+        return self.links[name].protocol
+
+    def start(self):
+        """Read the ports on a background thread"""
+        self.running = True
+        self.thread = Thread(target=self.__reader_thread, args=(), daemon=True, name='Radios')
+        self.thread.start()
+        logging.info("Start Radio Manager")
+        return self
+
+    def poll(self):
+        """Read whatever is waiting on every port without blocking, used in place of start() from an event loop.
+           Returns the number of bytes read"""
+        with self.lock:
+            links = [link for link in self.links.values() if link.state == STATE_UP]
+        read_count = sum(self.__read(link, False) for link in links)
+        self.__maintain()
+        return read_count
+
+    def send_data(self, write_data, name=None):
+        """Send a line out a radio's port, None sends it out every open port"""
+        with self.lock:
+            links = list(self.links.values()) if name is None else [self.links[name]]
+        for link in links:
+            if link.state != STATE_UP:
+                continue
+            try:
+                link.protocol.write_line(write_data)
+            except Exception as err:
+                logging.warning("Radio %s could not send: %s", link.name, err)
+
+    def get_stats(self):
+        """Parser counters added up over every radio"""
+        totals = dict()
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            for kind, value in link.protocol.get_stats().items():
+                totals[kind] = totals.get(kind, 0) + value
+        return totals
+
+    def get_health(self):
+        """{radio name: health}, see RadioLink.health"""
+        now = time.monotonic()
+        with self.lock:
+            return {name: link.health(now) for name, link in self.links.items()}
+
+    def exit(self):
+        """Stop the reader and close every port"""
+        self.running = False
+        self.__wake()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            for link in self.links.values():
+                link.close()
+        self.selector.close()
+        self.wake_read.close()
+        self.wake_write.close()
+
+    def __reader_thread(self):
+        """Wait for a selectable port to have data, or poll the others, then handle the health and reopens"""
+        while self.running:
+            with self.lock:
+                polled = [link for link in self.links.values() if link.state == STATE_UP and link.fileno is None]
+            timeout = POLL_SEC if polled else min(IDLE_WAKE_SEC, self.__time_to_next_open())
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self.__drain_wake()
+                else:
+                    self.__read(key.data, True)
+            for link in polled:
+                self.__read(link, False)
+            self.__maintain()
+
+    def __read(self, link, ready):
+        """Read the link's port, a port that fails is closed and queued to be reopened. Returns the bytes read
+           ready - the selector said there is data, a port that keeps saying so with nothing to read has gone away"""
+        try:
+            read_count = link.transport.poll()
+            if ready and not read_count:
+                link.empty_reads += 1
+                if link.empty_reads > MAX_EMPTY_READS:
+                    raise OSError("port is ready but has no data")
+            else:
+                link.empty_reads = 0
+            return read_count
+        except Exception as err:
+            with self.lock:
+                self.__fail(link, err, time.monotonic())
+            return 0
+
+    def __maintain(self):
+        """Reopen the ports that are due and take the health samples"""
+        now = time.monotonic()
+        with self.lock:
+            for link in self.links.values():
+                if link.state == STATE_DOWN and now >= link.next_open:
+                    self.__open(link, now)
+                elif link.reopen_delay != FIRST_REOPEN_DELAY and link.is_stable(now):
+                    link.reopen_delay = FIRST_REOPEN_DELAY
+            if now >= self.next_sample:
+                self.next_sample = now + HEALTH_SAMPLE_SEC
+                for link in self.links.values():
+                    link.take_sample(now)
+                    if link.health(now)['stale'] and not link.stale_logged:
+                        link.stale_logged = True
+                        logging.warning("Radio %s has not had a heartbeat for %s seconds", link.name, HEART_TIMEOUT_SEC)
+
+    def __open(self, link, now):
+        """Open the link's port, the lock is held by the caller"""
+        try:
+            fileno = link.open()
+        except Exception as err:
+            RADIO_REOPENS.inc(link.name, 'failed')
+            link.close()
+            self.__schedule_reopen(link, err, now)
+            return
+        if fileno is not None:
+            self.selector.register(fileno, selectors.EVENT_READ, link)
+        if link.last_error is not None:
+            RADIO_REOPENS.inc(link.name, 'ok')
+            logging.info("Radio %s reopened", link.name)
+        link.last_error = None
+
+    def __fail(self, link, err, now):
+        """Close a port that failed, the lock is held by the caller"""
+        if link.state != STATE_UP:
+            return
+        logging.warning("Radio %s lost: %s", link.name, err)
+        if link.fileno is not None:
+            try:
+                self.selector.unregister(link.fileno)
+            except (KeyError, ValueError, OSError):
+                pass
+        link.close()
+        self.__schedule_reopen(link, err, now)
+
+    def __schedule_reopen(self, link, err, now):
+        link.state = STATE_DOWN
+        link.last_error = str(err)
+        link.next_open = now + link.reopen_delay
+        logging.info("Radio %s will be reopened in %s seconds", link.name, link.reopen_delay)
+        link.reopen_delay = min(link.reopen_delay * REOPEN_RATE, MAX_REOPEN_DELAY)
+
+    def __time_to_next_open(self):
+        with self.lock:
+            due = [link.next_open for link in self.links.values() if link.state == STATE_DOWN]
+        return max(min(due) - time.monotonic(), 0) if due else IDLE_WAKE_SEC
+
+    def __unique_name(self, name):
+        """The same port can be added more than once in testing, later ones get a number"""
+        unique, number = name, 2
+        while unique in self.links:
+            unique, number = f"{name}#{number}", number + 1
+        return unique
+
+    def __wake(self):
+        try:
+            self.wake_write.send(b'\0')
+        except OSError:
+            pass
+
+    def __drain_wake(self):
+        try:
+            while self.wake_read.recv(256):
+                pass
+        except (BlockingIOError, OSError):
+            pass
@@ -0,0 +1,282 @@
+# -----------------------------------------------------------
+# Ring buffered time bucket counters, used to keep the per minute
+#  and per 15 minute counts up to date as events come in, so the
+#  reports are a lookup instead of a resample of the whole history.
+#  CountIndex keeps the recent minutes in a Fenwick tree and the
+#  compacted ones in a sorted array, so the count of any time range,
+#  and the busiest 15 minutes, are a quick lookup
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+import heapq
+import numpy as np
+
+from event_store import NS_PER_SEC
+
+MINUTE_NS = 60 * NS_PER_SEC
+FIFTEEN_MIN_NS = 15 * MINUTE_NS
+HOUR_NS = 60 * MINUTE_NS
+INDEX_START_BUCKETS = 24 * 60
+# busiest compacted windows kept ready for top_windows, asking for more works them out from the fixed buckets
+FIXED_TOP_WINDOWS = 96
+
+class RollupRing:
+    """Fixed number of time buckets of equal width, each slot remembers which bucket it holds
+    so a slot is reset when the ring wraps around to a newer bucket"""
+    def __init__(self, bucket_ns, bucket_count):
+        self.bucket_ns = bucket_ns
+        self.bucket_count = bucket_count
+        self.bucket_ids = [-1] * bucket_count
+        self.counts = [0] * bucket_count
+
+    def bucket_of(self, timestamp_ns):
+        """Return the bucket number a time stamp falls into"""
+        return timestamp_ns // self.bucket_ns
+
+    def add(self, timestamp_ns, delta):
+        """Add the delta to the bucket holding the time stamp, O(1)
+        Events older than the ring can hold are ignored"""
+        bucket = timestamp_ns // self.bucket_ns
+        slot = bucket % self.bucket_count
+        held = self.bucket_ids[slot]
+        if held != bucket:
+            if held > bucket:
+                return
+            self.bucket_ids[slot] = bucket
+            self.counts[slot] = 0
+        self.counts[slot] += delta
+
+    def add_many(self, timestamps_ns, deltas):
+        """Add a block of events, the buckets are summed in one vectorized pass"""
+        if len(timestamps_ns) == 0:
+            return
+        buckets = np.asarray(timestamps_ns, dtype=np.int64) // self.bucket_ns
+        keep = buckets > buckets.max() - self.bucket_count
+        unique_buckets, inverse = np.unique(buckets[keep], return_inverse=True)
+        sums = np.bincount(inverse, weights=np.asarray(deltas)[keep], minlength=len(unique_buckets))
+        for bucket, total in zip(unique_buckets.tolist(), sums.astype(np.int64).tolist()):
+            self.add(bucket * self.bucket_ns, total)
+
+    def get(self, bucket):
+        """Return the count of a bucket, zero if nothing was seen or it has left the ring"""
+        slot = bucket % self.bucket_count
+        if self.bucket_ids[slot] == bucket:
+            return self.counts[slot]
+        return 0
+
+    def clear(self):
+        """Forget all buckets"""
+        self.bucket_ids = [-1] * self.bucket_count
+        self.counts = [0] * self.bucket_count
+
+class FenwickTree:
+    """Binary indexed tree over bucket counts, adding to a bucket and summing the buckets before an index are O(log n)"""
+    def __init__(self, counts=()):
+        self.size = len(counts)
+        tree = [0] + list(counts)
+        # build in O(n), each node passes its sum on to its parent
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def add(self, index, delta):
+        """Add the delta to a bucket"""
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """Sum of the buckets before the index"""
+        total = 0
+        index = min(index, self.size)
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def range_sum(self, first, last):
+        """Sum of the buckets first to last - 1"""
+        return self.prefix(last) - self.prefix(max(first, 0))
+
+class CountIndex:
+    """Minute buckets of the events in a Fenwick tree for range counts, plus the count of each 15 minute
+    window with a max heap to find the busiest ones. Old heap entries are skipped when they reach the top,
+    a window's entry is current if its count still matches.
+    Buckets before the fixed point (the compacted events, see add_many) do not change any more, they are kept
+    as running totals in a sorted array so the tree only spans the minutes after it. The windows before it
+    leave the dictionary and heap, only the busiest of them are kept, so those only hold the recent windows.
+    Before the folded point the fixed buckets are summed into one per window"""
+    def __init__(self, bucket_ns=MINUTE_NS, window_ns=FIFTEEN_MIN_NS):
+        self.bucket_ns = bucket_ns
+        self.window_ns = window_ns
+        self.clear()
+
+    def clear(self):
+        """Forget all events"""
+        self.bucket_counts = dict()
+        self.origin = 0
+        self.tree = FenwickTree()
+        # bucket numbers before fixed_before, and fixed_totals[i] the sum of the first i of them
+        self.fixed_before = 0
+        self.fixed_buckets = np.zeros(0, dtype=np.int64)
+        self.fixed_totals = np.zeros(1, dtype=np.int64)
+        self.folded_before = 0
+        # windows before fixed_window are all fixed buckets, the busiest of them as (window, count)
+        self.fixed_window = 0
+        self.fixed_top = list()
+        self.window_counts = dict()
+        self.window_heap = list()
+
+    def add(self, timestamp_ns, delta):
+        """Add an event, O(log n)"""
+        bucket = timestamp_ns // self.bucket_ns
+        self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + delta
+        if self.origin <= bucket < self.origin + self.tree.size:
+            self.tree.add(bucket - self.origin, delta)
+        else:
+            self.__rebuild_tree()
+        window = timestamp_ns // self.window_ns
+        if window < self.fixed_window:
+            # counted in the fixed buckets by the rebuild above
+            return
+        count = self.window_counts.get(window, 0) + delta
+        self.window_counts[window] = count
+        heapq.heappush(self.window_heap, (-count, window))
+        if len(self.window_heap) > 2 * len(self.window_counts) + 64:
+            self.__rebuild_heap()
+
+    def add_many(self, timestamps_ns, deltas, fixed_before_ns=None, folded_before_ns=None):
+        """Add a block of events, the buckets are summed in one vectorized pass and the tree is built once
+           fixed_before_ns - the events before this time will not change, their buckets move out of the tree
+           folded_before_ns - the events before this time are only counted to the window, like the events
+                              compacted to 15 minutes. Their fixed buckets are summed into one per window"""
+        if fixed_before_ns is not None:
+            self.fixed_before = max(self.fixed_before, fixed_before_ns // self.bucket_ns)
+        if folded_before_ns is not None:
+            self.folded_before = max(self.folded_before, folded_before_ns // self.window_ns * self.window_ns // self.bucket_ns)
+        if len(timestamps_ns) == 0:
+            return
+        timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+        deltas = np.asarray(deltas, dtype=np.int64)
+        for counts, unit in [(self.bucket_counts, self.bucket_ns), (self.window_counts, self.window_ns)]:
+            keys, inverse = np.unique(timestamps // unit, return_inverse=True)
+            sums = np.bincount(inverse, weights=deltas, minlength=len(keys)).round().astype(np.int64)
+            for key, total in zip(keys.tolist(), sums.tolist()):
+                counts[key] = counts.get(key, 0) + total
+        self.__rebuild_tree()
+        self.__rebuild_heap()
+
+    def count_between(self, start_ns, end_ns):
+        """Count of the events with start <= time < end, to the minute: the minutes holding start and end - 1 are counted whole"""
+        first = start_ns // self.bucket_ns
+        last = (end_ns - 1) // self.bucket_ns + 1
+        if last <= first:
+            return 0
+        count = self.tree.range_sum(first - self.origin, last - self.origin)
+        if first < self.fixed_before and len(self.fixed_buckets):
+            low, high = np.searchsorted(self.fixed_buckets, [first, last])
+            count += int(self.fixed_totals[high] - self.fixed_totals[low])
+        return count
+
+    def first_bucket(self):
+        """Bucket number of the oldest event, None if there are none"""
+        if len(self.fixed_buckets):
+            return int(self.fixed_buckets[0])
+        return self.origin if self.bucket_counts else None
+
+    def rolling_count(self, window_ns, now_ns):
+        """Count of the events in the window that ends with the minute holding now"""
+        end_ns = (now_ns // self.bucket_ns + 1) * self.bucket_ns
+        return self.count_between(end_ns - window_ns, end_ns)
+
+    def top_windows(self, count=1):
+        """The busiest 15 minute windows as a list of (window start ns, count), busiest first"""
+        found = self.__top_live_windows(count)
+        fixed = self.fixed_top[:count] if count <= FIXED_TOP_WINDOWS else self.__busiest_fixed_windows(count)
+        busiest = sorted(found + fixed, key=lambda item: (-item[1], item[0]))[:count]
+        return [(window * self.window_ns, window_count) for window, window_count in busiest]
+
+    def all_window_counts(self):
+        """The count of every window as {window number: count}, the fixed windows are worked out from their buckets"""
+        windows, counts = self.__fixed_window_counts()
+        all_counts = dict(zip(windows.tolist(), counts.tolist()))
+        all_counts.update(self.window_counts)
+        return all_counts
+
+    def __top_live_windows(self, count):
+        """The busiest windows in the heap as a list of (window, count)"""
+        found = list()
+        seen = set()
+        while self.window_heap and len(found) < count:
+            negative_count, window = heapq.heappop(self.window_heap)
+            if window in seen or self.window_counts.get(window) != -negative_count:
+                continue
+            if negative_count >= 0:
+                # no window with a count above zero is left
+                heapq.heappush(self.window_heap, (negative_count, window))
+                break
+            seen.add(window)
+            found.append((window, -negative_count))
+        for window, window_count in found:
+            heapq.heappush(self.window_heap, (-window_count, window))
+        return found
+
+    def __fixed_window_counts(self):
+        """(window numbers, counts) of the windows before fixed_window, from the fixed buckets"""
+        windows = self.fixed_buckets * self.bucket_ns // self.window_ns
+        fixed = windows < self.fixed_window
+        windows, inverse = np.unique(windows[fixed], return_inverse=True)
+        counts = np.bincount(inverse, weights=np.diff(self.fixed_totals)[fixed], minlength=len(windows)).round().astype(np.int64)
+        return windows, counts
+
+    def __busiest_fixed_windows(self, count):
+        """The busiest fixed windows with a count above zero as a list of (window, count)"""
+        windows, counts = self.__fixed_window_counts()
+        busy = counts > 0
+        windows, counts = windows[busy], counts[busy]
+        order = np.lexsort((windows, -counts))[:count]
+        return list(zip(windows[order].tolist(), counts[order].tolist()))
+
+    def __rebuild_tree(self):
+        """Move the buckets before the fixed point into the fixed array, folding the ones before the folded point
+        into their window, and lay the tree out again over the rest with room for the events that come after the
+        last one. The windows that are now all fixed buckets leave the dictionary and heap"""
+        fixed = [bucket for bucket in self.bucket_counts if bucket < self.fixed_before]
+        window_buckets = self.window_ns // self.bucket_ns
+        folded_before = min(self.folded_before, self.fixed_before)
+        unfolded = np.count_nonzero(self.fixed_buckets[self.fixed_buckets < folded_before] % window_buckets)
+        if fixed or unfolded:
+            buckets = np.concatenate([self.fixed_buckets, np.array(fixed, dtype=np.int64)])
+            counts = np.concatenate([np.diff(self.fixed_totals), [self.bucket_counts.pop(bucket) for bucket in fixed]])
+            buckets = np.where(buckets < folded_before, buckets - buckets % window_buckets, buckets)
+            buckets, inverse = np.unique(buckets, return_inverse=True)
+            sums = np.bincount(inverse, weights=counts, minlength=len(buckets)).round().astype(np.int64)
+            self.fixed_buckets = buckets
+            self.fixed_totals = np.concatenate([[0], np.cumsum(sums)])
+        fixed_window = self.fixed_before * self.bucket_ns // self.window_ns
+        if fixed or fixed_window != self.fixed_window:
+            self.fixed_window = fixed_window
+            self.fixed_top = self.__busiest_fixed_windows(FIXED_TOP_WINDOWS)
+            old_windows = [window for window in self.window_counts if window < fixed_window]
+            for window in old_windows:
+                del self.window_counts[window]
+            if old_windows:
+                self.__rebuild_heap()
+        first = min(self.bucket_counts, default=self.fixed_before)
+        last = max(self.bucket_counts, default=first)
+        size = max(INDEX_START_BUCKETS, 2 * (last - first + 1))
+        counts = [0] * size
+        for bucket, bucket_count in self.bucket_counts.items():
+            counts[bucket - first] = bucket_count
+        self.origin = first
+        self.tree = FenwickTree(counts)
+
+    def __rebuild_heap(self):
+        """Drop the old heap entries"""
+        self.window_heap = [(-window_count, window) for window, window_count in self.window_counts.items()]
+        heapq.heapify(self.window_heap)
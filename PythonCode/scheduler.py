@@ -0,0 +1,171 @@
+# -----------------------------------------------------------
+# Scheduler for the repeating jobs, like the count report. Ticks
+#  line up with the wall clock (a 60 second job runs at the top
+#  of each minute) but are timed on the monotonic clock, so they
+#  do not drift and intervals under a second work. Each job runs
+#  on its own worker thread so a slow job never holds up the next
+#  tick, ticks missed while a job is busy are coalesced into one
+#  run or caught up one by one
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Lock
+import logging
+import time
+
+from event_store import local_time_ns, NS_PER_SEC
+from metrics import REGISTRY
+
+# a difference this big between the wall and monotonic clocks means the wall clock was changed
+CLOCK_JUMP_NS = NS_PER_SEC
+MAX_BACKLOG = 100
+
+SCHEDULER_DRIFT = REGISTRY.histogram('scheduler_drift_seconds', "How long after its tick each job run started", ['job'])
+SCHEDULER_TICKS = REGISTRY.counter('scheduler_ticks_total', "Job ticks by what was done with them", ['job', 'result'])
+
+class WallClockTicks:
+    """Tick times on the boundaries of the local wall clock, turned into monotonic clock deadlines.
+       Tick n is at n * interval + offset on the wall clock"""
+    def __init__(self, interval_sec, offset_sec=0):
+        self.interval_ns = int(round(interval_sec * NS_PER_SEC))
+        if self.interval_ns <= 0:
+            raise ValueError("The interval must be more than zero")
+        self.offset_ns = int(round(offset_sec * NS_PER_SEC))
+        self.__anchor()
+
+    def next_deadline(self):
+        """Monotonic time in ns of the next tick"""
+        return self.mono_anchor + self.next_index * self.interval_ns + self.offset_ns - self.wall_anchor
+
+    def seconds_until_next(self):
+        """Seconds to wait for the next tick, 0 if it is already due"""
+        return max(0, self.next_deadline() - time.monotonic_ns()) / NS_PER_SEC
+
+    def take_due(self, now_mono_ns, limit=MAX_BACKLOG):
+        """Return (deadlines, skipped), the deadlines of the last limit ticks due at or before now
+           and how many due ticks were older than those. The next tick moves past them all"""
+        if self.next_deadline() > now_mono_ns:
+            return list(), 0
+        last_index = (now_mono_ns - self.mono_anchor + self.wall_anchor - self.offset_ns) // self.interval_ns
+        count = last_index - self.next_index + 1
+        skipped = max(count - limit, 0)
+        self.next_index += skipped
+        first_deadline = self.next_deadline()
+        self.next_index = last_index + 1
+        return [first_deadline + tick * self.interval_ns for tick in range(count - skipped)], skipped
+
+    def resync(self):
+        """Line the ticks up again if the wall clock was changed, the time zone changing counts too"""
+        jump = (local_time_ns() - self.wall_anchor) - (time.monotonic_ns() - self.mono_anchor)
+        if abs(jump) > CLOCK_JUMP_NS:
+            logging.info("Wall clock moved %.1f seconds, lining the ticks up again", jump / NS_PER_SEC)
+            self.__anchor()
+
+    def __anchor(self):
+        """Pair the wall clock with the monotonic clock, the first tick is the next boundary after now"""
+        self.mono_anchor = time.monotonic_ns()
+        self.wall_anchor = local_time_ns()
+        self.next_index = (self.wall_anchor - self.offset_ns) // self.interval_ns + 1
+
+class ScheduledJob:
+    def __init__(self, name, interval_sec, function, catch_up=False, offset_sec=0):
+        """A repeating job, see Scheduler.every"""
+        self.name = name
+        self.function = function
+        self.catch_up = catch_up
+        self.ticks = WallClockTicks(interval_sec, offset_sec)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.lock = Lock()
+        self.waiting = 0
+        self.last_drift = None
+
+    def fire(self, deadlines, skipped=0):
+        """Hand the due ticks to the worker, never blocks"""
+        if skipped:
+            SCHEDULER_TICKS.inc(self.name, 'dropped', amount=skipped)
+        with self.lock:
+            if self.catch_up:
+                room = max(MAX_BACKLOG - self.waiting, 0)
+                run_deadlines = deadlines[:room]
+                if len(deadlines) > room:
+                    SCHEDULER_TICKS.inc(self.name, 'dropped', amount=len(deadlines) - room)
+            else:
+                # one run covers every tick since the last run started
+                run_deadlines = deadlines[-1:] if self.waiting == 0 else []
+                if len(deadlines) > len(run_deadlines):
+                    SCHEDULER_TICKS.inc(self.name, 'coalesced', amount=len(deadlines) - len(run_deadlines))
+            self.waiting += len(run_deadlines)
+        for deadline in run_deadlines:
+            self.executor.submit(self.__run, deadline)
+
+    def stop(self, wait=True):
+        """Stop the worker, ticks that have not started are dropped"""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def __run(self, deadline):
+        with self.lock:
+            self.waiting -= 1
+        self.last_drift = (time.monotonic_ns() - deadline) / NS_PER_SEC
+        SCHEDULER_DRIFT.observe(self.last_drift, self.name)
+        SCHEDULER_TICKS.inc(self.name, 'ran')
+        try:
+            self.function()
+        except Exception:
+            logging.exception("Scheduled job %s failed", self.name)
+
+class Scheduler:
+    def __init__(self):
+        """Runs the jobs from one timer thread, call start() after adding them and stop() to shut down"""
+        self.condition = Condition()
+        self.jobs = list()
+        self.running = False
+        self.thread = None
+
+    def every(self, interval_sec, function, name=None, catch_up=False, offset_sec=0):
+        """Run function every interval_sec seconds, on the wall clock boundaries of the interval
+           catch_up - run once for every tick missed while the job was busy, False runs once for all of them
+           offset_sec - move the ticks this far past the boundaries
+           returns the ScheduledJob"""
+        job = ScheduledJob(name or function.__name__, interval_sec, function, catch_up, offset_sec)
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+        return job
+
+    def start(self):
+        """Start the timer thread"""
+        self.running = True
+        self.thread = Thread(target=self.__timer_thread, args=(), daemon=True, name='Scheduler')
+        self.thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """Stop the timer, and the workers once the runs in progress finish"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        for job in self.jobs:
+            job.stop(wait)
+
+    def __timer_thread(self):
+        """Hand each job the ticks that are due then sleep until the next one"""
+        with self.condition:
+            while self.running:
+                now = time.monotonic_ns()
+                next_deadline = None
+                for job in self.jobs:
+                    job.ticks.resync()
+                    due, skipped = job.ticks.take_due(now)
+                    if due:
+                        job.fire(due, skipped)
+                    deadline = job.ticks.next_deadline()
+                    next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+                # wake up at least once a second to check for a changed wall clock
+                timeout = NS_PER_SEC if next_deadline is None else min(next_deadline - time.monotonic_ns(), NS_PER_SEC)
+                if timeout > 0:
+                    self.condition.wait(timeout / NS_PER_SEC)
@@ -7,44 +7,155 @@
 # email dvanvolk@ieee.org
 # -----------------------------------------------------------
 import serial
-from serial.threaded import LineReader, ReaderThread
+from serial.threaded import Protocol, ReaderThread
 import traceback
-import time
+import logging
 import sys
-import re
+import weakref
 
-class RadioProtocolHandler(LineReader):
-    """This class overrides the LineReader class and is responsible for getting information from the serial interface
-    The radio interface does not need to write, but if needed the function write_line can be used
-    Class looks for Button or Heart Messages that look like: "Button: 1", "Button: 2", "Button: 3" or "Heart: 1" """
-    def __init__(self):
+from metrics import REGISTRY
+
+# Binary frames from the RadioReceiver (BINARY_FRAMES set) are 6 bytes:
+#  [sync 0xA5][type 'B' or 'H'][from][id][seq][crc8 of type, from, id and seq]
+#  from is the address of the remote, each remote counts its own seq
+FRAME_SYNC = 0xA5
+FRAME_SIZE = 6
+FRAME_BUTTON = ord('B')
+FRAME_HEART = ord('H')
+CRC8_POLY = 0x07
+# a jump in the sequence bigger than this is the remote restarting, not lost packets
+MAX_SEQ_GAP = 32
+MAX_LINE_SIZE = 1024
+NUMBER_SEPARATORS = b": \t"
+# text lines end with the address of the remote, "Button 1 [From :3]", older receivers leave it off
+SENDER_TAG = b"[From :"
+
+def make_crc8_table(poly=CRC8_POLY):
+    """Lookup table for the CRC-8 used on the binary frames"""
+    table = list()
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+CRC8_TABLE = make_crc8_table()
+
+# radios whose parser counters are served as radio_frames_total, RadioInterface and RadioManager add themselves
+FRAME_SOURCES = weakref.WeakSet()
+
+def frame_totals():
+    """Parser counters added up over every radio source, by kind"""
+    totals = dict()
+    for source in list(FRAME_SOURCES):
+        for kind, value in source.get_stats().items():
+            totals[kind] = totals.get(kind, 0) + value
+    return {(kind,): value for kind, value in totals.items()}
+
+REGISTRY.counter('radio_frames_total', "Radio lines and frames by kind", ['kind']).set_function(frame_totals)
+
+def read_sender(text):
+    """Address of the remote from the end of a text line, None if the line does not have one"""
+    start = text.find(SENDER_TAG)
+    if start < 0:
+        return None
+    address = text[start + len(SENDER_TAG):].split(b"]", 1)[0].strip()
+    return int(address) if address.isdigit() else None
+
+def crc8(data):
+    """CRC-8 of the bytes, matches the Crc8 function in RadioReceiver.ino"""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+def make_frame(frame_type, ident, seq, sender=0):
+    """Build a binary frame, used to test the parser without a receiver"""
+    body = bytes([frame_type, sender & 0xFF, ident & 0xFF, seq & 0xFF])
+    return bytes([FRAME_SYNC]) + body + bytes([crc8(body)])
+
+class RadioProtocolHandler(Protocol):
+    """This class is responsible for getting information from the serial interface, it works on the raw bytes
+    so there is no decode or regular expression per line. The radio interface does not need to write, but if needed the function write_line can be used
+    Text mode looks for Button or Heart Messages that look like: "Button: 1", "Button 2 [From :3]" or "Heart 5 [RSSI :-40] [From :3]"
+    Binary mode looks for the 6 byte frames, see FRAME_SYNC
+    Each remote numbers its own packets, so the sequence and heart counts are kept by sender.
+    While a callback runs, packet is the (sender, seq) of the packet being handled, seq is None for a text line
+    Lines or frames that can not be read are counted in stats and skipped"""
+    def __init__(self, binary=False):
         super().__init__()
+        self.binary = binary
+        self.transport = None
+        self.buffer = bytearray()
         self.event_callback_list = list()
         self.heart_callback = None
+        self.last_seq = dict()
+        self.last_heart = dict()
+        self.packet = None
+        self.stats = {'buttons': 0, 'hearts': 0, 'unexpected': 0, 'malformed': 0,
+                      'skipped_bytes': 0, 'duplicates': 0, 'dropped': 0}
+        # the first byte picks the message, then the rest is checked against the full name
+        self.line_table = {ord('B'): (b"Button", self.__process_button),
+                           ord('H'): (b"Heart", self.__process_heart_line)}
+        self.frame_table = {FRAME_BUTTON: self.__process_button,
+                            FRAME_HEART: self.__process_heart}
 
     def connection_made(self, transport):
         """Function overrides the base class and reports when the serial port is open"""
-        super(RadioProtocolHandler, self).connection_made(transport)
-        print('port opened\n')
-
-    def handle_line(self, data):
-        """Function overrides the base class and handles incoming data from the serial port, 
-           it will check the response and signal what button was pressed.
-           Function checks for known string signatures that contain "button", and "heart"
-        """
-        numeric_data = int(re.search(r'\d+', data).group()) - 1
-        if "Button" in data:
-            self.__process_button(numeric_data)
-        elif "Heart" in data:
-            self.__process_heart(numeric_data)
-        else:
-            print(f"Unexpected Data: {data}")    
+        self.transport = transport
+        logging.info("port opened")
+
+    def data_received(self, data):
+        """Function overrides the base class and handles incoming data from the serial port"""
+        if self.binary:
+            self.__receive_frames(data)
+            return
+        self.buffer.extend(data)
+        if b'\n' not in data:
+            if len(self.buffer) > MAX_LINE_SIZE:
+                # no line ending is coming, drop the noise
+                self.stats['skipped_bytes'] += len(self.buffer)
+                self.buffer.clear()
+            return
+        *lines, rest = self.buffer.split(b'\n')
+        self.buffer = bytearray(rest)
+        for line in lines:
+            self.handle_packet(line)
+
+    def handle_packet(self, packet):
+        """Handle one line of bytes from the serial port and signal what button was pressed,
+           the line is matched on its first byte and the number after the name is read without a regex"""
+        line = packet.strip()
+        if not line:
+            return
+        entry = self.line_table.get(line[0])
+        if entry is None or not line.startswith(entry[0]):
+            self.stats['unexpected'] += 1
+            logging.info("Unexpected Data: %s", line.decode('ascii', 'replace'))
+            return
+        words = line[len(entry[0]):].lstrip(NUMBER_SEPARATORS).split(None, 1)
+        if not words or not words[0].isdigit():
+            self.stats['malformed'] += 1
+            logging.warning("Malformed Data: %s", line.decode('ascii', 'replace'))
+            return
+        self.packet = (read_sender(words[1] if len(words) > 1 else b""), None)
+        entry[1](int(words[0]))
+
+    def handle_line(self, line):
+        """Handle one line of text, kept so text can still be passed in like the old LineReader"""
+        self.handle_packet(line.encode('ascii', 'replace'))
 
     def connection_lost(self, exc):
         """Function overrides the base class and reports when the connection is lost"""
+        self.transport = None
         if exc:
             traceback.print_exc(exc)
-        print('Lost Connection\n')
+        logging.warning("Lost Connection")
+
+    def write_line(self, text):
+        """Write text out the serial port with a line ending"""
+        self.transport.write(text.encode('ascii', 'replace') + b'\r\n')
 
     def set_button_callback(self, button_cb_list):
         """Function sets the callback list of the buttons, The list index should correspond to the button ID"""
@@ -53,43 +164,161 @@ class RadioProtocolHandler(LineReader):
     def set_heart_callback(self, heart_cb):
         """Function sets the callback of the Heartbeat"""
         self.heart_callback = heart_cb
-        
-    def __process_button(self, button_index):
-        """handle a button receive data by calling a callback if configured"""
-        if len(self.event_callback_list) > button_index:
+
+    def get_stats(self):
+        """Copy of the parser counters"""
+        return dict(self.stats)
+
+    def __receive_frames(self, data):
+        """Pull the binary frames out of the data, bytes before a sync byte are skipped
+           and a frame with a bad CRC is skipped one byte at a time until the next good frame"""
+        buffer = self.buffer
+        buffer.extend(data)
+        start = 0
+        end = len(buffer)
+        while True:
+            sync = buffer.find(FRAME_SYNC, start)
+            if sync < 0:
+                self.stats['skipped_bytes'] += end - start
+                start = end
+                break
+            self.stats['skipped_bytes'] += sync - start
+            if end - sync < FRAME_SIZE:
+                start = sync
+                break
+            frame_type, sender, ident, seq, crc = buffer[sync + 1:sync + FRAME_SIZE]
+            if CRC8_TABLE[CRC8_TABLE[CRC8_TABLE[CRC8_TABLE[frame_type] ^ sender] ^ ident] ^ seq] != crc:
+                self.stats['malformed'] += 1
+                start = sync + 1
+                continue
+            start = sync + FRAME_SIZE
+            self.__handle_frame(frame_type, sender, ident, seq)
+        del buffer[:start]
+
+    def __handle_frame(self, frame_type, sender, ident, seq):
+        """Handle one good binary frame"""
+        process = self.frame_table.get(frame_type)
+        if process is None:
+            self.stats['malformed'] += 1
+            return
+        if self.__check_sequence(sender, seq):
+            self.packet = (sender, seq)
+            process(ident)
+
+    def __check_sequence(self, sender, seq):
+        """Track the sender's radio sequence number, returns False for a repeat of its last packet
+           and counts the packets missed before this one"""
+        last_seq = self.last_seq.get(sender)
+        if last_seq is not None:
+            gap = (seq - last_seq) % 256
+            if gap == 0:
+                self.stats['duplicates'] += 1
+                return False
+            if gap <= MAX_SEQ_GAP:
+                self.stats['dropped'] += gap - 1
+        self.last_seq[sender] = seq
+        return True
+
+    def __process_button(self, button_id):
+        """handle a button receive data by calling a callback if configured, button 1 is index 0"""
+        self.stats['buttons'] += 1
+        button_index = button_id - 1
+        if 0 <= button_index < len(self.event_callback_list):
                 if self.event_callback_list[button_index] is not None:
-                    self.event_callback_list[button_index]()   
+                    self.event_callback_list[button_index]()
         else:
-            print(f"Low list index")
+            logging.warning("No callback for button %s", button_id)
+
+    def __process_heart_line(self, heart_count):
+        """handle a text heart, each remote counts up by one each beat so a jump is missed beats
+           and a repeat is the same beat twice"""
+        sender = self.packet[0]
+        last_heart = self.last_heart.get(sender)
+        if last_heart is not None and heart_count <= last_heart + MAX_SEQ_GAP:
+            if heart_count == last_heart:
+                self.stats['duplicates'] += 1
+                return
+            if heart_count > last_heart:
+                self.stats['dropped'] += heart_count - last_heart - 1
+        self.last_heart[sender] = heart_count
+        self.__process_heart(heart_count)
 
     def __process_heart(self, id):
         """handle a heart receive data by calling a callback if configured"""
-        print(f"Radio Heart: {id}")  
+        self.stats['hearts'] += 1
+        logging.debug("Radio Heart: %s", id)
+        if self.heart_callback is not None:
+            self.heart_callback()
 
 TEST_PORT = 'loop://'
 BAUD_RATE = 115200
 
+def open_port(port):
+    """Open the serial port, the test port is a loopback device"""
+    if port == TEST_PORT:
+        # Create a loopback device
+        return serial.serial_for_url(port, baudrate=BAUD_RATE, timeout=1)
+    return serial.Serial(port, baudrate=BAUD_RATE, timeout=1)
+
+class PolledSerial:
+    """Stands in for the ReaderThread when the port is read by polling from an event loop instead of a thread,
+       it is the transport given to the protocol"""
+    def __init__(self, serial_instance, protocol_factory):
+        self.serial = serial_instance
+        self.protocol = protocol_factory()
+        self.protocol.connection_made(self)
+
+    def write(self, data):
+        """Write bytes out the serial port"""
+        self.serial.write(data)
+
+    def poll(self):
+        """Read whatever is waiting on the port and pass it to the protocol, returns the number of bytes read"""
+        waiting = self.serial.in_waiting
+        if not waiting:
+            return 0
+        data = self.serial.read(waiting)
+        self.protocol.data_received(data)
+        return len(data)
+
+    def close(self):
+        """Close the serial port"""
+        self.serial.close()
+        self.protocol.connection_lost(None)
+
 class RadioInterface():
     def __init__(self):
         self.protocol = None
         self.transport = None    
 
-    def start(self, port=TEST_PORT, button_callbacks = list(), heart_callback = None):
-        """Start the serial interface and reader thread"""
-        if port == TEST_PORT:
-            # Create a loopback device
-            serial_interface = serial.serial_for_url(port, baudrate=BAUD_RATE, timeout=1)
-        else:
-            serial_interface = serial.Serial(port, baudrate=BAUD_RATE, timeout=1)
-        reader_thread = ReaderThread(serial_interface, RadioProtocolHandler )
+    def open(self, port=TEST_PORT, button_callbacks = list(), heart_callback = None, binary=False):
+        """Open the serial interface without a reader thread, the owner reads it by calling poll()
+           binary - the receiver sends binary frames instead of text lines"""
+        self.transport = PolledSerial(open_port(port), lambda: RadioProtocolHandler(binary))
+        self.protocol = self.transport.protocol
+        self.protocol.set_button_callback(button_callbacks)
+        self.protocol.set_heart_callback(heart_callback)
+        FRAME_SOURCES.add(self)
+        logging.info("Open Serial Interface")
+
+    def poll(self):
+        """Read any waiting data, only used when the port was opened with open()"""
+        return self.transport.poll()
+
+    def start(self, port=TEST_PORT, button_callbacks = list(), heart_callback = None, binary=False):
+        """Start the serial interface and reader thread
+           binary - the receiver sends binary frames instead of text lines"""
+        serial_interface = open_port(port)
+        reader_thread = ReaderThread(serial_interface, lambda: RadioProtocolHandler(binary))
         reader_thread.start()
         self.transport, self.protocol = reader_thread.connect()
         
         self.protocol.set_button_callback(button_callbacks)
         self.protocol.set_heart_callback(heart_callback)
+        FRAME_SOURCES.add(self)
 
-        print("Start Serial Interface")
-        time.sleep(1)
+        # connect() has already waited for the reader thread to be running
+        logging.info("Start Serial Interface")
 
     def exit(self):
         """Close the serial port and reader thread"""
@@ -99,6 +328,10 @@ class RadioInterface():
         """Send Data to the out the interface"""
         self.protocol.write_line(write_data)
 
+    def get_stats(self):
+        """Parser counters: buttons, hearts, unexpected and malformed lines, dropped and duplicate packets"""
+        return self.protocol.get_stats()
+
 
 def test_button_callback():
     """Function is used for testing only"""
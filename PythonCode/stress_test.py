@@ -0,0 +1,94 @@
+# -----------------------------------------------------------
+# Command line stress test for the thread safe counters. Many
+#  writer threads press, un-press and mark at the same time as
+#  reader threads build reports, then the counts are checked so
+#  no event was lost or counted twice
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+import argparse
+import contextlib
+import os
+import time
+from threading import Thread, Event
+from counter_group import CounterGroup
+
+def writer(counter, presses, removes, marks):
+    """Send presses, removes and marks to one counter, the removes are spread through the presses"""
+    remove_every = presses // removes if removes else 0
+    for press in range(presses):
+        counter.increase()
+        if remove_every and press % remove_every == 0:
+            counter.decrease()
+        if marks and press % marks == 0:
+            counter.mark()
+
+def reader(group, stop, reads):
+    """Build reports as fast as possible until told to stop"""
+    while not stop.is_set():
+        group.get_total_count()
+        group.get_last_minute_count()
+        for name in group.site_names():
+            group.get_counter(name).raw_timestamp_df
+        reads.append(1)
+
+def run_stress(threads, presses, sites, readers, removes, marks):
+    """Hammer a CounterGroup from many threads, returns (elapsed seconds, errors list, reads done)"""
+    group = CounterGroup([f"site{index}" for index in range(sites)], max_sites=None)
+    stop = Event()
+    reads = list()
+    writer_threads = [Thread(target=writer, args=(group.get_counter(f"site{index % sites}"), presses, removes, marks))
+                      for index in range(threads)]
+    reader_threads = [Thread(target=reader, args=(group, stop, reads)) for _ in range(readers)]
+
+    start_time = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for thread in reader_threads + writer_threads:
+            thread.start()
+        for thread in writer_threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+        stop.set()
+        for thread in reader_threads:
+            thread.join()
+
+    errors = list()
+    removes_done = len(range(0, presses, presses // removes)) if removes else 0
+    marks_done = len(range(0, presses, marks)) if marks else 0
+    for index in range(sites):
+        writers = len(range(index, threads, sites))
+        counter = group.get_counter(f"site{index}")
+        expected_total = writers * (presses - removes_done)
+        # the seed row, plus every press and mark, less the removed events
+        expected_events = 1 + writers * (presses + marks_done - removes_done)
+        # a remove takes the last event of the site, with marks from other threads that can be a mark instead of a press
+        max_total = expected_total + (writers * removes_done if marks_done else 0)
+        if not expected_total <= counter.get_total_count() <= max_total:
+            errors.append(f"site{index} total {counter.get_total_count()}, expected {expected_total}")
+        if len(counter.events) != expected_events:
+            errors.append(f"site{index} has {len(counter.events)} events, expected {expected_events}")
+        if counter.raw_timestamp_df['count'].sum() != counter.get_total_count():
+            errors.append(f"site{index} event sum does not match the running total")
+    return elapsed, errors, len(reads)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='stress_test.py',
+                                     description='Hammer the counters from many threads and check no events are lost')
+    parser.add_argument('-t', required=False, type=int, default=16, help="Number of writer threads")
+    parser.add_argument('-n', required=False, type=int, default=20000, help="Presses per writer thread")
+    parser.add_argument('-s', required=False, type=int, default=4, help="Number of sites the writers are spread over")
+    parser.add_argument('-r', required=False, type=int, default=2, help="Number of reader threads building reports")
+    parser.add_argument('-d', required=False, type=int, default=100, help="Removes (down presses) per writer thread")
+    parser.add_argument('-m', required=False, type=int, default=1000, help="Mark every M presses, 0 for no marks")
+    args = parser.parse_args()
+
+    elapsed, errors, reads = run_stress(args.t, args.n, args.s, args.r, min(args.d, args.n), args.m)
+    presses = args.t * args.n
+    print(f"{presses} presses from {args.t} threads in {elapsed:.2f}s ({presses / elapsed:.0f} presses/s), {reads} reports")
+    if errors:
+        for error in errors:
+            print(f"FAIL: {error}")
+        raise SystemExit(1)
+    print("PASS: no events lost")
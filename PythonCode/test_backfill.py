@@ -0,0 +1,56 @@
+# -----------------------------------------------------------
+# Tests of reading captures and merging them into the event logs
+#      python -m pytest test_backfill.py
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from datetime import datetime
+import numpy as np
+
+from backfill import read_serial_capture, backfill
+from counter_group import LOG_SUFFIX
+from event_store import NS_PER_SEC, datetime_to_ns
+from TrickCount import trick_count
+
+CAPTURE = (b"2023-10-31 18:02:03.100 Button: 1\n"
+           b"\n"
+           b"2023-10-31 18:02:04.000 Heart: 0\n"
+           b"radio reset, garbage \xff\xfe\n"
+           b"2023-10-31 18:02:09.500 Button: 1\n")
+
+def test_serial_capture_counts_garbage_line(tmp_path):
+    capture = tmp_path / "radio_capture.txt"
+    capture.write_bytes(CAPTURE)
+    site_events, stats = read_serial_capture(str(capture), 'front')
+    assert stats['lines'] == 5
+    assert stats['unexpected'] == 1
+    assert stats['buttons'] == 2 and stats['hearts'] == 1
+    assert len(site_events['front'][0]) == 2
+
+def test_backfill_skips_presses_already_logged(tmp_path):
+    capture = tmp_path / "radio_capture.txt"
+    capture.write_bytes(CAPTURE)
+    site_events, _ = read_serial_capture(str(capture), 'front')
+    # the tracker logged the first press 40 ms after the radio logger did
+    logged = site_events['front'][0][0] + 40_000_000
+    counter = trick_count(log_path=str(tmp_path / f"front{LOG_SUFFIX}"))
+    counter.merge_events(np.array([logged]), np.array([1]))
+    counter.close()
+
+    before, after = backfill(site_events, str(tmp_path))
+    timestamps, deltas = after['front']
+    # a new counter starts with a 0 mark at the time it was made
+    assert timestamps[deltas != 0].tolist() == [logged, datetime_to_ns(datetime(2023, 10, 31, 18, 2, 9, 500000))]
+    # the same capture again adds nothing
+    before, after = backfill(site_events, str(tmp_path))
+    assert np.count_nonzero(after['front'][1]) == 2
+
+def test_backfill_match_window_zero_only_skips_exact_repeats(tmp_path):
+    counter = trick_count()
+    stamp = 1_000 * NS_PER_SEC
+    assert counter.merge_events(np.array([stamp]), np.array([1])) == 1
+    assert counter.merge_events(np.array([stamp, stamp + 1]), np.array([1, 1])) == 1
+    assert counter.merge_events(np.array([stamp + 2, stamp + 10]), np.array([1, 1]), window_ns=5) == 1
+    assert counter.get_total_count() == 3
@@ -0,0 +1,123 @@
+# -----------------------------------------------------------
+# Tests of the binary event log, reopening a torn log, replaying
+#  pops and rewriting it while records are still coming in
+#      python -m pytest test_event_log.py
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from threading import Thread, Event
+import os
+import numpy as np
+
+from event_log import EventLog, read_log, replay_log, HEADER, RECORD, KIND_APPEND, KIND_POP
+from event_store import EventBuffer
+
+def replayed(path):
+    """Timestamps and deltas left after replaying the log"""
+    events = EventBuffer()
+    replay_log(path, events)
+    return events.get_timestamps().tolist(), events.get_deltas().tolist()
+
+def test_open_drops_torn_last_record(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    log = EventLog(path, flush_interval=0)
+    log.append(100, 1)
+    log.append(200, 1)
+    log.close()
+    # a crash part way through writing the third record
+    with open(path, 'ab') as file:
+        file.write(RECORD.pack(300, 1, KIND_APPEND)[:5])
+    assert os.path.getsize(path) == HEADER.size + 2 * RECORD.size + 5
+
+    log = EventLog(path, flush_interval=0)
+    assert os.path.getsize(path) == HEADER.size + 2 * RECORD.size
+    # new records go after the last whole one
+    log.append(400, 1)
+    log.close()
+    assert read_log(path)['timestamp'].tolist() == [100, 200, 400]
+
+def test_open_writes_header_over_short_file(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    with open(path, 'wb') as file:
+        file.write(b'TOTE')
+    log = EventLog(path, flush_interval=0)
+    log.append(100, 1)
+    log.close()
+    assert read_log(path)['timestamp'].tolist() == [100]
+
+def test_replay_applies_pops_in_order(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    log = EventLog(path, flush_interval=0)
+    log.append(100, 1)
+    log.append(200, 1)
+    log.pop(210)
+    log.pop(220)
+    log.append(300, 1)
+    log.append(400, -1)
+    log.pop(410)
+    log.append(500, 1)
+    log.close()
+    records = read_log(path)
+    assert records['kind'].tolist().count(KIND_POP) == 3
+    assert replayed(path) == ([300, 500], [1, 1])
+
+def test_replay_pop_first_and_last(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    log = EventLog(path, flush_interval=0)
+    log.append(100, 1)
+    log.pop(110)
+    log.append(200, 1)
+    log.append(300, 1)
+    log.pop(310)
+    log.close()
+    assert replayed(path) == ([200], [1])
+
+def test_rewrite_keeps_records_added_after_snapshot(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    log = EventLog(path, flush_interval=0)
+    for stamp in range(100, 600, 100):
+        log.append(stamp, 1)
+    keep_from = log.end_offset()
+    # written after the events were copied, they are not in the rewrite
+    log.append(600, 1)
+    log.pop(610)
+    log.append(700, 1)
+    log.rewrite(np.array([100, 500]), np.array([3, 2]), keep_from)
+    log.append(800, 1)
+    log.close()
+    assert replayed(path) == ([100, 500, 700, 800], [3, 2, 1, 1])
+
+def test_rewrite_keeps_buffered_records(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    # a long interval, the records after the snapshot are still in the buffer at the rewrite
+    log = EventLog(path, flush_interval=60, batch_records=1000)
+    log.append(100, 1)
+    keep_from = log.end_offset()
+    log.append(200, 1)
+    log.rewrite(np.array([100]), np.array([1]), keep_from)
+    log.close()
+    assert replayed(path) == ([100, 200], [1, 1])
+
+def test_rewrite_while_appending(tmp_path):
+    path = str(tmp_path / "front.evlog")
+    log = EventLog(path, flush_interval=0.01, batch_records=8)
+    for stamp in range(1000):
+        log.append(stamp, 1)
+    keep_from = log.end_offset()
+    started = Event()
+    def add_records():
+        started.set()
+        for stamp in range(1000, 3000):
+            log.append(stamp, 1)
+    writer = Thread(target=add_records)
+    writer.start()
+    started.wait()
+    # the first 1000 presses folded into one event
+    log.rewrite(np.array([999]), np.array([1000]), keep_from)
+    writer.join()
+    log.close()
+    timestamps, deltas = replayed(path)
+    assert timestamps == [999] + list(range(1000, 3000))
+    assert sum(deltas) == 3000
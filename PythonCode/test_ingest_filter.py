@@ -0,0 +1,56 @@
+# -----------------------------------------------------------
+# Tests of the ingest filter, debouncing, message IDs and matching
+#  the same press seen on the radio and on MQTT
+#      python -m pytest test_ingest_filter.py
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from event_store import NS_PER_SEC
+from ingest_filter import IngestFilter, SOURCE_RADIO, SOURCE_MQTT, payload_message_id, radio_message_id
+
+MS = NS_PER_SEC // 1000
+
+def test_only_radio_is_debounced_by_default():
+    ingest = IngestFilter(match_window_sec=0)
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', now_ns=0)
+    assert not ingest.accept(SOURCE_RADIO, 'front', 'count', now_ns=50 * MS)
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=0)
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=50 * MS)
+
+def test_press_on_radio_and_mqtt_counted_once():
+    ingest = IngestFilter()
+    # the radio text lines have no ID, the bridge copy comes in 300 ms later
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', now_ns=0)
+    assert not ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=300 * MS)
+    # each press is only matched once, two presses on each source stay two
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', now_ns=2000 * MS)
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', now_ns=2200 * MS)
+    assert not ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=2300 * MS)
+    assert not ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=2400 * MS)
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=2500 * MS)
+    # another site or event, or outside the window, is another press
+    assert ingest.accept(SOURCE_MQTT, 'back', 'count', now_ns=5000 * MS)
+    assert ingest.accept(SOURCE_RADIO, 'front', 'down', now_ns=5000 * MS)
+    assert ingest.accept(SOURCE_RADIO, 'back', 'count', now_ns=6000 * MS)
+    assert ingest.get_stats()[SOURCE_MQTT] == {'passed': 2, 'debounced': 0, 'duplicates': 3}
+
+def test_message_ids_do_not_collide():
+    ingest = IngestFilter(match_window_sec=0)
+    # seq 17 from two remotes, and an MQTT message numbered 17
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', radio_message_id(2, 17), now_ns=0)
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', radio_message_id(3, 17), now_ns=1)
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', payload_message_id(b"1 17"), now_ns=2)
+    # a bridge republishing the radio press sends its ID
+    assert not ingest.accept(SOURCE_MQTT, 'front', 'count', payload_message_id(b"1 radio:2:17"), now_ns=3)
+
+def test_bridge_copy_with_id_uses_up_the_match():
+    ingest = IngestFilter()
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', radio_message_id(2, 17), now_ns=0)
+    assert not ingest.accept(SOURCE_MQTT, 'front', 'count', payload_message_id(b"1 radio:2:17"), now_ns=100 * MS)
+    # so an MQTT press without an ID just after is a new press
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', now_ns=200 * MS)
+    # two presses with different IDs are never matched
+    assert ingest.accept(SOURCE_RADIO, 'front', 'count', radio_message_id(2, 18), now_ns=3000 * MS)
+    assert ingest.accept(SOURCE_MQTT, 'front', 'count', payload_message_id(b"1 42"), now_ns=3100 * MS)
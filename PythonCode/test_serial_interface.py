@@ -0,0 +1,136 @@
+# -----------------------------------------------------------
+# Tests of the radio protocol handler, the text lines and binary
+#  frames are fed straight in without a serial port
+#      python -m pytest test_serial_interface.py
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from serial_interface import (RadioProtocolHandler, make_frame, FRAME_BUTTON, FRAME_HEART, FRAME_SYNC, FRAME_SIZE,
+                              MAX_SEQ_GAP, MAX_LINE_SIZE)
+
+def make_handler(binary=False):
+    """Handler that records the (sender, seq) of each button and heart"""
+    handler = RadioProtocolHandler(binary)
+    presses = list()
+    hearts = list()
+    handler.set_button_callback([lambda: presses.append(handler.packet)])
+    handler.set_heart_callback(lambda: hearts.append(handler.packet))
+    return handler, presses, hearts
+
+def test_frames_from_two_remotes_interleaved():
+    handler, presses, hearts = make_handler(binary=True)
+    # each remote counts its own seq, the two counts are far apart and cross over
+    frames = [(FRAME_BUTTON, 1, 10, 2), (FRAME_BUTTON, 1, 200, 3),
+              (FRAME_BUTTON, 1, 11, 2), (FRAME_HEART, 3, 201, 3),
+              (FRAME_BUTTON, 1, 11, 2), (FRAME_BUTTON, 1, 12, 2),
+              (FRAME_BUTTON, 1, 204, 3), (FRAME_BUTTON, 1, 12, 3)]
+    handler.data_received(b"".join(make_frame(*frame) for frame in frames))
+    assert presses == [(2, 10), (3, 200), (2, 11), (2, 12), (3, 204), (3, 12)]
+    assert hearts == [(3, 201)]
+    stats = handler.get_stats()
+    # the repeat of remote 2's 11, and remote 3 missed 202 and 203. 204 to 12 is a restart, not lost packets
+    assert stats['duplicates'] == 1
+    assert stats['dropped'] == 2
+    assert stats['buttons'] == 6 and stats['hearts'] == 1
+
+def test_text_hearts_from_two_remotes_interleaved():
+    handler, presses, hearts = make_handler()
+    handler.data_received(b"Heart 5 [RSSI :-40] [From :2]\r\n"
+                          b"Heart 90 [RSSI :-70] [From :3]\r\n"
+                          b"Button 1 [From :3]\r\n"
+                          b"Heart 6 [RSSI :-41] [From :2]\r\n"
+                          b"Heart 92 [RSSI :-70] [From :3]\r\n"
+                          b"Heart 6 [RSSI :-41] [From :2]\r\n")
+    assert hearts == [(2, None), (3, None), (2, None), (3, None)]
+    assert presses == [(3, None)]
+    stats = handler.get_stats()
+    assert stats['duplicates'] == 1
+    assert stats['dropped'] == 1
+
+def test_frame_with_bad_crc_is_skipped():
+    handler, presses, _ = make_handler(binary=True)
+    bad = bytearray(make_frame(FRAME_BUTTON, 1, 5, 2))
+    bad[-1] ^= 0xFF
+    handler.data_received(bytes(bad) + make_frame(FRAME_BUTTON, 1, 6, 2))
+    assert presses == [(2, 6)]
+    stats = handler.get_stats()
+    assert stats['malformed'] == 1
+    # the rest of the bad frame is skipped on the way to the next sync byte
+    assert stats['skipped_bytes'] == FRAME_SIZE - 1
+
+def test_frame_with_unknown_type_is_malformed():
+    handler, presses, hearts = make_handler(binary=True)
+    handler.data_received(make_frame(ord('X'), 1, 5, 2) + make_frame(FRAME_BUTTON, 1, 6, 2))
+    assert presses == [(2, 6)] and hearts == []
+    assert handler.get_stats()['malformed'] == 1
+
+def test_frames_split_across_reads():
+    handler, presses, _ = make_handler(binary=True)
+    data = b"\x00\x13" + b"".join(make_frame(FRAME_BUTTON, 1, seq, 2) for seq in range(1, 4))
+    # one byte at a time, then a read that ends part way through a frame
+    for index in range(0, 9):
+        handler.data_received(data[index:index + 1])
+    handler.data_received(data[9:])
+    assert presses == [(2, 1), (2, 2), (2, 3)]
+    assert handler.get_stats()['skipped_bytes'] == 2
+
+def test_sync_byte_inside_frame():
+    handler, presses, _ = make_handler(binary=True)
+    # the id and seq are the sync value, and a stray sync byte comes first
+    handler.data_received(bytes([FRAME_SYNC]) + make_frame(FRAME_BUTTON, 1, FRAME_SYNC, FRAME_SYNC))
+    assert presses == [(FRAME_SYNC, FRAME_SYNC)]
+
+def test_text_lines_split_across_reads():
+    handler, presses, _ = make_handler()
+    for chunk in [b"Butt", b"on: 1 [From", b" :4]\r", b"\nButton 1\r\n"]:
+        handler.data_received(chunk)
+    assert presses == [(4, None), (None, None)]
+
+def test_garbage_and_malformed_lines():
+    handler, presses, hearts = make_handler()
+    handler.data_received(b"RFM69 radio init OK!\r\n"
+                          b"\xff\xfe\x00junk\r\n"
+                          b"Bogus 1\r\n"
+                          b"Button\r\n"
+                          b"Button: x\r\n"
+                          b"Heart -3\r\n"
+                          b"\r\n"
+                          b"Button 9\r\n"
+                          b"Button 1 [From :x]\r\n")
+    # button 9 has no callback, it is still read
+    assert presses == [(None, None)]
+    assert hearts == []
+    stats = handler.get_stats()
+    assert stats['unexpected'] == 3
+    assert stats['malformed'] == 3
+    assert stats['buttons'] == 2
+
+def test_long_noise_without_line_end_is_dropped():
+    handler, presses, _ = make_handler()
+    handler.data_received(b"\x01" * (MAX_LINE_SIZE + 1))
+    handler.data_received(b"\r\nButton 1\r\n")
+    assert presses == [(None, None)]
+    assert handler.get_stats()['skipped_bytes'] == MAX_LINE_SIZE + 1
+
+def test_sequence_gap_and_wrap():
+    handler, presses, _ = make_handler(binary=True)
+    seqs = [250, 255, 0, 1, 1, 1 + MAX_SEQ_GAP, 2 + 2 * MAX_SEQ_GAP, 2 + 2 * MAX_SEQ_GAP]
+    handler.data_received(b"".join(make_frame(FRAME_BUTTON, 1, seq, 2) for seq in seqs))
+    stats = handler.get_stats()
+    # 251 to 254 missed, the wrap from 255 to 0 is no gap, then the largest gap counted as lost packets.
+    # A jump past MAX_SEQ_GAP is a restart of the remote
+    assert stats['dropped'] == 4 + MAX_SEQ_GAP - 1
+    assert stats['duplicates'] == 2
+    assert [seq for _, seq in presses] == [250, 255, 0, 1, 1 + MAX_SEQ_GAP, 2 + 2 * MAX_SEQ_GAP]
+
+def test_text_heart_gap_and_restart():
+    handler, _, hearts = make_handler()
+    counts = [10, 13, 13, 13 + MAX_SEQ_GAP + 1, 2, 3]
+    handler.data_received(b"".join(f"Heart {count} [RSSI :-50]\r\n".encode() for count in counts))
+    stats = handler.get_stats()
+    # 11 and 12 are missed, the jump up and the drop back to 2 are the remote restarting
+    assert stats['dropped'] == 2
+    assert stats['duplicates'] == 1
+    assert len(hearts) == 5
@@ -0,0 +1,96 @@
+# -----------------------------------------------------------
+# Tests of the counter's compaction, the counts of old times are
+#  kept to the minute or 15 minutes and the totals stay exact
+#      python -m pytest test_trick_count.py
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+import numpy as np
+
+from event_store import EventBuffer, local_time_ns, ns_to_datetime, NS_PER_SEC
+from rollup import CountIndex, MINUTE_NS, FIFTEEN_MIN_NS, HOUR_NS, FIXED_TOP_WINDOWS
+from TrickCount import trick_count
+
+RAW_HORIZON_SEC = 3600
+MINUTE_HORIZON_SEC = 6 * 3600
+
+def make_events(now_ns, days=3, size=20_000, seed=1):
+    """Presses and a few down presses spread over the last days, busier some hours than others"""
+    random = np.random.default_rng(seed)
+    start = now_ns - days * 86400 * NS_PER_SEC
+    timestamps = np.sort(np.concatenate([random.integers(start, now_ns - MINUTE_NS, size),
+                                         random.normal(now_ns - 30 * HOUR_NS, HOUR_NS, size // 4).astype(np.int64)]))
+    deltas = np.where(random.random(len(timestamps)) < 0.05, -1, 1).astype(np.int32)
+    return timestamps, deltas
+
+def window_totals(timestamps, deltas):
+    """{window number: count} of the windows with a count other than zero"""
+    windows, inverse = np.unique(timestamps // FIFTEEN_MIN_NS, return_inverse=True)
+    counts = np.bincount(inverse, weights=deltas).round().astype(np.int64)
+    return {window: count for window, count in zip(windows.tolist(), counts.tolist()) if count}
+
+def busiest(totals, count):
+    ordered = sorted(((window, window_count) for window, window_count in totals.items() if window_count > 0),
+                     key=lambda item: (-item[1], item[0]))
+    return [(ns_to_datetime(window * FIFTEEN_MIN_NS), window_count) for window, window_count in ordered[:count]]
+
+def check_counts(counter, timestamps, deltas, now_ns):
+    """The counts of the compacted counter match the ones worked out from every press"""
+    assert counter.get_total_count() == int(deltas.sum())
+    totals = window_totals(timestamps, deltas)
+    assert {window: count for window, count in counter.get_window_counts().items() if count} == totals
+    for count in [1, 10, FIXED_TOP_WINDOWS + 20]:
+        assert counter.get_busiest_windows(count) == busiest(totals, count)
+    # hours and 15 minutes line up with the compacted buckets, minutes do inside the minute horizon
+    ranges = [(hour * HOUR_NS, (hour + 1) * HOUR_NS) for hour in range(timestamps[0] // HOUR_NS, now_ns // HOUR_NS + 1)]
+    ranges += [(now_ns // FIFTEEN_MIN_NS * FIFTEEN_MIN_NS - offset * FIFTEEN_MIN_NS, now_ns) for offset in range(0, 300, 7)]
+    ranges += [(now_ns // MINUTE_NS * MINUTE_NS - offset * MINUTE_NS, now_ns) for offset in range(0, 6 * 60, 11)]
+    for start, end in ranges:
+        expected = int(deltas[(timestamps >= start) & (timestamps < end)].sum())
+        assert counter.get_count_between(start, end) == expected
+
+def test_compaction_keeps_counts_exact(tmp_path):
+    log_path = str(tmp_path / "front.evlog")
+    counter = trick_count(log_path=log_path, raw_horizon_sec=RAW_HORIZON_SEC, minute_horizon_sec=MINUTE_HORIZON_SEC)
+    first_mark = counter.snapshot()[0][:1]
+    now_ns = local_time_ns()
+    timestamps, deltas = make_events(now_ns)
+    events = EventBuffer(len(timestamps))
+    events.extend(timestamps, deltas)
+    counter.load_events(events)
+    timestamps = np.concatenate([timestamps, first_mark])
+    deltas = np.concatenate([deltas, [0]])
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, deltas = timestamps[order], deltas[order]
+    check_counts(counter, timestamps, deltas, now_ns)
+
+    # only the windows inside the raw horizon are in the dictionary and heap, the compacted ones are
+    # one fixed bucket per 15 minutes past the minute horizon
+    index = counter.index
+    assert len(index.window_counts) <= RAW_HORIZON_SEC * NS_PER_SEC // FIFTEEN_MIN_NS + 2
+    assert len(index.window_heap) <= 2 * len(index.window_counts) + 64
+    folded = index.fixed_buckets[index.fixed_buckets < index.folded_before]
+    assert len(folded) and np.all(folded % (FIFTEEN_MIN_NS // MINUTE_NS) == 0)
+    assert len(counter.snapshot()[0]) < len(timestamps) // 4
+    counter.close()
+
+    replayed = trick_count(log_path=log_path, raw_horizon_sec=RAW_HORIZON_SEC, minute_horizon_sec=MINUTE_HORIZON_SEC)
+    check_counts(replayed, timestamps, deltas, now_ns)
+    replayed.close()
+
+def test_index_event_added_before_fixed_point():
+    index = CountIndex()
+    timestamps = np.arange(0, 10 * HOUR_NS, 7 * MINUTE_NS)
+    index.add_many(timestamps, np.ones(len(timestamps)), fixed_before_ns=5 * HOUR_NS)
+    assert all(window * FIFTEEN_MIN_NS >= 5 * HOUR_NS for window in index.window_counts)
+    # a late event in a compacted window goes to the fixed buckets
+    late = 2 * HOUR_NS + 3 * MINUTE_NS
+    for _ in range(5):
+        index.add(late, 1)
+    timestamps = np.sort(np.concatenate([timestamps, [late] * 5]))
+    assert index.count_between(0, 10 * HOUR_NS) == len(timestamps)
+    assert index.count_between(2 * HOUR_NS, 2 * HOUR_NS + FIFTEEN_MIN_NS) == 7
+    assert index.top_windows(1) == [(2 * HOUR_NS, 7)]
+    assert index.all_window_counts() == window_totals(timestamps, np.ones(len(timestamps)))
@@ -0,0 +1,163 @@
+# -----------------------------------------------------------
+# Reporting pipeline for the counts. The minute, 15 minute and
+#  running total series are computed from the event arrays in one
+#  vectorized pass, the timeline is downsampled before it is drawn
+#  and the CSV files are written in chunks so large histories do
+#  not need a DataFrame of every event
+#
+# (C) 2023 Daniel VanVolkinburg
+# Released under GNU Public License (GPL)
+# email dvanvolk@ieee.org
+# -----------------------------------------------------------
+from datetime import datetime
+import os
+import numpy as np
+
+from rollup import MINUTE_NS, FIFTEEN_MIN_NS
+
+CSV_CHUNK_ROWS = 100_000
+MAX_TIMELINE_POINTS = 2000
+MAX_BARS = 500
+
+class CountRollups:
+    """Dense minute and 15 minute series plus the running total, computed from the event arrays"""
+    def __init__(self, timestamps_ns, deltas):
+        self.timestamps = np.asarray(timestamps_ns, dtype=np.int64)
+        self.deltas = np.asarray(deltas, dtype=np.int64)
+        if np.any(np.diff(self.timestamps) < 0):
+            order = np.argsort(self.timestamps, kind='stable')
+            self.timestamps = self.timestamps[order]
+            self.deltas = self.deltas[order]
+        self.total_count = np.cumsum(self.deltas)
+        self.minute_start, self.minute_counts = self.__bucket_counts(MINUTE_NS)
+        self.fifteen_min_start, self.fifteen_min_counts = self.__bucket_counts(FIFTEEN_MIN_NS)
+
+    def __bucket_counts(self, bucket_ns):
+        """Sum the deltas into every bucket from the first to the last event, including empty ones"""
+        if len(self.timestamps) == 0:
+            return 0, np.zeros(0, dtype=np.int64)
+        buckets = self.timestamps // bucket_ns
+        first = int(buckets.min())
+        counts = np.bincount(buckets - first, weights=self.deltas).round().astype(np.int64)
+        return first * bucket_ns, counts
+
+    def minute_times(self):
+        """Start time of every minute bucket as datetime64"""
+        return bucket_times(self.minute_start, MINUTE_NS, len(self.minute_counts))
+
+    def fifteen_min_times(self):
+        """Start time of every 15 minute bucket as datetime64"""
+        return bucket_times(self.fifteen_min_start, FIFTEEN_MIN_NS, len(self.fifteen_min_counts))
+
+    def timeline(self, max_points=MAX_TIMELINE_POINTS):
+        """Running total downsampled to at most max_points, the last event of each time slice is kept
+           so the drawn line has the same steps at the resolution it is shown at"""
+        if len(self.timestamps) <= max_points:
+            return self.timestamps.astype('datetime64[ns]'), self.total_count
+        edges = np.linspace(self.timestamps[0], self.timestamps[-1], max_points + 1)[1:]
+        last_in_slice = np.unique(np.searchsorted(self.timestamps, edges, side='right') - 1)
+        last_in_slice = last_in_slice[last_in_slice >= 0]
+        return self.timestamps[last_in_slice].astype('datetime64[ns]'), self.total_count[last_in_slice]
+
+def bucket_times(start_ns, bucket_ns, count):
+    """Start times of count buckets, as datetime64"""
+    return (start_ns + np.arange(count, dtype=np.int64) * bucket_ns).astype('datetime64[ns]')
+
+def write_csv_chunks(file_name, index_column, columns, chunk_rows=CSV_CHUNK_ROWS):
+    """Write the columns to a CSV file a chunk at a time, in the same layout pandas to_csv uses
+       index_column - array of the index values (strings or datetime64)
+       columns - dictionary of {column name: array}"""
+    import pandas as pd
+    with open(file_name, 'w', encoding='utf-8', newline='') as csv_file:
+        for start in range(0, max(len(index_column), 1), chunk_rows):
+            stop = start + chunk_rows
+            index = index_column[start:stop]
+            if np.issubdtype(np.asarray(index).dtype, np.datetime64):
+                index = pd.DatetimeIndex(np.asarray(index).astype('datetime64[us]'))
+            chunk = pd.DataFrame({name: values[start:stop] for name, values in columns.items()}, index=index)
+            chunk.to_csv(csv_file, header=(start == 0), encoding='utf-8')
+
+def clock_labels(times):
+    """Format datetime64 times as HH:MM on the 12 hour clock, the label used in the CSV files"""
+    import pandas as pd
+    return pd.DatetimeIndex(times).strftime('%I:%M').to_numpy()
+
+def write_csv_files(rollups, year=None, output_dir='.'):
+    """Write the raw, minute and 15 minute CSV files, returns the file names"""
+    year = datetime.today().year if year is None else year
+    raw_file_name = os.path.join(output_dir, f"{year}_RawTrickOrTreatData.csv")
+    write_csv_chunks(raw_file_name, rollups.timestamps.astype('datetime64[ns]'),
+                     {'count': rollups.deltas, 'total_count': rollups.total_count})
+
+    min_file_name = os.path.join(output_dir, f"{year}_MinTrickOrTreatData.csv")
+    write_csv_chunks(min_file_name, clock_labels(rollups.minute_times()), {'count': rollups.minute_counts})
+
+    fifteen_file_name = os.path.join(output_dir, f"{year}_15minTrickOrTreatData.csv")
+    write_csv_chunks(fifteen_file_name, clock_labels(rollups.fifteen_min_times()), {'count': rollups.fifteen_min_counts})
+    return [raw_file_name, min_file_name, fifteen_file_name]
+
+def new_figure(headless, figsize=None):
+    """Create a figure, headless figures are not tied to pyplot so no display is needed"""
+    if headless:
+        from matplotlib.figure import Figure
+        return Figure(figsize=figsize)
+    import matplotlib.pyplot as plt
+    return plt.figure(figsize=figsize)
+
+def draw_counts(axes, times, counts, bucket_days, color, title):
+    """Bar chart of bucket counts, when there are too many buckets to see as bars the peak of each slice is stepped"""
+    from matplotlib.dates import DateFormatter
+    if len(counts) <= MAX_BARS:
+        axes.bar(times, counts, width=bucket_days, align='edge', color=color)
+    else:
+        slices = np.array_split(np.arange(len(counts)), MAX_BARS)
+        starts = np.array([piece[0] for piece in slices])
+        peaks = np.maximum.reduceat(counts, starts)
+        axes.step(times[starts], peaks, where='post', color=color)
+    axes.xaxis.set_major_formatter(DateFormatter('%I:%M'))
+    axes.set_xlabel("Time Stamp")
+    axes.set_ylabel("Count (Min)")
+    axes.set_title(title)
+
+def plot_rollups(rollups, show=True, image_format=None, year=None, output_dir='.'):
+    """Draw the minute, 15 minute and total timeline graphs
+       show - open the graphs in a window with plt.show()
+       image_format - 'png' or 'svg' to also save each graph to a file, None to not save them
+       returns the saved image file names"""
+    from matplotlib.dates import DateFormatter, MinuteLocator
+    year = datetime.today().year if year is None else year
+    headless = not show
+
+    min_figure = new_figure(headless)
+    draw_counts(min_figure.add_subplot(), rollups.minute_times(), rollups.minute_counts,
+                1 / (24 * 60), 'purple', "Count by Min")
+
+    fifteen_figure = new_figure(headless)
+    draw_counts(fifteen_figure.add_subplot(), rollups.fifteen_min_times(), rollups.fifteen_min_counts,
+                1 / (24 * 4), 'red', "Count by 15 Mins")
+
+    # Create a timeline plot of the total count
+    timeline_figure = new_figure(headless, figsize=(10, 3))
+    timeline_axes = timeline_figure.add_subplot()
+    times, totals = rollups.timeline()
+    timeline_axes.plot(times, totals, marker='x' if len(times) < 200 else None, linestyle='-', drawstyle='steps-post')
+    timeline_axes.xaxis.set_major_formatter(DateFormatter('%I:%M'))
+    if len(rollups.fifteen_min_counts) <= 4 * 6:
+        timeline_axes.xaxis.set_major_locator(MinuteLocator(interval=15))
+    timeline_axes.set_xlabel('Time')
+    timeline_axes.set_ylabel('Total Count')
+    timeline_axes.set_title('Total Trick-or-Treaters')
+    timeline_axes.grid(axis='x')
+    timeline_figure.tight_layout()
+
+    image_files = list()
+    if image_format is not None:
+        for name, figure in [('Min', min_figure), ('15min', fifteen_figure), ('Total', timeline_figure)]:
+            image_file = os.path.join(output_dir, f"{year}_{name}TrickOrTreatGraph.{image_format}")
+            figure.savefig(image_file, format=image_format)
+            image_files.append(image_file)
+
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return image_files